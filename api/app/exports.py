@@ -0,0 +1,166 @@
+# api/app/exports.py
+
+import os
+import json
+import time
+import uuid
+import hashlib
+import zipfile
+from typing import Dict, Iterator, List, Optional, Tuple
+from ocr_doc_utils import utils
+from ocr_doc_utils.sessions import SessionStore
+
+logger = utils.setup_logging()
+
+# Định dạng xuất cho mỗi kết quả: đuôi file → hàm tạo nội dung từ văn bản
+EXPORT_FORMATS = {
+    "txt": lambda text: text,
+    "md": lambda text: text,
+    "json": lambda text: json.dumps({"result": text}, ensure_ascii=False, indent=2),
+}
+
+# Thời điểm cố định cho mọi entry để cùng nội dung luôn ra cùng file ZIP (ETag / Range ổn định)
+_ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+class _ZipSink:
+    """File-like chỉ ghi: gom các byte zipfile sinh ra để phát dần và ghi song song ra file cache."""
+
+    def __init__(self, tee):
+        self._parts: List[bytes] = []
+        self._tee = tee
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._parts.append(data)
+        self._tee.write(data)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+class ZipExporter:
+    """
+    Xuất kết quả của một phiên (SessionStore) thành ZIP, tạo khi được yêu cầu.
+    Lần tải đầu tiên ZIP được phát theo luồng trong lúc nén, đồng thời ghi vào
+    `directory` theo khoá nội dung; các lần sau (và request Range để tải tiếp)
+    đọc file đã có. Cache quá `ttl` giây bị xoá.
+    """
+
+    def __init__(self, store: SessionStore, directory: str = "/data/exports", ttl: float = 24 * 3600):
+        self.store = store
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def entries(self, session_id: str, formats: List[str],
+                indices: Optional[List[int]] = None) -> List[Tuple[str, Dict, str]]:
+        """Danh sách (tên trong ZIP, mục, định dạng) theo thứ tự mục rồi định dạng."""
+        items = self.store.items(session_id)
+        if indices is not None:
+            wanted = set(indices)
+            items = [item for item in items if item["idx"] in wanted]
+        bases = [os.path.splitext(item["name"])[0] or f"file_{item['idx']}" for item in items]
+        out = []
+        for item, base in zip(items, bases):
+            # Trùng tên trong phiên → thêm chỉ số mục để không ghi đè nhau trong ZIP
+            if bases.count(base) > 1:
+                base = f"{base}_{item['idx']}"
+            for fmt in formats:
+                out.append((f"{base}.{fmt}", item, fmt))
+        return out
+
+    @staticmethod
+    def key(session_id: str, entries: List[Tuple[str, Dict, str]]) -> str:
+        """Khoá nội dung của ZIP: đổi khi danh sách file hoặc kết quả đổi."""
+        spec = [session_id] + [[arcname, item["result_hash"], fmt] for arcname, item, fmt in entries]
+        return hashlib.md5(json.dumps(spec).encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.zip")
+
+    def stream(self, key: str, entries: List[Tuple[str, Dict, str]]) -> Iterator[bytes]:
+        """Nén và phát từng phần ZIP; file cache chỉ xuất hiện khi đã ghi xong trọn vẹn."""
+        path = self.path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                sink = _ZipSink(f)
+                # sink không seek được → zipfile dùng data descriptor, bản phát và bản cache trùng byte
+                with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as zf:
+                    for arcname, item, fmt in entries:
+                        data = EXPORT_FORMATS[fmt](self.store.read_result(item)).encode("utf-8")
+                        info = zipfile.ZipInfo(arcname, date_time=_ZIP_DATE_TIME)
+                        info.compress_type = zipfile.ZIP_DEFLATED
+                        with zf.open(info, "w") as w:
+                            for offset in range(0, len(data), utils.CHUNK_SIZE):
+                                w.write(data[offset:offset + utils.CHUNK_SIZE])
+                                chunk = sink.drain()
+                                if chunk:
+                                    yield chunk
+                yield sink.drain()
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.prune()
+
+    def build(self, key: str, entries: List[Tuple[str, Dict, str]]) -> str:
+        """Đường dẫn ZIP trong cache, tạo nếu chưa có."""
+        path = self.path(key)
+        if not os.path.exists(path):
+            for _ in self.stream(key, entries):
+                pass
+        return path
+
+    def prune(self) -> None:
+        cutoff = time.time() - self.ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Đọc header Range dạng "bytes=a-b", "bytes=a-" hoặc "bytes=-n" thành (start, end) bao gồm end.
+    Trả về None nếu không có / nhiều khoảng (trả cả file); ném ValueError nếu không thoả mãn được.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, _, end = header[len("bytes="):].strip().partition("-")
+    try:
+        if not start:
+            length = int(end)
+            if length <= 0:
+                raise ValueError(header)
+            return max(size - length, 0), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        raise ValueError(header)
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, min(end, size - 1)
+
+
+def iter_file(path: str, start: int, end: int) -> Iterator[bytes]:
+    """Đọc các byte [start, end] của file theo khối."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(utils.CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
@@ -0,0 +1,219 @@
+# api/app/jobs.py
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from ocr_doc_utils import utils
+
+logger = utils.setup_logging()
+
+# Trạng thái của một job
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Giá trị cột api_key: job có API key riêng, key chỉ giữ trong bộ nhớ tiến trình
+KEY_IN_MEMORY = "memory"
+
+
+class JobStore:
+    """
+    Lưu job trong SQLite dưới `directory` (mặc định /data/jobs).
+    File đầu vào và kết quả nằm trong thư mục riêng của từng job,
+    DB chỉ giữ metadata để danh sách job nhẹ và sống sót qua restart.
+    API key riêng không được ghi xuống DB (volume /data dùng chung với FE): key nằm trong
+    bộ nhớ tới khi job kết thúc, nên job có key riêng không chạy tiếp được sau restart.
+    """
+
+    def __init__(self, directory: str = "/data/jobs"):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, "jobs.db"), check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                progress REAL NOT NULL DEFAULT 0,
+                source_type TEXT NOT NULL,
+                filename TEXT,
+                content_type TEXT,
+                url TEXT,
+                api_key TEXT,
+                mode TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._api_keys: Dict[str, str] = {}
+        # DB cũ lưu key dạng rõ: nạp key của job chưa xong vào bộ nhớ rồi xoá khỏi DB
+        rows = self._db.execute(
+            "SELECT id, status, api_key FROM jobs WHERE api_key IS NOT NULL AND api_key != ?", (KEY_IN_MEMORY,)
+        ).fetchall()
+        for row in rows:
+            if row["status"] in (QUEUED, RUNNING):
+                self._api_keys[row["id"]] = row["api_key"]
+            self._db.execute("UPDATE jobs SET api_key = ? WHERE id = ?",
+                             (KEY_IN_MEMORY if row["status"] in (QUEUED, RUNNING) else None, row["id"]))
+        self._db.commit()
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(self.directory, job_id)
+
+    def input_path(self, job_id: str) -> str:
+        return os.path.join(self.job_dir(job_id), "input")
+
+    def result_path(self, job_id: str) -> str:
+        return os.path.join(self.job_dir(job_id), "result.json")
+
+    def create(self, source_type: str, filename: str = None, content_type: str = None,
+               url: str = None, api_key: str = None, mode: str = None) -> str:
+        job_id = uuid.uuid4().hex
+        os.makedirs(self.job_dir(job_id), exist_ok=True)
+        now = time.time()
+        with self._lock:
+            if api_key:
+                self._api_keys[job_id] = api_key
+            self._db.execute(
+                "INSERT INTO jobs (id, status, progress, source_type, filename, content_type, url, api_key, mode, created_at, updated_at) "
+                "VALUES (?, ?, 0, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, source_type, filename, content_type, url, KEY_IN_MEMORY if api_key else None,
+                 mode, now, now),
+            )
+            self._db.commit()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def api_key(self, job_id: str) -> Optional[str]:
+        """API key riêng của job (None nếu job dùng key mặc định hoặc key đã mất sau restart)."""
+        return self._api_keys.get(job_id)
+
+    def update(self, job_id: str, **fields) -> None:
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            if "api_key" in fields and fields["api_key"] is None:
+                self._api_keys.pop(job_id, None)
+            self._db.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+            self._db.commit()
+
+    def unfinished(self) -> List[str]:
+        """Các job chưa xong (queued hoặc đang chạy khi tiến trình bị dừng), theo thứ tự tạo."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id FROM jobs WHERE status IN (?, ?) ORDER BY created_at", (QUEUED, RUNNING)
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+    def save_result(self, job_id: str, result: Dict[str, Any]) -> None:
+        path = self.result_path(job_id)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+
+    def load_result(self, job_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.result_path(job_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def discard_input(self, job_id: str) -> None:
+        try:
+            os.remove(self.input_path(job_id))
+        except FileNotFoundError:
+            pass
+
+
+# handler(job, report_progress) → dict kết quả (OCRResponse đã encode)
+JobHandler = Callable[[Dict[str, Any], Callable[[float], None]], Awaitable[Dict[str, Any]]]
+
+
+class JobManager:
+    """
+    Hàng đợi cục bộ + pool worker asyncio. Job được ghi vào JobStore trước khi
+    vào hàng đợi, nên khi khởi động lại các job queued/running được nạp lại.
+    """
+
+    def __init__(self, store: JobStore, handler: JobHandler, workers: int = 4):
+        self.store = store
+        self.handler = handler
+        self.workers = workers
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue()
+        pending = self.store.unfinished()
+        for job_id in pending:
+            self.store.update(job_id, status=QUEUED, progress=0)
+            self._queue.put_nowait(job_id)
+        if pending:
+            logger.info(f"Re-queued {len(pending)} unfinished OCR jobs")
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, job_id: str) -> None:
+        self._queue.put_nowait(job_id)
+
+    def queue_size(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id: str) -> None:
+        job = self.store.get(job_id)
+        if job is None or job["status"] not in (QUEUED, RUNNING):
+            return
+        if job["api_key"] == KEY_IN_MEMORY and self.store.api_key(job_id) is None:
+            # Tiến trình khởi động lại: key riêng không được lưu nên không chạy thay bằng key mặc định
+            self.store.update(job_id, status=FAILED, api_key=None,
+                              error="API key riêng không được lưu lại sau khi dịch vụ khởi động lại. Vui lòng gửi lại job.")
+            self.store.discard_input(job_id)
+            return
+        self.store.update(job_id, status=RUNNING, progress=0.05)
+
+        def report(progress: float) -> None:
+            self.store.update(job_id, progress=round(progress, 2))
+
+        try:
+            result = await self.handler(job, report)
+            self.store.save_result(job_id, result)
+            # Không giữ lại API key và file đầu vào sau khi job kết thúc
+            self.store.update(job_id, status=DONE, progress=1.0, api_key=None)
+        except asyncio.CancelledError:
+            # Tiến trình đang dừng: để job ở trạng thái running, sẽ được nạp lại khi khởi động
+            raise
+        except Exception as e:
+            detail = getattr(e, "detail", None) or str(e)
+            logger.error(f"OCR job {job_id} failed: {detail}")
+            self.store.update(job_id, status=FAILED, error=str(detail), api_key=None)
+        else:
+            logger.info(f"OCR job {job_id} done")
+        self.store.discard_input(job_id)
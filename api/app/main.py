@@ -1,16 +1,80 @@
 # api/app/main.py
 
 import os
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Query, Body, Header
+import json
+import time
+import asyncio
+import shutil
+import tempfile
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Query, Body, Header, Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from ocr_doc_utils import utils, postprocess, schemas
-from .ocr_service_client import call_ocr, validate_api_key
-import requests
-from typing import Dict
+from fastapi.responses import StreamingResponse, FileResponse
+from ocr_doc_utils import utils, postprocess, schemas, sessions, metrics, tracing, admission
+from .ocr_service_client import call_ocr, validate_api_key, get_http_client, close_http_client, validation_cache
+from .jobs import JobStore, JobManager, DONE, FAILED
+from .renders import PageRenderer
+from .exports import ZipExporter, EXPORT_FORMATS, parse_range, iter_file
+import httpx
+from typing import Dict, List
 
 logger = utils.setup_logging()
 app = FastAPI()
 
+# Job bất đồng bộ: hàng đợi lưu dưới /data để sống sót qua restart
+OCR_JOB_WORKERS = int(utils.get_env("OCR_JOB_WORKERS", "4"))
+OCR_JOB_TIMEOUT = float(utils.get_env("OCR_JOB_TIMEOUT", "900"))
+job_store = JobStore(utils.get_env("OCR_JOBS_DIR", "/data/jobs"))
+
+# File tải từ URL được giữ trong RAM tới ngưỡng này, lớn hơn thì tràn xuống file tạm
+URL_SPOOL_MAX_BYTES = int(utils.get_env("OCR_URL_SPOOL_MAX_BYTES", str(1024 * 1024)))
+
+# Số file xử lý đồng thời trong một request /ocr/batch
+OCR_BATCH_CONCURRENCY = int(utils.get_env("OCR_BATCH_CONCURRENCY", "4"))
+
+# Gắn thời gian từng giai đoạn (gateway + OCR-service) vào raw_json["stages"] cho mọi request
+OCR_DEBUG_TIMINGS = utils.get_env("OCR_DEBUG_TIMINGS", "0") == "1"
+
+# Phiên OCR lưu trên đĩa (dùng chung với FE qua volume /data)
+session_store = sessions.build_session_store()
+
+# Ảnh render từng trang cho FE xem trước, cache theo (hash file, trang, DPI);
+# chỉ render ở DPI preview / thumbnail, cache được dọn theo TTL và dung lượng
+OCR_PREVIEW_DPI = int(utils.get_env("OCR_PREVIEW_DPI", "100"))
+OCR_THUMB_DPI = int(utils.get_env("OCR_THUMB_DPI", "36"))
+page_renderer = PageRenderer(
+    utils.get_env("OCR_RENDER_DIR", "/data/renders"),
+    dpis=(OCR_THUMB_DPI, OCR_PREVIEW_DPI),
+    max_bytes=int(utils.get_env("OCR_RENDER_MAX_BYTES", str(1024 * 1024 * 1024))),
+    ttl=float(utils.get_env("OCR_RENDER_TTL", str(7 * 24 * 3600))) or None,
+)
+
+# ZIP xuất kết quả phiên, tạo khi được tải và cache theo nội dung để hỗ trợ Range / tải tiếp
+zip_exporter = ZipExporter(
+    session_store,
+    utils.get_env("OCR_EXPORT_DIR", "/data/exports"),
+    ttl=float(utils.get_env("OCR_EXPORT_TTL", str(24 * 3600))),
+)
+
+# Admission control: giới hạn request OCR đồng thời + hàng đợi có giới hạn (đầy → 429 + Retry-After),
+# token bucket theo API key (form api_key hoặc header X-API-Key). Thêm trước metrics/tracing để 429 vẫn được đếm.
+# Key trong header bị từ chối ngay ở middleware (trước khi đọc body); key trong form do endpoint kiểm tra.
+admission_limiter, rate_limiter = admission.build_admission("api")
+app.add_middleware(admission.AdmissionMiddleware, limiter=admission_limiter, paths=("/ocr", "/ocr/batch"),
+                   rate_limiter=rate_limiter, anonymous=False)
+
+# Metrics (GET /metrics): request/độ trễ theo route và giai đoạn xử lý của gateway
+metrics.instrument_app(app, "api")
+UPSTREAM_ERRORS = metrics.registry.counter(
+    "ocr_upstream_errors_total", "Số lỗi khi gọi OCR-service", ("status",))
+metrics.registry.add_collector(lambda: [
+    "# TYPE ocr_job_queue_size gauge", f"ocr_job_queue_size {job_manager.queue_size()}",
+])
+
+# Tracing: nối traceparent từ FE, truyền tiếp tới OCR-service (xuất span theo OCR_TRACE_EXPORTER)
+tracer = tracing.configure("api")
+tracing.instrument_app(app, tracer)
+
 # Thêm CORS middleware để frontend có thể gọi API
 app.add_middleware(
     CORSMiddleware,
@@ -20,11 +84,16 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.post("/ocr", response_model=schemas.OCRResponse)
+@app.post("/ocr", response_model=schemas.OCRResponse, response_model_exclude_unset=True)
 async def ocr_endpoint(
     file: UploadFile = File(None),
     url: str = Form(None),
     api_key: str = Form(None),
+    mode: str = Form(None),
+    fields: str = Form(None),
+    include_images: bool = Form(False),
+    session_id: str = Form(None),
+    debug: bool = Form(False),
     x_api_key: str = Header(None)
 ):
     """
@@ -33,73 +102,516 @@ async def ocr_endpoint(
     3) Lấy text đã clean (hoặc tự clean nếu chưa có)
     4) Lấy markdown (hoặc tự tạo nếu chưa có)
     5) Trả về OCRResponse(text, markdown, raw_json)
+    `fields` (vd. "text" hoặc "text,pages,meta") chỉ lấy các phần cần dùng, cả từ OCR-service.
+    `include_images` trả thêm `images`: đường dẫn ảnh trích xuất dưới /data (không nhúng base64).
+    `session_id` lưu file gốc và kết quả vào phiên (SessionStore) để xem lại / xuất sau.
+    `debug` gắn thời gian từng giai đoạn của gateway và OCR-service vào raw_json["stages"].
     """
     if not file and not url:
         raise HTTPException(
             status_code=400,
             detail="Vui lòng cung cấp file upload hoặc URL"
         )
+    requested = parse_fields_or_400(fields)
+    if session_id and not sessions.SESSION_ID_PATTERN.match(session_id):
+        raise HTTPException(status_code=400, detail="session_id không hợp lệ")
     
     # Prefer form data API key over header
     effective_api_key = api_key or x_api_key
+    check_rate_or_429(effective_api_key, x_api_key)
     
-    # Trường hợp URL
-    if url:
+    with metrics.start_timer("api") as timer:
+        # Trường hợp URL
+        if url:
+            source, filename, content_type = await fetch_url(url)
+        # Trường hợp file upload: chuyển tiếp file đã spool, không đọc toàn bộ vào RAM
+        else:
+            source = file.file
+            filename = file.filename
+            content_type = file.content_type
+        timer.content_type = content_type or ""
+
         try:
-            logger.info(f"Fetching file from URL: {url}")
-            response = requests.get(url, timeout=30)
-            response.raise_for_status()
-            raw = response.content
-            filename = url.split("/")[-1]
-            content_type = response.headers.get("Content-Type", "application/octet-stream")
-        except Exception as e:
-            logger.error(f"Failed to fetch URL {url}: {str(e)}")
-            raise HTTPException(
-                status_code=400,
-                detail=f"Không thể tải file từ URL: {str(e)}"
+            response = await run_ocr(
+                source, filename, content_type,
+                source_type="url" if url else "upload",
+                api_key=effective_api_key, mode=mode, fields=requested, include_images=include_images,
+                debug=debug or OCR_DEBUG_TIMINGS
             )
-    # Trường hợp file upload
-    else:
-        filename = file.filename
-        content_type = file.content_type
-        raw = await file.read()
+            if session_id:
+                with timer.stage("session_store"):
+                    await asyncio.to_thread(
+                        session_store.add_item, session_id, filename, response.text or "",
+                        content_type=content_type, source=source, url=url
+                    )
+            return response
+        finally:
+            if url:
+                source.close()
+
+def check_rate_or_429(api_key: str, header_key: str = None, cost: int = 1):
+    """
+    Từ chối (429 + Retry-After) khi API key không còn đủ `cost` token (OCR_RATE_LIMIT).
+    `header_key`: key trong header X-API-Key mà AdmissionMiddleware đã tính một token;
+    nếu trùng `api_key` thì chỉ trừ phần còn lại.
+    """
+    if header_key and header_key == api_key:
+        cost -= 1
+    try:
+        admission.check_rate(rate_limiter, api_key, "api", cost)
+    except admission.Overloaded as e:
+        raise HTTPException(
+            status_code=429,
+            detail="Vượt giới hạn số request cho API key này, vui lòng thử lại sau",
+            headers={"Retry-After": e.retry_after_header()}
+        )
+
+def parse_fields_or_400(fields: str):
+    try:
+        return schemas.parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def fetch_url(url: str):
+    """
+    Tải file từ URL qua HTTP client dùng chung, ghi theo luồng vào file tạm.
+    Trả về (file tạm đã tua về đầu, filename, content_type); người gọi chịu trách nhiệm đóng file.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=URL_SPOOL_MAX_BYTES)
+    try:
+        logger.info(f"Fetching file from URL: {url}")
+        with metrics.stage("fetch"):
+            async with get_http_client().stream("GET", url, timeout=httpx.Timeout(30, connect=5)) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(utils.CHUNK_SIZE):
+                    spool.write(chunk)
+                content_type = response.headers.get("Content-Type", "application/octet-stream")
+        spool.seek(0)
+        filename = url.split("/")[-1]
+    except Exception as e:
+        spool.close()
+        logger.error(f"Failed to fetch URL {url}: {str(e)}")
+        raise HTTPException(
+            status_code=400,
+            detail=f"Không thể tải file từ URL: {str(e)}"
+        )
+    return spool, filename, content_type
+
+async def run_ocr(source, filename: str, content_type: str, source_type: str,
+                  api_key: str = None, mode: str = None, timeout: float = None,
+                  fields: set = None, include_images: bool = False, debug: bool = False) -> schemas.OCRResponse:
+    """
+    Pipeline dùng chung cho /ocr và job bất đồng bộ:
+    gọi OCR-service, lấy text clean + markdown và gắn metadata file vào raw_json.
+    `source` là file object (được stream tới service) hoặc bytes.
+    `fields` là profile đã parse (schemas.parse_fields); None = đầy đủ. OCR-service chỉ được
+    yêu cầu trả các phần trong profile.
+    `debug` gắn raw_json["stages"] = {"api": ..., "ocr_service": ...} (giây theo giai đoạn).
+    """
+    file_size = len(source) if isinstance(source, (bytes, bytearray)) else utils.stream_size(source)
+    fields = fields or set(schemas.RESPONSE_FIELDS)
+    full_profile = fields >= set(schemas.RESPONSE_FIELDS)
 
     # --- gọi service ---
     try:
-        data = call_ocr(raw, filename=filename, content_type=content_type, api_key=effective_api_key)
-    except HTTPException:
+        with metrics.stage("upstream"):
+            data = await call_ocr(
+                source, filename=filename, content_type=content_type, api_key=api_key, mode=mode, timeout=timeout,
+                fields=None if full_profile else ",".join(sorted(fields)),
+                include_images=include_images, debug=debug
+            )
+    except HTTPException as e:
         # service trả HTTPException rồi, chỉ re-raise
+        UPSTREAM_ERRORS.inc(status=str(e.status_code))
         raise
     except Exception as e:
+        UPSTREAM_ERRORS.inc(status="502")
         logger.error("Call to OCR-service failed: %s", e)
         raise HTTPException(status_code=502, detail="OCR engine error")
 
-    # --- xử lý text & markdown ---
-    # nếu call_ocr đã trả về trường 'clean', ưu tiên dùng
-    clean = data.get("clean") or postprocess.correct(data.get("text", ""))
-    # nếu call_ocr đã trả 'markdown', ưu tiên dùng
-    md = data.get("markdown") or f"```txt\n{clean}\n```"
-
     # --- chuẩn bị raw_json trả về ---
     # nếu service trả 'raw_json', dùng, nếu không thì toàn bộ dict
     raw_json = data.get("raw_json", data)
+
+    # --- xử lý text & markdown ---
+    # `text` của OCR-service đã được hậu xử lý; chỉ tự clean khi service không trả về
+    clean = data.get("text")
+    with metrics.stage("postprocess"):
+        if clean is None and (full_profile or fields & {"text", "markdown"}):
+            clean = postprocess.correct((raw_json or {}).get("text", ""))
+        # nếu call_ocr đã trả 'markdown', ưu tiên dùng
+        md = None
+        if "markdown" in fields:
+            md = data.get("markdown") or f"```txt\n{clean}\n```"
     
     # Thêm thông tin file vào raw_json
-    if isinstance(raw_json, dict):
+    if isinstance(raw_json, dict) and "meta" in fields:
         raw_json.update({
             "filename": filename,
             "content_type": content_type,
-            "source_type": "url" if url else "upload",
+            "source_type": source_type,
             "timestamp": utils.get_timestamp(),
-            "file_size_bytes": len(raw)
+            "file_size_bytes": file_size
         })
+    timer = metrics.current_timer()
+    if debug and isinstance(raw_json, dict) and timer is not None:
+        raw_json["stages"] = {"api": timer.summary(), "ocr_service": raw_json.get("stages", {})}
 
-    return schemas.OCRResponse(
+    return schemas.build_response(
+        fields,
         text=clean,
         markdown=md,
-        raw_json=raw_json
+        raw_json=raw_json,
+        images=data.get("images") if include_images else None
     )
 
+async def process_job(job: dict, report) -> dict:
+    """
+    Handler của JobManager: đọc đầu vào đã lưu (hoặc tải URL) rồi chạy pipeline OCR.
+    """
+    with tracer.start_span("job", attributes={"job.id": job["id"]}), \
+            metrics.start_timer("api", job["content_type"] or "") as timer:
+        # Thời gian job nằm trong hàng đợi trước khi worker nhận
+        timer.record("queue", max(time.time() - job["created_at"], 0.0))
+        if job["source_type"] == "url":
+            source, filename, content_type = await fetch_url(job["url"])
+        else:
+            source = open(job_store.input_path(job["id"]), "rb")
+            filename, content_type = job["filename"], job["content_type"]
+        report(0.2)
+        
+        try:
+            response = await run_ocr(
+                source, filename, content_type,
+                source_type=job["source_type"], api_key=job_store.api_key(job["id"]), mode=job["mode"],
+                timeout=OCR_JOB_TIMEOUT, debug=OCR_DEBUG_TIMINGS
+            )
+        finally:
+            source.close()
+        return jsonable_encoder(response)
+
+job_manager = JobManager(job_store, process_job, workers=OCR_JOB_WORKERS)
+
+@app.on_event("startup")
+async def start_job_workers():
+    await job_manager.start()
+
+@app.on_event("shutdown")
+async def stop_job_workers():
+    await job_manager.stop()
+    await close_http_client()
+
+def job_status(job: dict) -> schemas.JobStatus:
+    return schemas.JobStatus(
+        job_id=job["id"],
+        status=job["status"],
+        progress=job["progress"],
+        filename=job["filename"] or (job["url"] or "").split("/")[-1],
+        source_type=job["source_type"],
+        error=job["error"],
+        created_at=utils.format_timestamp(job["created_at"]),
+        updated_at=utils.format_timestamp(job["updated_at"])
+    )
+
+@app.post("/jobs", response_model=schemas.JobStatus, status_code=202)
+async def submit_job(
+    file: UploadFile = File(None),
+    url: str = Form(None),
+    api_key: str = Form(None),
+    mode: str = Form(None),
+    x_api_key: str = Header(None)
+):
+    """
+    Tạo job OCR bất đồng bộ và trả về job_id ngay lập tức.
+    Theo dõi bằng GET /jobs/{job_id}, lấy kết quả bằng GET /jobs/{job_id}/result.
+    """
+    if not file and not url:
+        raise HTTPException(
+            status_code=400,
+            detail="Vui lòng cung cấp file upload hoặc URL"
+        )
+    check_rate_or_429(api_key or x_api_key)
+    
+    tmp_path = None
+    if not url:
+        # Ghi file upload ra file tạm (cùng thư mục job) trước khi tạo job:
+        # copy lỗi giữa chừng không để lại job QUEUED không có input
+        fd, tmp_path = tempfile.mkstemp(dir=job_store.directory, suffix=".upload")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                await asyncio.to_thread(shutil.copyfileobj, file.file, f, utils.CHUNK_SIZE)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    
+    try:
+        job_id = await asyncio.to_thread(
+            job_store.create,
+            source_type="url" if url else "upload",
+            filename=None if url else file.filename,
+            content_type=None if url else file.content_type,
+            url=url,
+            api_key=api_key or x_api_key,
+            mode=mode
+        )
+        if tmp_path:
+            try:
+                os.replace(tmp_path, job_store.input_path(job_id))
+            except OSError as e:
+                await asyncio.to_thread(job_store.update, job_id, status=FAILED, error=str(e), api_key=None)
+                raise
+            tmp_path = None
+    finally:
+        if tmp_path:
+            os.remove(tmp_path)
+    
+    job_manager.submit(job_id)
+    return job_status(await asyncio.to_thread(job_store.get, job_id))
+
+@app.get("/jobs/{job_id}", response_model=schemas.JobStatus)
+def get_job(job_id: str):
+    """Trạng thái và tiến độ của job"""
+    job = job_store.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_status(job)
+
+@app.get("/jobs/{job_id}/result", response_model=schemas.OCRResponse)
+def get_job_result(job_id: str):
+    """Kết quả OCRResponse của job đã hoàn thành"""
+    job = job_store.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] == FAILED:
+        raise HTTPException(status_code=502, detail=job["error"] or "OCR job failed")
+    if job["status"] != DONE:
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    return job_store.load_result(job_id)
+
+def encode_batch_event(event: dict, fmt: str) -> str:
+    payload = json.dumps(event, ensure_ascii=False)
+    if fmt == "sse":
+        return f"event: {event['type']}\ndata: {payload}\n\n"
+    return payload + "\n"
+
+@app.post("/ocr/batch")
+async def ocr_batch_endpoint(
+    files: List[UploadFile] = File(None),
+    urls: List[str] = Form(None),
+    api_key: str = Form(None),
+    mode: str = Form(None),
+    fields: str = Form(None),
+    include_images: bool = Form(False),
+    x_api_key: str = Header(None),
+    format: str = Query("ndjson", pattern="^(ndjson|sse)$")
+):
+    """
+    OCR nhiều file/URL trong một request. Các mục được xử lý đồng thời
+    (tối đa OCR_BATCH_CONCURRENCY) và kết quả được stream về theo thứ tự hoàn thành,
+    mỗi mục một dòng NDJSON (hoặc một event SSE):
+      {"type": "result", "index": 0, "filename": ..., "status": "ok", "result": OCRResponse}
+      {"type": "result", "index": 1, "filename": ..., "status": "error", "status_code": 400, "error": ...}
+    Dòng cuối: {"type": "summary", "total": N, "succeeded": ..., "failed": ...}
+    `fields` và `include_images` có ý nghĩa như ở /ocr.
+    """
+    if not files and not urls:
+        raise HTTPException(
+            status_code=400,
+            detail="Vui lòng cung cấp file upload hoặc URL"
+        )
+    requested = parse_fields_or_400(fields)
+    
+    # Mỗi file / URL tốn một token; không đủ token cho cả batch thì từ chối toàn bộ
+    item_count = len(files or []) + len(urls or [])
+    if rate_limiter.enabled and item_count > rate_limiter.burst:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Batch tối đa {rate_limiter.burst} file/URL (OCR_RATE_BURST)"
+        )
+    effective_api_key = api_key or x_api_key
+    check_rate_or_429(effective_api_key, x_api_key, cost=item_count)
+    
+    # Sao chép file upload sang file tạm riêng: form upload bị đóng trước khi stream response chạy
+    items = []
+    for upload in files or []:
+        spool = tempfile.SpooledTemporaryFile(max_size=URL_SPOOL_MAX_BYTES)
+        await asyncio.to_thread(shutil.copyfileobj, upload.file, spool, utils.CHUNK_SIZE)
+        spool.seek(0)
+        items.append({"filename": upload.filename, "content_type": upload.content_type, "source": spool, "url": None})
+    for url in urls or []:
+        items.append({"filename": url.split("/")[-1], "content_type": None, "source": None, "url": url})
+    
+    semaphore = asyncio.Semaphore(OCR_BATCH_CONCURRENCY)
+    
+    async def run_item(index: int, item: dict) -> dict:
+        event = {"type": "result", "index": index, "filename": item["filename"]}
+        async with semaphore:
+            with metrics.start_timer("api", item["content_type"] or "") as timer:
+                try:
+                    if item["url"]:
+                        source, filename, content_type = await fetch_url(item["url"])
+                    else:
+                        source, filename, content_type = item["source"], item["filename"], item["content_type"]
+                    timer.content_type = content_type or ""
+                    try:
+                        response = await run_ocr(
+                            source, filename, content_type,
+                            source_type="url" if item["url"] else "upload",
+                            api_key=effective_api_key, mode=mode, fields=requested,
+                            include_images=include_images, debug=OCR_DEBUG_TIMINGS
+                        )
+                    finally:
+                        source.close()
+                    event.update(status="ok", result=jsonable_encoder(response, exclude_unset=True))
+                except HTTPException as e:
+                    event.update(status="error", status_code=e.status_code, error=e.detail)
+                except Exception as e:
+                    logger.error(f"Batch item {item['filename']} failed: {str(e)}")
+                    event.update(status="error", status_code=500, error=str(e))
+        return event
+    
+    async def stream():
+        tasks = [asyncio.create_task(run_item(i, item)) for i, item in enumerate(items)]
+        succeeded = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                event = await next_done
+                succeeded += event["status"] == "ok"
+                yield encode_batch_event(event, format)
+            yield encode_batch_event({
+                "type": "summary",
+                "total": len(items),
+                "succeeded": succeeded,
+                "failed": len(items) - succeeded
+            }, format)
+        finally:
+            # Client ngắt kết nối giữa chừng: huỷ các mục còn lại và dọn file tạm
+            for task in tasks:
+                task.cancel()
+            for item in items:
+                if item["source"] is not None:
+                    item["source"].close()
+    
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(stream(), media_type=media_type)
+
+@app.get("/sessions/{session_id}")
+def get_session(session_id: str):
+    """Danh sách mục (metadata, không kèm kết quả) của một phiên OCR"""
+    items = session_store.items(session_id)
+    if not items:
+        raise HTTPException(status_code=404, detail="Session not found")
+    session_store.touch(session_id)
+    return {
+        "session_id": session_id,
+        "items": [
+            {key: item[key] for key in ("idx", "name", "content_type", "url", "file_hash", "file_size")}
+            for item in items
+        ]
+    }
+
+@app.get("/sessions/{session_id}/export")
+async def export_session(
+    session_id: str,
+    request: Request,
+    formats: str = Query("txt,md,json"),
+    items: str = Query(None),
+):
+    """
+    Tải ZIP kết quả của phiên: `formats` (txt, md, json) và `items` (chỉ số mục, vd. "0,2")
+    chọn phần cần xuất. ZIP được nén theo luồng ở lần tải đầu; khi đã có trong cache thì hỗ trợ
+    Range / If-Range để tải tiếp file lớn.
+    """
+    selected_formats = [fmt.strip().lower() for fmt in formats.split(",") if fmt.strip()]
+    unknown = set(selected_formats) - set(EXPORT_FORMATS)
+    if not selected_formats or unknown:
+        raise HTTPException(status_code=400, detail=f"formats chỉ gồm: {', '.join(EXPORT_FORMATS)}")
+    try:
+        indices = [int(idx) for idx in items.split(",") if idx.strip()] if items else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="items phải là danh sách chỉ số mục")
+
+    entries = await asyncio.to_thread(zip_exporter.entries, session_id, selected_formats, indices)
+    if not entries:
+        raise HTTPException(status_code=404, detail="Session not found or empty")
+    session_store.touch(session_id)
+
+    key = zip_exporter.key(session_id, entries)
+    etag = f'"{key}"'
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Content-Disposition": f'attachment; filename="{session_id}.zip"',
+    }
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if if_range and if_range != etag:
+        range_header = None  # Nội dung đã đổi từ lần tải trước: trả lại cả file
+    path = zip_exporter.path(key)
+
+    if not os.path.exists(path):
+        if not range_header:
+            return StreamingResponse(zip_exporter.stream(key, entries), media_type="application/zip", headers=headers)
+        path = await asyncio.to_thread(zip_exporter.build, key, entries)
+
+    size = os.path.getsize(path)
+    try:
+        byte_range = parse_range(range_header, size)
+    except ValueError:
+        raise HTTPException(status_code=416, detail="Range không hợp lệ", headers={"Content-Range": f"bytes */{size}"})
+    if byte_range is None:
+        return StreamingResponse(
+            iter_file(path, 0, size - 1), media_type="application/zip",
+            headers={**headers, "Content-Length": str(size)}
+        )
+    start, end = byte_range
+    return StreamingResponse(
+        iter_file(path, start, end), status_code=206, media_type="application/zip",
+        headers={**headers, "Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(end - start + 1)}
+    )
+
+def blob_path_or_404(file_hash: str) -> str:
+    """Đường dẫn file gốc đã lưu trong SessionStore theo hash nội dung."""
+    if not sessions.BLOB_ID_PATTERN.match(file_hash):
+        raise HTTPException(status_code=400, detail="file_hash không hợp lệ")
+    path = session_store.blob_path(file_hash)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="File not found")
+    return path
+
+def render_response(file_hash: str, page: int, dpi: int) -> FileResponse:
+    path = blob_path_or_404(file_hash)
+    try:
+        out_path = page_renderer.render(file_hash, path, page, dpi)
+    except Exception as e:
+        logger.error(f"Render error {file_hash} page {page}: {str(e)}")
+        raise HTTPException(status_code=422, detail=f"Không render được file: {str(e)}")
+    if out_path is None:
+        raise HTTPException(status_code=404, detail="Page not found")
+    # Nội dung theo hash không bao giờ đổi: cho phép trình duyệt cache lâu dài
+    return FileResponse(out_path, media_type="image/jpeg",
+                        headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+@app.get("/files/{file_hash}/pages")
+def get_file_pages(file_hash: str):
+    """Số trang của file đã lưu (1 với ảnh)"""
+    path = blob_path_or_404(file_hash)
+    try:
+        page_count = page_renderer.page_count(file_hash, path)
+    except Exception as e:
+        raise HTTPException(status_code=422, detail=f"Không đọc được file: {str(e)}")
+    return {"file_hash": file_hash, "page_count": page_count}
+
+@app.get("/files/{file_hash}/pages/{page}")
+def get_file_page(file_hash: str, page: int, dpi: int = Query(None)):
+    """Ảnh JPEG một trang (1-based), chỉ trang được yêu cầu được render"""
+    return render_response(file_hash, page, dpi or OCR_PREVIEW_DPI)
+
+@app.get("/files/{file_hash}/thumbnail")
+def get_file_thumbnail(file_hash: str, page: int = Query(1)):
+    """Ảnh thu nhỏ của một trang"""
+    return render_response(file_hash, page, OCR_THUMB_DPI)
+
 @app.post("/ocr/validate")
 async def validate_api_key_endpoint(data: Dict[str, str] = Body(...)):
     """
@@ -121,7 +633,7 @@ async def validate_api_key_endpoint(data: Dict[str, str] = Body(...)):
         raise HTTPException(status_code=400, detail="API key is required")
     
     try:
-        is_valid = validate_api_key(api_key)
+        is_valid = await validate_api_key(api_key)
         if is_valid:
             return {"valid": True, "message": "API key is valid"}
         else:
@@ -130,6 +642,15 @@ async def validate_api_key_endpoint(data: Dict[str, str] = Body(...)):
         logger.error(f"API key validation error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error validating API key: {str(e)}")
 
+@app.get("/stats")
+def stats():
+    """API key validation cache and job queue counters"""
+    return {
+        "validation_cache": validation_cache.stats(),
+        "job_queue_size": job_manager.queue_size(),
+        "timestamp": utils.get_timestamp()
+    }
+
 @app.get("/health")
 def health_check():
     """Health check endpoint"""
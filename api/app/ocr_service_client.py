@@ -1,8 +1,9 @@
 #api/app/ocr_service_client.py
-import os
-import requests
+import hashlib
+import httpx
+from typing import BinaryIO, Optional, Union
 from fastapi import HTTPException
-from ocr_doc_utils import utils
+from ocr_doc_utils import utils, tracing, cache, resilience
 
 logger = utils.setup_logging()
 
@@ -10,28 +11,99 @@ logger = utils.setup_logging()
 OCR_URL = utils.get_env("OCR_SERVICE_URL", "http://ocr-service:9000/ocr")
 OCR_BASE_URL = OCR_URL.rsplit("/", 1)[0]  # Remove /ocr to get base URL
 
-def validate_api_key(api_key: str) -> bool:
+# Cấu hình pool kết nối dùng chung cho mọi request của tiến trình
+HTTP_MAX_CONNECTIONS = int(utils.get_env("OCR_HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(utils.get_env("OCR_HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(utils.get_env("OCR_HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_CONNECT_TIMEOUT = float(utils.get_env("OCR_HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_TIMEOUT = float(utils.get_env("OCR_HTTP_TIMEOUT", "60"))
+
+_client: Optional[httpx.AsyncClient] = None
+
+# Nhớ kết quả kiểm tra API key để FE rerun không gọi lại OCR-service mỗi lần
+VALIDATE_CACHE_TTL = float(utils.get_env("OCR_VALIDATE_CACHE_TTL", "300"))
+validation_cache = cache.ResultCache(cache.MemoryBackend(max_entries=1024, ttl=VALIDATE_CACHE_TTL))
+
+# Lời gọi tới OCR-service: thử lại lỗi tạm thời (kết nối, 5xx, 429) với backoff có jitter và circuit
+# breaker trả 503 ngay khi OCR-service đang hỏng (cấu hình OCR_UPSTREAM_*, xem resilience.build_caller).
+# Kết quả được OCR-service cache theo hash nên gửi lại cùng file là idempotent.
+upstream_caller = resilience.build_caller("ocr-service", "OCR_UPSTREAM", attempts=2)
+
+def retry_upstream(exc: BaseException) -> bool:
+    """502 nghĩa là OCR-service đã thử lại engine và vẫn lỗi: không gửi lại để tránh nhân số lần gọi."""
+    return resilience.is_transient(exc) and resilience.status_of(exc) != 502
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Trả về AsyncClient dùng chung (keep-alive, HTTP/2 nếu có gói `h2`).
+    Khởi tạo lười ở lần gọi đầu tiên trong event loop.
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=_http2_available(),
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            follow_redirects=True,
+        )
+    return _client
+
+async def close_http_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+async def validate_api_key(api_key: str) -> bool:
     """
     Validate an API key by calling the validation endpoint on the OCR service.
     Returns True if the key is valid, False otherwise.
+    Definite answers (200 / 401) are cached for OCR_VALIDATE_CACHE_TTL seconds.
     """
+    key_digest = hashlib.sha256(api_key.encode()).hexdigest()
+    known = validation_cache.get(key_digest)
+    if known is not None:
+        return known["valid"]
+    
     try:
         # Call the validation endpoint on the OCR service
-        resp = requests.post(
+        resp = await get_http_client().post(
             f"{OCR_BASE_URL}/validate_api_key",
             json={"api_key": api_key},
-            timeout=10
+            timeout=httpx.Timeout(10, connect=HTTP_CONNECT_TIMEOUT)
         )
         
         # Return True only if status code is 200
+        if resp.status_code in (200, 401):
+            validation_cache.set(key_digest, {"valid": resp.status_code == 200})
         return resp.status_code == 200
     except Exception as e:
         logger.error(f"Error validating API key: {str(e)}")
         return False
 
-def call_ocr(raw_bytes: bytes, filename: str = "upload.pdf", content_type: str = None, api_key: str = None) -> dict:
+async def call_ocr(source: Union[bytes, BinaryIO], filename: str = "upload.pdf", content_type: str = None, api_key: str = None, mode: str = None, timeout: float = None, fields: str = None, include_images: bool = False, debug: bool = False) -> dict:
     """
-    Send raw bytes to OCR‐service and return its full JSON:
+    Send a file to OCR‐service and return its full JSON.
+    `source` may be raw bytes or a seekable binary file object; file objects are
+    streamed to the service in chunks instead of being loaded into memory.
+    `mode` ("document" | "pages") is forwarded as-is; None lets the service decide.
+    `timeout` is the read timeout in seconds (defaults to OCR_HTTP_TIMEOUT; async jobs pass a larger value).
+    `fields` is the response profile (e.g. "text,meta"); only the requested parts are returned.
+    `include_images` asks the service to extract page images; they are written under /data
+    and returned as path references in "images".
+    `debug` asks the service to attach its per-stage timings to raw_json["stages"].
+    Returns:
       {
         "text": ...,
         "clean": ...,
@@ -51,47 +123,80 @@ def call_ocr(raw_bytes: bytes, filename: str = "upload.pdf", content_type: str =
                 content_type = 'image/png'
             else:
                 content_type = 'application/octet-stream'
-                
+        
         # Include content type in the request
         files = {
-            "file": (filename, raw_bytes, content_type)
+            "file": (filename, source, content_type)
         }
         
+        # Processing mode (document | pages), only sent when requested
+        form = {"mode": mode} if mode else {}
+        if fields:
+            form["fields"] = fields
+        if include_images:
+            form["include_images"] = "true"
+        if debug:
+            form["debug"] = "true"
+        
         # Add API key if provided
         headers = {}
         if api_key:
             headers["X-API-Key"] = api_key
+        # Truyền trace hiện tại (header traceparent) để span của OCR-service nằm cùng trace
+        headers = tracing.inject(headers)
         
-        # Add file hash to logging
-        file_hash = utils.compute_file_hash(raw_bytes)
-        file_info = utils.extract_file_info(filename)
-        logger.info(f"Processing file: {filename}, size: {len(raw_bytes)} bytes, hash: {file_hash}, type: {content_type}")
+        # Chỉ log kích thước: OCR-service tự hash khi ghi file, không đọc lại stream ở đây
+        file_size = len(source) if isinstance(source, (bytes, bytearray)) else utils.stream_size(source)
+        logger.info(f"Processing file: {filename}, size: {file_size} bytes, type: {content_type}")
         
-        resp = requests.post(
-            OCR_URL,
-            files=files,
-            headers=headers,
-            timeout=60  # Increased timeout for larger files
-        )
-        resp.raise_for_status()
+        async def post():
+            # Lần gửi lại đọc file từ đầu
+            if not isinstance(source, (bytes, bytearray)):
+                source.seek(0)
+            resp = await get_http_client().post(
+                OCR_URL,
+                files=files,
+                data=form,
+                headers=headers,
+                timeout=httpx.Timeout(timeout or HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+            )
+            resp.raise_for_status()
+            return resp
+        
+        # Không hedge: hai request đồng thời không thể cùng đọc một file stream
+        resp = await upstream_caller.call(post, hedge=False, retryable=retry_upstream)
         return resp.json()
-    except requests.exceptions.ConnectionError as e:
+    except resilience.CircuitOpen as e:
+        logger.error("OCR service circuit open: %s", e)
+        raise HTTPException(
+            status_code=503,
+            detail="OCR service tạm thời không khả dụng. Vui lòng thử lại sau.",
+            headers={"Retry-After": str(max(1, round(e.retry_after)))}
+        )
+    except (httpx.ConnectError, httpx.ConnectTimeout) as e:
         logger.error("Cannot connect to OCR service: %s", e)
         raise HTTPException(
             status_code=503,
             detail="OCR service không khả dụng. Vui lòng thử lại sau."
         )
-    except requests.exceptions.Timeout as e:
+    except httpx.TimeoutException as e:
         logger.error("OCR service timeout: %s", e)
         raise HTTPException(
             status_code=504,
             detail="OCR service xử lý quá lâu. Vui lòng thử lại sau."
         )
-    except requests.exceptions.HTTPError as e:
+    except httpx.HTTPStatusError as e:
         if e.response.status_code == 400:
             # Forward client errors
             detail = e.response.json().get("detail", str(e))
             raise HTTPException(status_code=400, detail=detail)
+        elif e.response.status_code == 429:
+            # OCR-service quá tải: trả 429 kèm Retry-After để client chờ rồi gửi lại
+            raise HTTPException(
+                status_code=429,
+                detail="OCR service đang quá tải. Vui lòng thử lại sau.",
+                headers={"Retry-After": e.response.headers.get("Retry-After", "1")}
+            )
         else:
             logger.error("OCR-service HTTP error: %s", e)
             raise HTTPException(
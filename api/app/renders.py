@@ -0,0 +1,168 @@
+# api/app/renders.py
+
+import io
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+from pdf2image import convert_from_path, pdfinfo_from_path
+from PIL import Image
+from ocr_doc_utils import utils
+
+logger = utils.setup_logging()
+
+
+class PageRenderer:
+    """
+    Render từng trang của file đã lưu (blob trong SessionStore) thành JPEG để FE xem trước.
+    Ảnh render được cache trên đĩa theo (hash file, trang, DPI) dưới `directory`,
+    nên mỗi trang chỉ render một lần và các lần xem sau chỉ đọc file.
+    Ảnh (png/jpg) được coi là file 1 trang và chỉ thu nhỏ theo DPI.
+    DPI yêu cầu được làm tròn về một trong `dpis` (preview / thumbnail), để mỗi trang
+    có tối đa vài bản render. Thư mục cache bị dọn theo `ttl` (giây kể từ lần dùng cuối)
+    và `max_bytes` (xoá bản dùng lâu nhất trước), tối đa mỗi `sweep_interval` giây.
+    """
+
+    def __init__(self, directory: str = "/data/renders", dpis: Iterable[int] = (36, 100),
+                 quality: int = 80, source_dpi: int = 200, max_bytes: int = 1024 * 1024 * 1024,
+                 ttl: Optional[float] = 7 * 24 * 3600, sweep_interval: float = 300,
+                 max_page_counts: int = 4096):
+        self.directory = directory
+        self.dpis = sorted(set(dpis))
+        self.quality = quality
+        self.source_dpi = source_dpi
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.max_page_counts = max_page_counts
+        self._last_sweep = 0.0
+        os.makedirs(directory, exist_ok=True)
+        # Khoá theo file render: hai request cùng trang không render hai lần
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+        self._page_counts: "OrderedDict[str, int]" = OrderedDict()  # LRU hash → số trang
+        self._sweep_lock = threading.Lock()
+
+    def render_path(self, digest: str, page: int, dpi: int) -> str:
+        return os.path.join(self.directory, digest[:2], digest, f"p{page:04d}_{dpi}.jpg")
+
+    def snap_dpi(self, dpi: int) -> int:
+        """DPI được phép gần `dpi` nhất."""
+        return min(self.dpis, key=lambda allowed: (abs(allowed - dpi), allowed))
+
+    @staticmethod
+    def is_pdf(path: str) -> bool:
+        with open(path, "rb") as f:
+            return f.read(5) == b"%PDF-"
+
+    def page_count(self, digest: str, path: str) -> int:
+        """Số trang (1 với ảnh), nhớ theo hash file (LRU) vì nội dung blob không đổi."""
+        with self._locks_guard:
+            count = self._page_counts.get(digest)
+            if count is not None:
+                self._page_counts.move_to_end(digest)
+                return count
+        count = pdfinfo_from_path(path)["Pages"] if self.is_pdf(path) else 1
+        with self._locks_guard:
+            self._page_counts[digest] = count
+            while len(self._page_counts) > self.max_page_counts:
+                self._page_counts.popitem(last=False)
+        return count
+
+    def _lock_for(self, key: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def render(self, digest: str, path: str, page: int, dpi: int) -> Optional[str]:
+        """
+        Đường dẫn JPEG của trang `page` (1-based) ở `dpi`, render nếu chưa có trong cache.
+        Trả về None nếu trang nằm ngoài file.
+        """
+        dpi = self.snap_dpi(dpi)
+        if page < 1 or page > self.page_count(digest, path):
+            return None
+        self.maybe_sweep()
+        out_path = self.render_path(digest, page, dpi)
+        if self._touch(out_path):
+            return out_path
+        lock = self._lock_for(out_path)
+        with lock:
+            if self._touch(out_path):
+                return out_path
+            buf = io.BytesIO()
+            if self.is_pdf(path):
+                image = convert_from_path(path, dpi=dpi, first_page=page, last_page=page)[0]
+                image.convert("RGB").save(buf, format="JPEG", quality=self.quality, optimize=True)
+            else:
+                with Image.open(path) as image:
+                    # Ảnh gốc coi như `source_dpi`: dpi thấp hơn → thu nhỏ tương ứng
+                    scale = min(1.0, dpi / self.source_dpi)
+                    image.thumbnail((max(1, int(image.width * scale)), max(1, int(image.height * scale))))
+                    image.convert("RGB").save(buf, format="JPEG", quality=self.quality, optimize=True)
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            tmp_path = f"{out_path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(buf.getvalue())
+            os.replace(tmp_path, out_path)
+        with self._locks_guard:
+            self._locks.pop(out_path, None)
+        logger.info(f"Rendered {digest} page {page} at {dpi} DPI ({len(buf.getvalue())} bytes)")
+        return out_path
+
+    @staticmethod
+    def _touch(path: str) -> bool:
+        """True nếu bản render đã có; cập nhật mtime để dọn theo lần dùng cuối (LRU)."""
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def maybe_sweep(self) -> None:
+        """Chạy `sweep` nếu lần dọn gần nhất đã quá `sweep_interval` giây."""
+        if time.time() - self._last_sweep >= self.sweep_interval:
+            self.sweep()
+
+    def sweep(self) -> int:
+        """Xoá bản render quá `ttl` rồi bản dùng lâu nhất cho tới khi dưới `max_bytes`."""
+        if not self._sweep_lock.acquire(blocking=False):
+            return 0
+        try:
+            self._last_sweep = time.time()
+            entries = []
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            cutoff = time.time() - self.ttl if self.ttl else None
+            removed = 0
+            for mtime, size, path in entries:
+                # File .tmp đang ghi dở còn mới: chỉ xoá khi đã quá hạn
+                expired = cutoff is not None and mtime < cutoff
+                if not expired and (total <= self.max_bytes or path.endswith(".tmp")):
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                total -= size
+                removed += 1
+            for root, dirs, files in os.walk(self.directory, topdown=False):
+                if root != self.directory and not dirs and not files:
+                    try:
+                        os.rmdir(root)
+                    except OSError:
+                        pass
+        finally:
+            self._sweep_lock.release()
+        if removed:
+            logger.info(f"Removed {removed} cached page renders ({total} bytes left)")
+        return removed
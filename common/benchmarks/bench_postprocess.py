@@ -0,0 +1,160 @@
+# common/benchmarks/bench_postprocess.py
+"""
+Benchmark hậu xử lý OCR (`ocr_doc_utils.postprocess.correct`).
+
+Sinh văn bản pháp luật tiếng Việt tổng hợp 1 / 100 / 1000 trang (giống đầu ra OCR:
+khoảng trắng thừa, ngắt dòng giữa đoạn, lỗi l.l, số thập phân, từ ghép bị tách),
+kiểm tra kết quả trùng byte với bản cài đặt cũ rồi đo thông lượng MB/s của `correct`
+và của `correct_stream` (đưa vào từng trang).
+
+    python common/benchmarks/bench_postprocess.py
+    python common/benchmarks/bench_postprocess.py --pages 1 100 1000 --repeat 5 --legacy
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ocr_doc_utils import postprocess  # noqa: E402
+
+
+def correct_legacy(text: str) -> str:
+    """Bản cài đặt trước khi tối ưu, giữ lại làm chuẩn so sánh (golden)."""
+    if not text:
+        return ""
+
+    lines = text.split('\n')
+    cleaned_lines = []
+
+    for line in lines:
+        cleaned_line = re.sub(r'\s+', ' ', line.strip())
+        cleaned_lines.append(cleaned_line)
+
+    result = ""
+    current_paragraph = []
+
+    for line in cleaned_lines:
+        if line.strip():
+            current_paragraph.append(line)
+        else:
+            if current_paragraph:
+                result += "\n".join(current_paragraph) + "\n\n"
+                current_paragraph = []
+            else:
+                result += "\n"
+
+    if current_paragraph:
+        result += "\n".join(current_paragraph)
+
+    corrections = [
+        (r'l\s?([^\w\s])\s?l', '1\\1'),
+        (r'([0-9])\s*\.\s*([0-9])', '\\1.\\2'),
+        (r'([a-z])\s*\-\s*([a-z])', '\\1-\\2'),
+    ]
+
+    for pattern, replacement in corrections:
+        result = re.sub(pattern, replacement, result)
+
+    result = re.sub(r'^(CHÍNH PHỦ|CỘNG HÒA XÃ HỘI CHỦ NGHĨA VIỆT NAM|NGHỊ ĐỊNH)$', r'\n\1\n', result, flags=re.MULTILINE)
+    result = re.sub(r'^(Điều \d+\.)', r'\n\1', result, flags=re.MULTILINE)
+
+    return result.strip()
+
+
+HEADER = [
+    "CHÍNH PHỦ",
+    "CỘNG HÒA XÃ HỘI CHỦ NGHĨA VIỆT NAM",
+    "Độc lập - Tự do - Hạnh phúc",
+    "",
+    "Số: l2/2024/NĐ-CP      Hà Nội, ngày 05 tháng 02 năm 2024",
+    "",
+    "NGHỊ ĐỊNH",
+    "Quy định chi tiết một số điều của Luật Đất đai",
+    "",
+]
+
+SENTENCES = [
+    "Nghị định này quy định chi tiết   một số điều, khoản của Luật Đất đai về quản lý nhà nước.",
+    "Cơ quan nhà nước có thẩm quyền thực hiện việc  thu hồi đất theo quy định tại Điều 79 .",
+    "Mức thu bằng 0 . 5 % giá trị quyền sử dụng đất tính theo bảng giá đất của Ủy ban nhân dân cấp tỉnh.",
+    "Hộ gia đình, cá nhân sử dụng đất ổn định lâu dài được cấp giấy chứng nhận quyền sử dụng đất - tài sản.",
+    "Diện tích đất nông nghiệp tối đa là l . l0 ha đối với mỗi loại đất  trồng cây hằng năm.",
+    "Người sử dụng đất có trách nhiệm kê khai, đăng ký đất đai theo mẫu do Bộ Tài nguyên và Môi trường ban hành.",
+    "Trường hợp không thống nhất thì giải quyết theo quy định của pháp luật về tố tụng dân sự -hành chính.",
+    "\tKinh phí thực hiện được bảo đảm từ ngân sách nhà nước và các nguồn hợp pháp khác.",
+]
+
+
+def make_pages(pages: int, seed: int = 0) -> list:
+    """Các trang văn bản tổng hợp, khoảng 3 KB mỗi trang."""
+    rnd = random.Random(seed)
+    article = 1
+    out = []
+    for page in range(pages):
+        lines = list(HEADER) if page == 0 else []
+        lines.append(f"--- Trang {page + 1}/{pages} ---")
+        lines.append("")
+        for _ in range(3):
+            lines.append(f"Điều {article}. Phạm vi điều chỉnh  và đối tượng áp dụng")
+            article += 1
+            for clause in range(1, rnd.randint(3, 5)):
+                # OCR thường ngắt dòng giữa câu và để thừa khoảng trắng cuối dòng
+                sentence = rnd.choice(SENTENCES)
+                cut = rnd.randint(20, len(sentence) - 10)
+                lines.append(f"{clause}. {sentence[:cut]}   ")
+                lines.append(sentence[cut:])
+                lines.append("")
+        out.append("\n".join(lines))
+    return out
+
+
+def make_document(pages: int, seed: int = 0) -> str:
+    """Văn bản tổng hợp, các trang nối bằng dòng trống như trong do_ocr."""
+    return "\n\n".join(make_pages(pages, seed))
+
+
+def measure(func, text: str, repeat: int) -> float:
+    """Thời gian tốt nhất (giây) trong `repeat` lần chạy."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ocr_doc_utils.postprocess.correct")
+    parser.add_argument("--pages", type=int, nargs="+", default=[1, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--legacy", action="store_true", help="đo cả bản cài đặt cũ để so sánh")
+    args = parser.parse_args()
+
+    print(f"{'pages':>6} {'size MB':>9} {'correct MB/s':>13} {'stream MB/s':>12}" + (f" {'legacy MB/s':>12} {'speedup':>8}" if args.legacy else ""))
+    for pages in args.pages:
+        page_texts = make_pages(pages)
+        text = "\n\n".join(page_texts)
+        size_mb = len(text.encode("utf-8")) / (1024 * 1024)
+
+        # Golden: kết quả phải trùng byte với bản cài đặt cũ
+        if postprocess.correct(text) != correct_legacy(text):
+            sys.exit(f"output differs from legacy implementation on {pages}-page document")
+        if "".join(postprocess.correct_stream(page_texts)) != correct_legacy(text):
+            sys.exit(f"correct_stream output differs on {pages}-page document")
+
+        seconds = measure(postprocess.correct, text, args.repeat)
+        stream_seconds = measure(lambda _: "".join(postprocess.correct_stream(page_texts)), text, args.repeat)
+        row = f"{pages:>6} {size_mb:>9.2f} {size_mb / seconds:>13.1f} {size_mb / stream_seconds:>12.1f}"
+        if args.legacy:
+            legacy_seconds = measure(correct_legacy, text, max(1, args.repeat // 2))
+            row += f" {size_mb / legacy_seconds:>12.1f} {legacy_seconds / seconds:>7.1f}x"
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+import os
+import json
+import time
+import math
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Iterable, Optional
+from . import metrics
+
+ADMISSION_IN_FLIGHT = metrics.registry.gauge(
+    "ocr_admission_in_flight", "Số request OCR đang được xử lý", ("service",))
+ADMISSION_QUEUE_DEPTH = metrics.registry.gauge(
+    "ocr_admission_queue_depth", "Số request OCR đang chờ slot", ("service",))
+ADMISSION_WAIT = metrics.registry.histogram(
+    "ocr_admission_wait_seconds", "Thời gian chờ slot trước khi được xử lý", ("service",))
+ADMISSION_REJECTED = metrics.registry.counter(
+    "ocr_admission_rejected_total", "Số request bị từ chối (429)", ("service", "reason"))
+
+
+class Overloaded(Exception):
+    """Request bị từ chối do quá tải (`reason`: queue_full | queue_timeout | rate_limited)."""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class ConcurrencyLimiter:
+    """
+    Giới hạn số request xử lý đồng thời (`limit`) kèm hàng đợi có giới hạn (`max_queue`).
+    Hàng đợi đầy → từ chối ngay; chờ quá `max_wait` giây → từ chối. Retry-After được ước lượng
+    từ thời gian xử lý trung bình (EWMA) và số request đang xếp trước.
+    """
+
+    def __init__(self, limit: int, max_queue: int, max_wait: float, service: str = ""):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.service = service
+        self.in_flight = 0
+        self.waiting = 0
+        self._avg_seconds = 1.0
+        self._condition: Optional[asyncio.Condition] = None
+
+    def _retry_after(self) -> float:
+        return self._avg_seconds * (self.waiting + 1) / max(self.limit, 1)
+
+    def _update_gauges(self) -> None:
+        ADMISSION_IN_FLIGHT.set(self.in_flight, service=self.service)
+        ADMISSION_QUEUE_DEPTH.set(self.waiting, service=self.service)
+
+    async def acquire(self) -> None:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        start = time.perf_counter()
+        async with self._condition:
+            if self.in_flight >= self.limit:
+                if self.waiting >= self.max_queue:
+                    raise Overloaded("queue_full", self._retry_after())
+                self.waiting += 1
+                self._update_gauges()
+                try:
+                    await asyncio.wait_for(
+                        self._condition.wait_for(lambda: self.in_flight < self.limit), timeout=self.max_wait
+                    )
+                except asyncio.TimeoutError:
+                    raise Overloaded("queue_timeout", self._retry_after())
+                finally:
+                    self.waiting -= 1
+            self.in_flight += 1
+            self._update_gauges()
+        ADMISSION_WAIT.observe(time.perf_counter() - start, service=self.service)
+
+    async def release(self, seconds: float) -> None:
+        async with self._condition:
+            self.in_flight -= 1
+            self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * seconds
+            self._update_gauges()
+            # Báo mọi request đang chờ: request hết hạn chờ không làm mất lượt của request khác
+            self._condition.notify_all()
+
+
+class RateLimiter:
+    """
+    Token bucket theo API key: `rate` request/giây, tối đa `burst` request liên tiếp.
+    Khoá là hash của key (không giữ key thô), tối đa `max_keys` bucket (LRU).
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()  # key → [tokens, thời điểm cập nhật]
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def check(self, api_key: Optional[str], cost: int = 1) -> float:
+        """
+        Lấy `cost` token (tất cả hoặc không); trả về 0 nếu được phép,
+        ngược lại số giây tới khi đủ token. `cost` lớn hơn `burst` không bao giờ đủ.
+        """
+        if not self.enabled or cost <= 0:
+            return 0.0
+        key = hashlib.sha256((api_key or "").encode()).hexdigest()
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(key, None) or [float(self.burst), now]
+            bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self._buckets[key] = bucket
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return 0.0
+            return (cost - bucket[0]) / self.rate
+
+
+class AdmissionMiddleware:
+    """
+    Middleware ASGI đứng trước các endpoint OCR: kiểm tra token bucket theo header X-API-Key
+    (nếu có `rate_limiter`) và giữ slot của `limiter` trong suốt request, kể cả khi stream
+    response. Chạy trước khi body được đọc nên request bị từ chối không tốn bộ nhớ / đĩa.
+    `anonymous=False`: request không có header không bị tính token ở đây (endpoint tự kiểm tra
+    key gửi qua form, tránh dồn mọi key form vào chung một bucket rỗng).
+    """
+
+    def __init__(self, app, limiter: ConcurrencyLimiter, paths: Iterable[str],
+                 rate_limiter: Optional[RateLimiter] = None, anonymous: bool = True):
+        self.app = app
+        self.limiter = limiter
+        self.paths = set(paths)
+        self.rate_limiter = rate_limiter
+        self.anonymous = anonymous
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        try:
+            if self.rate_limiter is not None:
+                api_key = dict(scope["headers"]).get(b"x-api-key", b"").decode("latin-1")
+                if api_key or self.anonymous:
+                    check_rate(self.rate_limiter, api_key or None, self.limiter.service)
+            await self.limiter.acquire()
+        except Overloaded as e:
+            return await send_429(send, e, self.limiter.service)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await self.limiter.release(time.perf_counter() - start)
+
+
+def check_rate(rate_limiter: RateLimiter, api_key: Optional[str], service: str = "", cost: int = 1) -> None:
+    """Ném Overloaded("rate_limited") nếu key không còn đủ `cost` token."""
+    wait = rate_limiter.check(api_key, cost)
+    if wait > 0:
+        ADMISSION_REJECTED.inc(service=service, reason="rate_limited")
+        raise Overloaded("rate_limited", wait)
+
+
+async def send_429(send, error: Overloaded, service: str = "") -> None:
+    if error.reason != "rate_limited":
+        ADMISSION_REJECTED.inc(service=service, reason=error.reason)
+    body = json.dumps({"detail": f"Hệ thống đang quá tải ({error.reason}), vui lòng thử lại sau"},
+                      ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": 429,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", error.retry_after_header().encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def build_admission(service: str, prefix: str = "OCR"):
+    """
+    Tạo (ConcurrencyLimiter, RateLimiter) từ biến môi trường:
+      OCR_MAX_IN_FLIGHT    số request OCR xử lý đồng thời (mặc định 16)
+      OCR_MAX_QUEUE        số request được chờ slot, vượt quá trả 429 ngay (mặc định 64)
+      OCR_QUEUE_TIMEOUT    số giây tối đa chờ slot (mặc định 30)
+      OCR_RATE_LIMIT       số request/giây cho mỗi API key (0 = không giới hạn)
+      OCR_RATE_BURST       số request liên tiếp tối đa cho mỗi API key (mặc định 10)
+    """
+    limiter = ConcurrencyLimiter(
+        limit=int(os.getenv(f"{prefix}_MAX_IN_FLIGHT", "16")),
+        max_queue=int(os.getenv(f"{prefix}_MAX_QUEUE", "64")),
+        max_wait=float(os.getenv(f"{prefix}_QUEUE_TIMEOUT", "30")),
+        service=service,
+    )
+    rate_limiter = RateLimiter(
+        rate=float(os.getenv(f"{prefix}_RATE_LIMIT", "0")),
+        burst=int(os.getenv(f"{prefix}_RATE_BURST", "10")),
+    )
+    return limiter, rate_limiter
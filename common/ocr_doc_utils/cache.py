@@ -0,0 +1,345 @@
+import os
+import json
+import math
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def make_key(file_hash: str, model: str, namespace: str = "doc") -> str:
+    """
+    Tạo khoá cache từ hash nội dung + tên model.
+    Cùng một file OCR bằng model khác sẽ có khoá khác.
+    """
+    return f"{namespace}:{model}:{file_hash}"
+
+
+class CacheBackend:
+    """
+    Giao diện chung cho các backend lưu kết quả OCR (giá trị là dict JSON được).
+    """
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+
+class MemoryBackend(CacheBackend):
+    """
+    LRU trong tiến trình, giới hạn theo số entry, tổng dung lượng và TTL.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 256 * 1024 * 1024, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()  # key → (expires_at, size, value)
+        self._bytes = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, _, value = item
+            if expires_at is not None and expires_at < time.time():
+                self._pop(key)
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        size = len(json.dumps(value, ensure_ascii=False).encode())
+        if size > self.max_bytes:
+            return
+        expires_at = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (expires_at, size, value)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._data))
+                self._pop(oldest)
+                self._evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        return {
+            "backend": "memory",
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "evictions": self._evictions,
+        }
+
+    def _pop(self, key):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+
+class DiskBackend(CacheBackend):
+    """
+    Lưu mỗi entry thành một file JSON trong `directory` (mặc định dưới /data).
+    LRU theo thời điểm truy cập (mtime được cập nhật khi đọc), TTL theo thời điểm ghi.
+    """
+
+    def __init__(self, directory: str = "/data/cache", max_bytes: int = 1024 * 1024 * 1024, ttl: Optional[float] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._bytes = sum(size for _, size, _ in self._scan())
+
+    def _path(self, key: str) -> str:
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], f"{digest}.json")
+
+    def _scan(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if self.ttl and entry.get("created_at", 0) + self.ttl < time.time():
+            self.delete(key)
+            return None
+        try:
+            os.utime(path)  # đánh dấu vừa được dùng cho LRU
+        except OSError:
+            pass
+        return entry.get("value")
+
+    def set(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        payload = json.dumps({"key": key, "created_at": time.time(), "value": value}, ensure_ascii=False)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(payload)
+        with self._lock:
+            # Ghi đè entry cũ: trừ kích thước cũ để tổng không bị cộng dồn
+            try:
+                self._bytes -= os.stat(path).st_size
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)
+            self._bytes += os.stat(path).st_size
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def delete(self, key):
+        path = self._path(key)
+        with self._lock:
+            try:
+                size = os.stat(path).st_size
+                os.remove(path)
+            except FileNotFoundError:
+                return
+            self._bytes = max(self._bytes - size, 0)
+
+    def clear(self):
+        with self._lock:
+            for path, _, _ in list(self._scan()):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._bytes = 0
+
+    def stats(self):
+        return {
+            "backend": "disk",
+            "directory": self.directory,
+            "bytes": self._bytes,
+            "evictions": self._evictions,
+        }
+
+    def _evict(self):
+        # Quét lại thư mục (có thể có tiến trình khác cùng ghi) rồi xoá file cũ nhất
+        entries = sorted(self._scan(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            self._evictions += 1
+        self._bytes = total
+
+
+class RedisBackend(CacheBackend):
+    """
+    Lưu vào Redis (hoặc server tương thích Redis). TTL dùng SETEX;
+    giới hạn dung lượng do cấu hình `maxmemory-policy` của server đảm nhiệm.
+    """
+
+    def __init__(self, url: str = "redis://localhost:6379/0", ttl: Optional[float] = None, prefix: str = "ocr:"):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("OCR_CACHE_BACKEND=redis cần cài thư viện `redis`") from e
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value):
+        payload = json.dumps(value, ensure_ascii=False)
+        if self.ttl:
+            # SETEX chỉ nhận số giây nguyên dương: TTL lẻ / dưới 1 giây được làm tròn lên
+            self.client.setex(self.prefix + key, max(1, math.ceil(self.ttl)), payload)
+        else:
+            self.client.set(self.prefix + key, payload)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + "*"):
+            self.client.delete(key)
+
+    def stats(self):
+        return {"backend": "redis"}
+
+
+class ResultCache:
+    """
+    Cache kết quả OCR với bộ đếm hit/miss. Lỗi backend chỉ được log và coi như miss,
+    để cache không bao giờ làm hỏng request OCR.
+    """
+
+    def __init__(self, backend: Optional[CacheBackend]):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        if self.backend is None:
+            return None
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            logger.warning(f"Cache get failed for {key}: {e}")
+            value = None
+            with self._lock:
+                self.errors += 1
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        if self.backend is None:
+            return
+        try:
+            self.backend.set(key, value)
+        except Exception as e:
+            logger.warning(f"Cache set failed for {key}: {e}")
+            with self._lock:
+                self.errors += 1
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        stats = {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+        if self.backend is not None:
+            stats.update(self.backend.stats())
+        return stats
+
+
+def build_cache(prefix: str = "OCR_CACHE") -> ResultCache:
+    """
+    Khởi tạo cache từ biến môi trường:
+      OCR_CACHE_BACKEND      memory | disk | redis | none (mặc định memory)
+      OCR_CACHE_TTL          số giây sống của entry (0 = không hết hạn)
+      OCR_CACHE_MAX_ENTRIES  số entry tối đa (memory)
+      OCR_CACHE_MAX_BYTES    dung lượng tối đa (memory, disk)
+      OCR_CACHE_DIR          thư mục cho backend disk
+      OCR_CACHE_REDIS_URL    URL cho backend redis
+    """
+    kind = os.getenv(f"{prefix}_BACKEND", "memory").lower()
+    ttl = float(os.getenv(f"{prefix}_TTL", "0")) or None
+
+    if kind in ("", "none", "off", "disabled"):
+        backend = None
+    elif kind == "memory":
+        backend = MemoryBackend(
+            max_entries=int(os.getenv(f"{prefix}_MAX_ENTRIES", "1024")),
+            max_bytes=int(os.getenv(f"{prefix}_MAX_BYTES", str(256 * 1024 * 1024))),
+            ttl=ttl,
+        )
+    elif kind == "disk":
+        backend = DiskBackend(
+            directory=os.getenv(f"{prefix}_DIR", "/data/cache"),
+            max_bytes=int(os.getenv(f"{prefix}_MAX_BYTES", str(1024 * 1024 * 1024))),
+            ttl=ttl,
+        )
+    elif kind == "redis":
+        backend = RedisBackend(url=os.getenv(f"{prefix}_REDIS_URL", "redis://localhost:6379/0"), ttl=ttl)
+    else:
+        raise RuntimeError(f"Unknown {prefix}_BACKEND: {kind}")
+
+    logger.info(f"OCR result cache backend: {kind}")
+    return ResultCache(backend)
@@ -0,0 +1,328 @@
+import os
+import time
+import bisect
+import threading
+import contextlib
+import contextvars
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from . import tracing
+
+# Ngưỡng histogram mặc định (giây): từ vài ms (hậu xử lý) tới vài phút (OCR PDF lớn)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Bộ đếm chỉ tăng."""
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in items]
+
+
+class Gauge(Counter):
+    """Giá trị tăng giảm được (số request đang xử lý, kích thước hàng đợi, ...)."""
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """Phân bố giá trị (độ trễ, kích thước) theo các ngưỡng cố định."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[Tuple, list] = {}  # key → [đếm theo bucket..., tổng, số mẫu]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((key, list(state)) for key, state in self._values.items())
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {state[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {state[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {state[-1]}")
+        return lines
+
+
+class Registry:
+    """
+    Tập metric của một tiến trình, xuất ở định dạng text của Prometheus (GET /metrics).
+    `add_collector` nhận hàm trả về các dòng sinh lúc scrape (vd. số liệu cache sẵn có).
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], List[str]]] = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], List[str]]) -> None:
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                lines.extend(collector())
+            except Exception:
+                pass  # số liệu phụ không được làm hỏng /metrics
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def process_metrics() -> List[str]:
+    """RSS và thời gian CPU của tiến trình (Linux /proc), dùng cho load test và giám sát."""
+    lines = ["# TYPE process_cpu_seconds_total counter", f"process_cpu_seconds_total {time.process_time()}"]
+    try:
+        with open("/proc/self/statm") as f:
+            rss_pages = int(f.read().split()[1])
+        lines += ["# TYPE process_resident_memory_bytes gauge",
+                  f"process_resident_memory_bytes {rss_pages * os.sysconf('SC_PAGE_SIZE')}"]
+    except (OSError, ValueError, IndexError):
+        pass
+    return lines
+
+
+registry = Registry()
+registry.add_collector(process_metrics)
+
+STAGE_SECONDS = registry.histogram(
+    "ocr_stage_duration_seconds", "Thời gian từng giai đoạn xử lý OCR",
+    ("service", "stage", "content_type")
+)
+
+
+def content_type_label(content_type: str) -> str:
+    """Nhãn content_type cho metrics: pdf | image | other (content type do client gửi, không giới hạn giá trị)."""
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    if content_type == "application/pdf":
+        return "pdf"
+    if content_type.startswith("image/"):
+        return "image"
+    return "other"
+
+
+class StageTimer:
+    """
+    Đo thời gian các giai đoạn của một request (upload, engine, postprocess, ...).
+    Thời gian được cộng dồn theo giai đoạn vào `stages` (giây, để gắn vào raw_json khi bật
+    debug) và ghi vào histogram STAGE_SECONDS một lần khi request kết thúc (`flush`), nên
+    `content_type` có thể được cập nhật khi mới biết (vd. sau khi tải URL).
+    Mỗi giai đoạn cũng là một span con khi tracing được bật.
+    """
+
+    def __init__(self, service: str, content_type: str = ""):
+        self.service = service
+        self.content_type = content_type
+        self.stages: Dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            with tracing.span(name):
+                yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def flush(self) -> None:
+        for name, seconds in self.stages.items():
+            STAGE_SECONDS.observe(seconds, service=self.service, stage=name,
+                                  content_type=content_type_label(self.content_type))
+
+    def summary(self) -> Dict[str, float]:
+        return {name: round(seconds, 4) for name, seconds in self.stages.items()}
+
+
+# Timer của request hiện tại: code sâu bên trong (engine, cache, ...) đo giai đoạn
+# mà không phải truyền timer qua từng hàm. contextvars đi theo task asyncio và to_thread.
+_current_timer: contextvars.ContextVar[Optional[StageTimer]] = contextvars.ContextVar("ocr_stage_timer", default=None)
+
+
+@contextlib.contextmanager
+def start_timer(service: str, content_type: str = ""):
+    timer = StageTimer(service, content_type)
+    token = _current_timer.set(timer)
+    try:
+        yield timer
+    finally:
+        _current_timer.reset(token)
+        timer.flush()
+
+
+def current_timer() -> Optional[StageTimer]:
+    return _current_timer.get()
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Đo giai đoạn `name` của request hiện tại (không làm gì nếu ngoài request)."""
+    timer = _current_timer.get()
+    if timer is None:
+        with tracing.span(name):
+            yield
+        return
+    with timer.stage(name):
+        yield
+
+
+def instrument_app(app, service: str) -> None:
+    """
+    Gắn middleware đếm request, số request đang xử lý, độ trễ và số byte vào/ra
+    theo route cho một ứng dụng FastAPI, cùng endpoint GET /metrics.
+    """
+    from fastapi import Request
+    from fastapi.responses import Response
+
+    requests_total = registry.counter(
+        "http_requests_total", "Số request HTTP", ("service", "method", "route", "status"))
+    in_flight = registry.gauge(
+        "http_requests_in_flight", "Số request HTTP đang xử lý", ("service", "method"))
+    latency = registry.histogram(
+        "http_request_duration_seconds", "Độ trễ request HTTP", ("service", "method", "route"))
+    bytes_in = registry.counter(
+        "http_request_bytes_total", "Tổng byte nhận (Content-Length)", ("service", "route"))
+    bytes_out = registry.counter(
+        "http_response_bytes_total", "Tổng byte trả về (Content-Length)", ("service", "route"))
+
+    @app.middleware("http")
+    async def metrics_middleware(request: Request, call_next):
+        if request.url.path == "/metrics":
+            return await call_next(request)
+        method = request.method
+        in_flight.inc(service=service, method=method)
+        start = time.perf_counter()
+        status, response = 500, None
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            in_flight.dec(service=service, method=method)
+            # Dùng template của route (vd. /jobs/{job_id}) để số nhãn không tăng theo id
+            route = getattr(request.scope.get("route"), "path", "unmatched")
+            requests_total.inc(service=service, method=method, route=route, status=str(status))
+            latency.observe(time.perf_counter() - start, service=service, method=method, route=route)
+            length = request.headers.get("content-length")
+            if length and length.isdigit():
+                bytes_in.inc(int(length), service=service, route=route)
+            if response is not None:
+                length = response.headers.get("content-length")
+                if length and length.isdigit():
+                    bytes_out.inc(int(length), service=service, route=route)
+
+    @app.get("/metrics", include_in_schema=False)
+    def metrics_endpoint():
+        return Response(registry.render(), media_type=CONTENT_TYPE)
+
+
+def start_http_server(port: int, host: str = "0.0.0.0") -> None:
+    """
+    Phục vụ GET /metrics ở thread nền cho tiến trình không có FastAPI (vd. worker OCR).
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
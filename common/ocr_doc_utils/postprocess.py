@@ -1,53 +1,169 @@
 import re
+from typing import Iterable, Iterator
+
+# Các biểu thức chính quy được biên dịch một lần khi nạp module
+
+# Ký tự trắng khác dấu cách và xuống dòng (tab, \r, ...) được đổi thành dấu cách
+_OTHER_SPACE = re.compile(r'[^\S \n]')
+# Chuỗi nhiều dấu cách liên tiếp được gộp thành một
+_MULTI_SPACE = re.compile(r'  +')
+
+# Sửa lỗi chung trong OCR
+_CORRECTIONS = [
+    (re.compile(r'l\s?([^\w\s])\s?l'), '1\\1'),  # l.l → 1.1
+    (re.compile(r'([0-9])\s*\.\s*([0-9])'), '\\1.\\2'),  # Fix số thập phân
+    (re.compile(r'([a-z])\s*\-\s*([a-z])'), '\\1-\\2'),  # Fix từ ghép
+]
+
+# Tiêu đề dễ nhận biết và tiêu đề Điều. Neo bằng '\n' đứng trước thay cho `^` (MULTILINE)
+# để regex tìm nhanh theo tiền tố cố định; chunk được thêm '\n' ở đầu trước khi áp dụng.
+_HEADING = re.compile(r'\n(CHÍNH PHỦ|CỘNG HÒA XÃ HỘI CHỦ NGHĨA VIỆT NAM|NGHỊ ĐỊNH)(?=\n|\Z)')
+_ARTICLE = re.compile(r'\n(Điều \d+\.)')
+
+# Ranh giới đoạn: ký tự cuối đoạn trước, ít nhất một dòng trống, ký tự đầu đoạn sau
+_PARAGRAPH_BREAK = re.compile(r'(\S)[^\S\n]*\n(?:[^\S\n]*\n)+[^\S\n]*(\S)')
+
+# Kích thước tối thiểu (ký tự) của một chunk trước khi tìm điểm cắt
+CHUNK_CHARS = 64 * 1024
+
+_DIGITS = frozenset("0123456789")
+_LOWER = frozenset("abcdefghijklmnopqrstuvwxyz")
+
+
+def _may_join(left: str, right: str) -> bool:
+    """
+    True nếu phép sửa số thập phân / từ ghép có thể nối ký tự cuối đoạn trước (`left`)
+    với ký tự đầu đoạn sau (`right`) qua dòng trống, tức không được cắt chunk ở đây.
+    Phép l.l chỉ nuốt tối đa một khoảng trắng nên không vượt được dòng trống, nhưng nó
+    có thể biến 'l' cuối đoạn thành dấu câu và 'l' đầu đoạn thành '1'.
+    """
+    lefts = (left, ".", "-") if left == "l" else (left,)
+    rights = (right, "1") if right == "l" else (right,)
+    for l in lefts:
+        for r in rights:
+            if (l in _DIGITS and r == ".") or (l == "." and r in _DIGITS):
+                return True
+            if (l in _LOWER and r == "-") or (l == "-" and r in _LOWER):
+                return True
+    return False
+
+
+def _find_cut(text: str, start: int) -> int:
+    """
+    Vị trí đầu dòng sau `start` mà các phép sửa không thể vắt qua, hoặc -1 nếu không có.
+    Cắt ở đó rồi xử lý từng phần cho kết quả giống hệt xử lý cả văn bản.
+    """
+    for match in _PARAGRAPH_BREAK.finditer(text, start):
+        if not _may_join(match.group(1), match.group(2)):
+            return text.rindex('\n', match.start(), match.start(2)) + 1
+    return -1
+
+
+def _split_chunks(text: str):
+    """Chia văn bản thành các chunk khoảng CHUNK_CHARS ký tự tại các điểm cắt an toàn."""
+    pos = 0
+    while len(text) - pos > CHUNK_CHARS:
+        cut = _find_cut(text, pos + CHUNK_CHARS)
+        if cut < 0:
+            break
+        yield text[pos:cut]
+        pos = cut
+    yield text[pos:]
+
+
+def _find_last_cut(text: str, start: int) -> int:
+    """
+    Như `_find_cut` nhưng lấy điểm cắt an toàn cuối cùng sau `start`. Chỉ quét phần đuôi
+    của văn bản, nới rộng dần khi phần đuôi không có điểm cắt nào.
+    """
+    window = 4096
+    while True:
+        lo = max(start, len(text) - window)
+        cut = -1
+        for match in _PARAGRAPH_BREAK.finditer(text, lo):
+            if not _may_join(match.group(1), match.group(2)):
+                cut = match.start(2)
+        if cut >= 0:
+            return text.rindex('\n', 0, cut) + 1
+        if lo == start:
+            return -1
+        window *= 4
+
+
+def _stream_chunks(pages: Iterable[str], separator: str):
+    """
+    Ghép các trang (nối bằng `separator`) và phát ra phần đầu tới điểm cắt an toàn cuối cùng
+    sau mỗi trang; phần còn lại (thường chỉ vài dòng cuối) được mang sang trang sau.
+    """
+    carry = ""
+    first = True
+    for page in pages:
+        text = page if first else carry + separator + page
+        first = False
+        # Các điểm cắt trong phần mang sang đã được xét ở trang trước
+        cut = _find_last_cut(text, max(len(carry.rstrip()) - 1, 0))
+        if cut < 0:
+            carry = text
+            continue
+        yield text[:cut]
+        carry = text[cut:]
+    if carry:
+        yield carry
+
+
+def _clean_chunk(chunk: str) -> str:
+    """Áp dụng toàn bộ các phép làm sạch cho một chunk gồm các dòng trọn vẹn."""
+    # Loại bỏ khoảng trắng thừa trong một dòng nhưng giữ nguyên ngắt dòng
+    chunk = _MULTI_SPACE.sub(' ', _OTHER_SPACE.sub(' ', chunk))
+    chunk = chunk.replace(' \n', '\n').replace('\n ', '\n')
+    if chunk.startswith(' '):
+        chunk = chunk[1:]
+    if chunk.endswith(' '):
+        chunk = chunk[:-1]
+
+    for pattern, replacement in _CORRECTIONS:
+        chunk = pattern.sub(replacement, chunk)
+
+    chunk = _HEADING.sub('\n\n\\1\n', '\n' + chunk)
+    return _ARTICLE.sub('\n\n\\1', chunk)[1:]
+
+
+def _strip_edges(chunks):
+    """Tương đương `"".join(chunks).strip()` nhưng phát ra từng phần."""
+    started = False
+    pending = ""
+    for chunk in chunks:
+        if not started:
+            chunk = chunk.lstrip()
+        body = chunk.rstrip()
+        if body:
+            yield pending + body
+            started = True
+            pending = chunk[len(body):]
+        elif started:
+            pending += chunk
+
 
 def correct(text: str) -> str:
     """
     Hàm hậu xử lý, làm sạch và cải thiện chất lượng văn bản OCR.
     Giữ nguyên định dạng từ văn bản gốc càng nhiều càng tốt.
+
+    Văn bản được duyệt một lần theo từng chunk (cắt ở ranh giới đoạn), mỗi chunk chỉ
+    qua các regex đã biên dịch sẵn nên thời gian chạy tuyến tính theo độ dài văn bản.
     """
     if not text:
         return ""
-        
-    # Loại bỏ khoảng trắng thừa trong một dòng nhưng giữ nguyên ngắt dòng
-    lines = text.split('\n')
-    cleaned_lines = []
-    
-    for line in lines:
-        # Loại bỏ khoảng trắng thừa trong mỗi dòng
-        cleaned_line = re.sub(r'\s+', ' ', line.strip())
-        cleaned_lines.append(cleaned_line)
-    
-    # Giữ nguyên cấu trúc đoạn văn của văn bản gốc
-    result = ""
-    current_paragraph = []
-    
-    for line in cleaned_lines:
-        if line.strip():
-            current_paragraph.append(line)
-        else:
-            if current_paragraph:
-                result += "\n".join(current_paragraph) + "\n\n"
-                current_paragraph = []
-            else:
-                result += "\n"
-    
-    if current_paragraph:
-        result += "\n".join(current_paragraph)
-    
-    # Sửa lỗi chung trong OCR
-    corrections = [
-        (r'l\s?([^\w\s])\s?l', '1\\1'),  # l.l → 1.1
-        (r'([0-9])\s*\.\s*([0-9])', '\\1.\\2'),  # Fix số thập phân
-        (r'([a-z])\s*\-\s*([a-z])', '\\1-\\2'),  # Fix từ ghép
-    ]
-    
-    for pattern, replacement in corrections:
-        result = re.sub(pattern, replacement, result)
-    
-    # Thêm định dạng cho các tiêu đề dễ nhận biết
-    result = re.sub(r'^(CHÍNH PHỦ|CỘNG HÒA XÃ HỘI CHỦ NGHĨA VIỆT NAM|NGHỊ ĐỊNH)$', r'\n\1\n', result, flags=re.MULTILINE)
-    
-    # Định dạng đặc biệt cho tiêu đề Điều, Khoản, Mục
-    result = re.sub(r'^(Điều \d+\.)', r'\n\1', result, flags=re.MULTILINE)
-    
-    return result.strip()
+    return "".join(_strip_edges(_clean_chunk(chunk) for chunk in _split_chunks(text)))
+
+
+def correct_stream(pages: Iterable[str], separator: str = "\n\n") -> Iterator[str]:
+    """
+    Hậu xử lý tăng dần: nhận các trang văn bản theo thứ tự và phát ra các đoạn đã làm sạch
+    ngay khi có thể, để có thể xử lý từng trang khi engine trả về.
+    `"".join(correct_stream(pages))` luôn bằng `correct(separator.join(pages))`.
+
+    Đoạn văn hay phép sửa vắt qua ranh giới trang được giữ lại tới trang sau, nên bộ nhớ
+    chỉ tỉ lệ với một trang (cộng phần đuôi chưa cắt được của trang trước).
+    """
+    return _strip_edges(_clean_chunk(chunk) for chunk in _stream_chunks(pages, separator))
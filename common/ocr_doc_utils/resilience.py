@@ -0,0 +1,280 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+CALL_ATTEMPTS = metrics.registry.counter(
+    "ocr_call_attempts_total", "Số lần gọi engine / OCR-service theo kết quả (ok | retry | error)",
+    ("target", "outcome"))
+CALL_HEDGES = metrics.registry.counter(
+    "ocr_call_hedges_total", "Số request dự phòng (hedge) được gửi, theo request về trước", ("target", "winner"))
+CIRCUIT_STATE = metrics.registry.gauge(
+    "ocr_circuit_state", "Trạng thái circuit breaker (0 closed, 1 half-open, 2 open)", ("target",))
+CIRCUIT_REJECTED = metrics.registry.counter(
+    "ocr_circuit_rejected_total", "Số lần gọi bị từ chối ngay do circuit breaker đang mở", ("target",))
+
+# Mã HTTP coi là lỗi tạm thời (gửi lại có thể thành công)
+TRANSIENT_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+def status_of(exc: BaseException) -> Optional[int]:
+    """Mã HTTP của lỗi: `status_code` (SDK Mistral, MockEngineError) hoặc `response.status_code` (httpx)."""
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_transient(exc: BaseException) -> bool:
+    """Lỗi có thể thử lại: 408/425/429/5xx, timeout, lỗi kết nối (kể cả httpx.TransportError)."""
+    status = status_of(exc)
+    if status is not None:
+        return status in TRANSIENT_STATUS
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    return any(cls.__name__ == "TransportError" for cls in type(exc).__mro__)
+
+
+def retry_after_of(exc: BaseException) -> Optional[float]:
+    """Số giây trong header Retry-After của response lỗi (nếu có)."""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    try:
+        return float(headers.get("retry-after")) if headers is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitOpen(Exception):
+    """Circuit breaker đang mở: không gọi engine, thử lại sau `retry_after` giây."""
+    status_code = 503
+
+    def __init__(self, target: str, retry_after: float):
+        super().__init__(f"{target} tạm thời không khả dụng (circuit open)")
+        self.target = target
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Mở sau `failure_threshold` lỗi tạm thời liên tiếp; khi mở mọi lời gọi bị từ chối ngay
+    (CircuitOpen). Sau `reset_timeout` giây cho `half_open_max` lời gọi thử: thành công thì đóng,
+    lỗi thì mở lại; lời gọi thử bị huỷ trả lại lượt thử. Dùng trong một event loop nên không cần khoá.
+    """
+
+    def __init__(self, target: str, failure_threshold: int = 5, reset_timeout: float = 30.0, half_open_max: int = 1):
+        self.target = target
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max = half_open_max
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trials = 0
+        self._trial_at = 0.0
+        CIRCUIT_STATE.set(0, target=target)
+
+    def _transition(self, state: str) -> None:
+        if state != self.state:
+            logger.warning(f"Circuit {self.target}: {self.state} -> {state}")
+            self.state = state
+            CIRCUIT_STATE.set(_STATE_VALUES[state], target=self.target)
+
+    def before_call(self) -> None:
+        """Ném CircuitOpen nếu lời gọi không được phép."""
+        if self.state == OPEN:
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                CIRCUIT_REJECTED.inc(target=self.target)
+                raise CircuitOpen(self.target, remaining)
+            self._transition(HALF_OPEN)
+            self._trials = 0
+        if self.state == HALF_OPEN:
+            # Lượt thử bị giữ quá reset_timeout (không ghi nhận được kết quả) thì cho thử lại
+            if self._trials >= self.half_open_max and time.monotonic() - self._trial_at < self.reset_timeout:
+                CIRCUIT_REJECTED.inc(target=self.target)
+                raise CircuitOpen(self.target, 1.0)
+            if self._trials >= self.half_open_max:
+                self._trials = 0
+            self._trials += 1
+            self._trial_at = time.monotonic()
+
+    def release_trial(self) -> None:
+        """Lời gọi bị huỷ (client ngắt kết nối), không biết engine còn hỏng không: trả lại lượt thử."""
+        if self.state == HALF_OPEN and self._trials > 0:
+            self._trials -= 1
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._transition(CLOSED)
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            self._transition(OPEN)
+
+
+class LatencyWindow:
+    """Độ trễ của `size` lời gọi thành công gần nhất, dùng để tính ngưỡng hedge."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+class ResilientCaller:
+    """
+    Bọc lời gọi idempotent tới engine / OCR-service:
+      - thử lại tối đa `attempts` lần với lỗi tạm thời, chờ theo exponential backoff có
+        jitter (full jitter, tối đa `max_delay`; tôn trọng Retry-After nếu nhỏ hơn `max_delay`);
+      - hedge: nếu lời gọi chưa xong sau phân vị `hedge_percentile` độ trễ gần đây thì gửi thêm
+        một request, lấy kết quả về trước và huỷ request còn lại (0 = tắt). Độ trễ được thống kê
+        riêng theo `latency_key` (vd. loại + cỡ file) để file lớn không bị hedge chỉ vì chậm hơn file nhỏ;
+      - circuit breaker (nếu có): mọi lỗi trừ 429 và lỗi 4xx của request được tính, breaker mở thì
+        từ chối ngay;
+      - `timeout` (giây, 0 = tắt): mỗi lần gọi quá hạn bị huỷ và tính là lỗi tạm thời (TimeoutError),
+        nên provider treo cũng được retry / mở breaker thay vì giữ slot mãi.
+    """
+
+    def __init__(self, target: str, attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0,
+                 hedge_percentile: float = 0.0, breaker: Optional[CircuitBreaker] = None, timeout: float = 0.0):
+        self.target = target
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_percentile = hedge_percentile
+        self.breaker = breaker
+        self.timeout = timeout
+        self._windows: Dict[str, LatencyWindow] = {}
+
+    def backoff(self, attempt: int, exc: Optional[BaseException] = None) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        retry_after = retry_after_of(exc) if exc is not None else None
+        if retry_after is not None and retry_after <= self.max_delay:
+            delay = max(delay, retry_after)
+        return delay
+
+    def window(self, key: str) -> LatencyWindow:
+        if key not in self._windows:
+            self._windows[key] = LatencyWindow()
+        return self._windows[key]
+
+    async def call(self, fn: Callable[[], Awaitable[T]], hedge: bool = True,
+                   attempts: Optional[int] = None, latency_key: str = "",
+                   retryable: Callable[[BaseException], bool] = is_transient) -> T:
+        """
+        Gọi `fn()` (hàm tạo coroutine mới mỗi lần) với retry / hedge / breaker.
+        `hedge=False` khi lời gọi có side effect ngoài kết quả trả về;
+        `retryable` chọn lỗi được thử lại (mặc định mọi lỗi tạm thời).
+        """
+        attempts = max(1, attempts or self.attempts)
+        for attempt in range(1, attempts + 1):
+            if self.breaker is not None:
+                self.breaker.before_call()
+            try:
+                result = await self._attempt(fn, hedge, self.window(latency_key))
+            except asyncio.CancelledError:
+                if self.breaker is not None:
+                    self.breaker.release_trial()
+                raise
+            except Exception as e:
+                if self.breaker is not None:
+                    status = status_of(e)
+                    if status == 429:
+                        # Quá tải tạm thời, không phải engine hỏng: không tính, trả lại lượt thử
+                        self.breaker.release_trial()
+                    elif status is not None and 400 <= status < 500 and not is_transient(e):
+                        # Engine trả lời đúng, lỗi do chính request (file / key sai)
+                        self.breaker.record_success()
+                    else:
+                        # Lỗi tạm thời, 5xx và lỗi không rõ (engine local crash, response hỏng...)
+                        self.breaker.record_failure()
+                if not retryable(e) or attempt == attempts:
+                    CALL_ATTEMPTS.inc(target=self.target, outcome="error")
+                    raise
+                CALL_ATTEMPTS.inc(target=self.target, outcome="retry")
+                delay = self.backoff(attempt, e)
+                logger.warning(f"{self.target} call failed (attempt {attempt}/{attempts}), retry in {delay:.2f}s: {e}")
+                await asyncio.sleep(delay)
+                continue
+            if self.breaker is not None:
+                self.breaker.record_success()
+            CALL_ATTEMPTS.inc(target=self.target, outcome="ok")
+            return result
+
+    async def _timed(self, fn: Callable[[], Awaitable[T]], window: LatencyWindow) -> T:
+        start = time.perf_counter()
+        result = await (asyncio.wait_for(fn(), self.timeout) if self.timeout > 0 else fn())
+        window.add(time.perf_counter() - start)
+        return result
+
+    async def _attempt(self, fn: Callable[[], Awaitable[T]], hedge: bool, window: LatencyWindow) -> T:
+        delay = window.percentile(self.hedge_percentile) if hedge and self.hedge_percentile > 0 else None
+        if delay is None:
+            return await self._timed(fn, window)
+        primary = asyncio.ensure_future(self._timed(fn, window))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+        backup = asyncio.ensure_future(self._timed(fn, window))
+        pending = {primary, backup}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        CALL_HEDGES.inc(target=self.target, winner="primary" if task is primary else "hedge")
+                        return task.result()
+                    error = error or task.exception()
+            CALL_HEDGES.inc(target=self.target, winner="none")
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+def build_caller(target: str, prefix: str, attempts: int = 3, timeout: float = 0.0) -> ResilientCaller:
+    """
+    Tạo ResilientCaller từ biến môi trường (vd. prefix OCR_ENGINE):
+      <prefix>_RETRY_ATTEMPTS      số lần gọi tối đa (mặc định `attempts`, 1 = không thử lại)
+      <prefix>_RETRY_BASE_DELAY    backoff lần đầu, giây (mặc định 0.5)
+      <prefix>_RETRY_MAX_DELAY     backoff tối đa, giây (mặc định 8)
+      <prefix>_HEDGE_PERCENTILE    gửi request dự phòng sau phân vị độ trễ này, vd. 95 (mặc định 0 = tắt)
+      <prefix>_BREAKER_FAILURES    số lỗi liên tiếp để mở breaker (mặc định 5, 0 = tắt)
+      <prefix>_BREAKER_RESET       số giây breaker mở trước khi cho gọi thử (mặc định 30)
+      <prefix>_TIMEOUT             thời gian tối đa mỗi lần gọi, giây (mặc định `timeout`, 0 = không giới hạn)
+    """
+    failures = int(os.getenv(f"{prefix}_BREAKER_FAILURES", "5"))
+    breaker = CircuitBreaker(
+        target, failure_threshold=failures, reset_timeout=float(os.getenv(f"{prefix}_BREAKER_RESET", "30"))
+    ) if failures > 0 else None
+    return ResilientCaller(
+        target,
+        attempts=int(os.getenv(f"{prefix}_RETRY_ATTEMPTS", str(attempts))),
+        base_delay=float(os.getenv(f"{prefix}_RETRY_BASE_DELAY", "0.5")),
+        max_delay=float(os.getenv(f"{prefix}_RETRY_MAX_DELAY", "8")),
+        hedge_percentile=float(os.getenv(f"{prefix}_HEDGE_PERCENTILE", "0")),
+        breaker=breaker,
+        timeout=float(os.getenv(f"{prefix}_TIMEOUT", str(timeout))),
+    )
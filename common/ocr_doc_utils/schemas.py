@@ -1,10 +1,77 @@
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Set
 from pydantic import BaseModel
 
+# Các nhóm trường có thể chọn qua tham số `fields` (vd. "text,pages,meta"):
+#   text      văn bản đã hậu xử lý        markdown  bản markdown
+#   raw       văn bản gốc ghép các trang  pages     văn bản từng trang
+#   meta      metadata (page_count, thời gian xử lý, hash, ...)
+RESPONSE_FIELDS = ("text", "markdown", "raw", "pages", "meta")
+
 class OCRResponse(BaseModel):
     """
     Cấu trúc response trả về từ OCR service, phù hợp với cách stand.py trả về kết quả.
+    Khi request chọn `fields`, chỉ các trường được chọn có mặt trong response.
+    """
+    text: Optional[str] = None  # Văn bản tinh chỉnh
+    markdown: Optional[str] = None  # Format markdown
+    raw_json: Optional[Dict[str, Any]] = None  # Dữ liệu gốc bao gồm metadata phong phú: page_count, results, processing_time_seconds, v.v.
+    images: Optional[List[Dict[str, Any]]] = None  # Ảnh trích xuất (khi include_images): page, id, path dưới /data, size_bytes
+
+def parse_fields(fields: Optional[str]) -> Set[str]:
+    """
+    Đọc tham số `fields` (danh sách cách nhau bởi dấu phẩy). Không truyền = đầy đủ như trước.
+    Ném ValueError nếu có nhóm trường không hợp lệ.
+    """
+    if not fields:
+        return set(RESPONSE_FIELDS)
+    requested = {name.strip().lower() for name in fields.split(",") if name.strip()}
+    unknown = requested - set(RESPONSE_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}. Allowed: {', '.join(RESPONSE_FIELDS)}")
+    return requested
+
+def build_response(fields: Set[str], text: Optional[str] = None, markdown: Optional[str] = None,
+                   raw_json: Optional[Dict[str, Any]] = None,
+                   images: Optional[List[Dict[str, Any]]] = None) -> OCRResponse:
+    """
+    Tạo OCRResponse chỉ chứa các nhóm trường trong `fields`. Với profile đầy đủ raw_json được giữ
+    nguyên; với profile rút gọn, raw_json chỉ giữ "text" (raw), "results" (pages) và metadata (meta),
+    bản "clean" trùng với `text` bị bỏ. `images` chỉ có mặt khi được truyền (request bật include_images).
+    Dùng kèm `response_model_exclude_unset=True`.
+    """
+    values = {} if images is None else {"images": images}
+    if fields >= set(RESPONSE_FIELDS):
+        return OCRResponse(text=text, markdown=markdown, raw_json=raw_json, **values)
+    
+    if "text" in fields:
+        values["text"] = text
+    if "markdown" in fields:
+        values["markdown"] = markdown
+    if raw_json is not None and fields & {"raw", "pages", "meta"}:
+        selected = {}
+        for key, value in raw_json.items():
+            if key == "text":
+                wanted = "raw" in fields
+            elif key == "results":
+                wanted = "pages" in fields
+            elif key == "clean":
+                wanted = False
+            else:
+                wanted = "meta" in fields
+            if wanted:
+                selected[key] = value
+        values["raw_json"] = selected
+    return OCRResponse(**values)
+
+class JobStatus(BaseModel):
+    """
+    Trạng thái job OCR bất đồng bộ (queued | running | done | failed).
     """
-    text: str  # Văn bản tinh chỉnh
-    markdown: str  # Format markdown
-    raw_json: Dict[str, Any]  # Dữ liệu gốc bao gồm metadata phong phú: page_count, results, processing_time_seconds, v.v.
+    job_id: str
+    status: str
+    progress: float  # 0.0 → 1.0
+    filename: Optional[str] = None
+    source_type: str  # upload | url
+    error: Optional[str] = None
+    created_at: str
+    updated_at: str
@@ -0,0 +1,267 @@
+import os
+import re
+import time
+import uuid
+import shutil
+import sqlite3
+import logging
+import datetime
+import threading
+from typing import Any, BinaryIO, Dict, List, Optional, Union
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# Hash nội dung (MD5 hex) dùng làm tên blob
+BLOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+class SessionStore:
+    """
+    Lưu các phiên OCR trên đĩa: metadata trong SQLite, file gốc và kết quả là blob
+    đánh địa chỉ theo hash nội dung dưới `directory/blobs` (file trùng chỉ lưu một lần).
+    API ghi kết quả vào phiên, FE chỉ đọc metadata và nạp blob khi cần hiển thị.
+    Phiên cũ bị loại theo tuổi (`max_age` giây kể từ lần truy cập cuối) và theo LRU
+    khi vượt `max_sessions`.
+    """
+
+    def __init__(self, directory: str = "/data/sessions", max_sessions: int = 500,
+                 max_age: Optional[float] = 30 * 24 * 3600, evict_interval: float = 300):
+        self.directory = directory
+        self.blob_dir = os.path.join(directory, "blobs")
+        self.max_sessions = max_sessions
+        self.max_age = max_age
+        self.evict_interval = evict_interval
+        self._last_evict = 0.0
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        # FE và API (khác container) cùng mở DB trên volume /data
+        self._db = sqlite3.connect(os.path.join(directory, "sessions.db"), timeout=30, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                owner TEXT,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS sessions_owner ON sessions (owner, created_at);
+            CREATE TABLE IF NOT EXISTS items (
+                session_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                content_type TEXT,
+                url TEXT,
+                file_hash TEXT,
+                file_size INTEGER,
+                result_hash TEXT,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (session_id, idx)
+            );
+            """
+        )
+        self._db.commit()
+
+    # ---------- blobs ----------
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def put_blob(self, data: Union[bytes, BinaryIO]) -> str:
+        """Ghi blob (bytes hoặc file object seek được) nếu chưa có, trả về hash nội dung."""
+        if isinstance(data, (bytes, bytearray)):
+            digest = utils.compute_file_hash(data)
+        else:
+            data.seek(0)
+            digest, _ = utils.hash_stream(data)
+        path = self.blob_path(digest)
+        if os.path.exists(path):
+            os.utime(path)  # blob đang được dùng lại, không để GC xoá nhầm
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            if isinstance(data, (bytes, bytearray)):
+                f.write(data)
+            else:
+                shutil.copyfileobj(data, f, utils.CHUNK_SIZE)
+                data.seek(0)
+        os.replace(tmp_path, path)
+        return digest
+
+    def read_blob(self, digest: str) -> Optional[bytes]:
+        try:
+            with open(self.blob_path(digest), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    # ---------- sessions ----------
+
+    def create_session(self, owner: Optional[str] = None) -> str:
+        session_id = f"sess_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO sessions (id, owner, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (session_id, owner, now, now),
+            )
+            self._db.commit()
+        self.maybe_evict()
+        return session_id
+
+    def list_sessions(self, owner: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """Các phiên mới nhất trước, chỉ metadata (không nạp kết quả)."""
+        query = (
+            "SELECT s.id, s.created_at, COUNT(i.idx) AS item_count FROM sessions s "
+            "LEFT JOIN items i ON i.session_id = s.id "
+        )
+        params: tuple = ()
+        if owner is not None:
+            query += "WHERE s.owner = ? "
+            params = (owner,)
+        query += "GROUP BY s.id ORDER BY s.created_at DESC LIMIT ?"
+        with self._lock:
+            rows = self._db.execute(query, (*params, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def touch(self, session_id: str) -> None:
+        with self._lock:
+            self._db.execute("UPDATE sessions SET accessed_at = ? WHERE id = ?", (time.time(), session_id))
+            self._db.commit()
+
+    def delete_session(self, session_id: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM items WHERE session_id = ?", (session_id,))
+            self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            self._db.commit()
+
+    # ---------- items ----------
+
+    def add_item(self, session_id: str, name: str, result: str, content_type: Optional[str] = None,
+                 source: Union[bytes, BinaryIO, None] = None, url: Optional[str] = None) -> int:
+        """
+        Thêm một kết quả OCR vào phiên (tạo phiên nếu chưa có). File gốc `source` được lưu
+        làm blob để xem lại; nguồn URL chỉ lưu URL nếu không truyền `source`.
+        Trả về chỉ số của mục trong phiên.
+        """
+        file_hash = file_size = None
+        if source is not None:
+            file_size = len(source) if isinstance(source, (bytes, bytearray)) else utils.stream_size(source)
+            file_hash = self.put_blob(source)
+        result_hash = self.put_blob(result.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            # Khoá ghi ngay từ đầu: nhiều worker API có thể cùng thêm mục vào một phiên
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute(
+                    "INSERT OR IGNORE INTO sessions (id, owner, created_at, accessed_at) VALUES (?, NULL, ?, ?)",
+                    (session_id, now, now),
+                )
+                idx = self._db.execute(
+                    "SELECT COALESCE(MAX(idx) + 1, 0) FROM items WHERE session_id = ?", (session_id,)
+                ).fetchone()[0]
+                self._db.execute(
+                    "INSERT INTO items (session_id, idx, name, content_type, url, file_hash, file_size, result_hash, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (session_id, idx, name, content_type, url, file_hash, file_size, result_hash, now),
+                )
+                self._db.execute("UPDATE sessions SET accessed_at = ? WHERE id = ?", (now, session_id))
+                self._db.execute("COMMIT")
+            except BaseException:
+                # Không để transaction treo (giữ khoá ghi) sau lỗi giữa chừng
+                self._db.execute("ROLLBACK")
+                raise
+        self.maybe_evict()
+        return idx
+
+    def items(self, session_id: str) -> List[Dict[str, Any]]:
+        """Metadata các mục trong phiên theo thứ tự hoàn thành."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM items WHERE session_id = ? ORDER BY idx", (session_id,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_item(self, session_id: str, idx: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM items WHERE session_id = ? AND idx = ?", (session_id, idx)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def read_result(self, item: Dict[str, Any]) -> str:
+        data = self.read_blob(item["result_hash"]) if item.get("result_hash") else None
+        return data.decode("utf-8") if data is not None else ""
+
+    def source_path(self, item: Dict[str, Any]) -> Optional[str]:
+        """Đường dẫn blob file gốc của mục (None với nguồn URL không lưu file)."""
+        if not item.get("file_hash"):
+            return None
+        path = self.blob_path(item["file_hash"])
+        return path if os.path.exists(path) else None
+
+    # ---------- eviction ----------
+
+    def maybe_evict(self) -> None:
+        """Chạy `evict` nếu lần dọn gần nhất đã quá `evict_interval` giây."""
+        if time.time() - self._last_evict >= self.evict_interval:
+            self.evict()
+
+    def evict(self) -> int:
+        """Xoá phiên quá hạn / vượt số lượng và các blob không còn được tham chiếu."""
+        self._last_evict = time.time()
+        with self._lock:
+            expired = []
+            if self.max_age:
+                expired = [row["id"] for row in self._db.execute(
+                    "SELECT id FROM sessions WHERE accessed_at < ?", (time.time() - self.max_age,)
+                )]
+            overflow = [row["id"] for row in self._db.execute(
+                "SELECT id FROM sessions ORDER BY accessed_at DESC LIMIT -1 OFFSET ?", (self.max_sessions,)
+            )]
+            doomed = set(expired) | set(overflow)
+            for session_id in doomed:
+                self._db.execute("DELETE FROM items WHERE session_id = ?", (session_id,))
+                self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            self._db.commit()
+            referenced = set()
+            for row in self._db.execute("SELECT file_hash, result_hash FROM items"):
+                referenced.update(h for h in row if h)
+        if doomed:
+            logger.info(f"Evicted {len(doomed)} OCR sessions")
+        self._collect_blobs(referenced)
+        return len(doomed)
+
+    def _collect_blobs(self, referenced: set, grace: float = 3600) -> None:
+        # Blob mới ghi có thể chưa kịp được tham chiếu trong DB: bỏ qua các file trẻ hơn `grace`
+        cutoff = time.time() - grace
+        for root, _, files in os.walk(self.blob_dir):
+            for name in files:
+                if name in referenced or name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    if os.stat(path).st_mtime < cutoff:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+def build_session_store(prefix: str = "OCR_SESSION") -> SessionStore:
+    """
+    Khởi tạo SessionStore từ biến môi trường:
+      OCR_SESSION_DIR           thư mục lưu (mặc định /data/sessions)
+      OCR_SESSION_MAX_COUNT     số phiên tối đa giữ lại (LRU)
+      OCR_SESSION_MAX_AGE_DAYS  số ngày không truy cập trước khi bị xoá (0 = không giới hạn)
+    """
+    max_age_days = float(os.getenv(f"{prefix}_MAX_AGE_DAYS", "30"))
+    return SessionStore(
+        directory=os.getenv(f"{prefix}_DIR", "/data/sessions"),
+        max_sessions=int(os.getenv(f"{prefix}_MAX_COUNT", "500")),
+        max_age=max_age_days * 24 * 3600 if max_age_days else None,
+    )
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import fcntl
+import asyncio
+import hashlib
+import contextlib
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+COALESCED = metrics.registry.counter(
+    "ocr_coalesced_total", "Số request dùng chung kết quả của request OCR đang chạy cho cùng nội dung",
+    ("scope",))
+IN_FLIGHT_KEYS = metrics.registry.gauge(
+    "ocr_singleflight_keys", "Số nội dung đang được OCR (mỗi nội dung chỉ một lời gọi engine)")
+
+
+class LeaderGone(Exception):
+    """Request đang OCR bị huỷ (client ngắt kết nối) hoặc lỗi: request chờ tự chạy lại."""
+
+
+class SingleFlight:
+    """
+    Gộp các request OCR đồng thời cho cùng nội dung (khoá theo hash file + model) thành
+    một lời gọi engine:
+      - trong tiến trình: request đến sau chờ Future của request đang chạy;
+      - giữa các worker uvicorn: request dẫn đầu của mỗi worker giữ file lock (flock) dưới
+        `directory`, worker đến sau chờ lock rồi đọc kết quả được ghi cạnh lock.
+    Kết quả ghi ra đĩa (dict JSON được) chỉ được dùng lại trong `result_ttl` giây;
+    `directory=None` chỉ gộp trong tiến trình.
+    """
+
+    def __init__(self, directory: Optional[str] = "/data/inflight", result_ttl: float = 60.0,
+                 lock_timeout: float = 900.0, poll_interval: float = 0.1):
+        self.directory = directory
+        self.result_ttl = result_ttl
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self._flights: Dict[str, asyncio.Future] = {}
+        self._last_prune = 0.0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Dict[str, Any]]]) -> Tuple[Dict[str, Any], bool]:
+        """
+        Chạy `fn()` một lần cho mỗi `key` đang bay. Trả về (kết quả, True nếu dùng chung
+        kết quả của request khác). Lỗi của request dẫn đầu (API key riêng sai, 429, lỗi tạm thời...)
+        chỉ trả cho chính nó: request chờ tự chạy lại `fn` với tham số của mình.
+        """
+        while True:
+            flight = self._flights.get(key)
+            if flight is None:
+                break
+            try:
+                result = await asyncio.shield(flight)
+            except LeaderGone:
+                continue
+            COALESCED.inc(scope="process")
+            return result, True
+
+        flight = asyncio.get_running_loop().create_future()
+        self._flights[key] = flight
+        IN_FLIGHT_KEYS.set(len(self._flights))
+        try:
+            result, shared = await self._run_locked(key, fn)
+        except BaseException:
+            flight.set_exception(LeaderGone())
+            # Đánh dấu đã đọc: không có request chờ thì asyncio không cảnh báo "never retrieved"
+            flight.exception()
+            raise
+        else:
+            flight.set_result(result)
+            return result, shared
+        finally:
+            del self._flights[key]
+            IN_FLIGHT_KEYS.set(len(self._flights))
+
+    def _path(self, key: str) -> str:
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    async def _run_locked(self, key: str, fn) -> Tuple[Dict[str, Any], bool]:
+        if self.directory is None:
+            return await fn(), False
+        base = self._path(key)
+        fd = await self._acquire(base + ".lock")
+        try:
+            published = self._read(base + ".json")
+            if published is not None:
+                COALESCED.inc(scope="worker")
+                return published, True
+            result = await fn()
+            self._write(base + ".json", result)
+            return result, False
+        finally:
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+            self._maybe_prune()
+
+    async def _acquire(self, path: str) -> Optional[int]:
+        """
+        Lấy flock trên `path` mà không chặn event loop (thử lại định kỳ). Quá `lock_timeout`
+        hoặc lỗi đĩa thì chạy không có lock (trùng công việc nhưng không treo request).
+        """
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as e:
+            logger.warning(f"Single-flight lock unavailable ({path}): {e}")
+            return None
+        deadline = time.monotonic() + self.lock_timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.utime(path)
+                return fd
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    logger.warning(f"Single-flight lock timeout ({path}), running without lock")
+                    os.close(fd)
+                    return None
+                await asyncio.sleep(self.poll_interval)
+            except BaseException:
+                os.close(fd)
+                raise
+
+    def _read(self, path: str) -> Optional[Dict[str, Any]]:
+        try:
+            if time.time() - os.path.getmtime(path) > self.result_ttl:
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, path: str, result: Dict[str, Any]) -> None:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(result, f, ensure_ascii=False)
+            os.replace(tmp, path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Cannot publish single-flight result ({path}): {e}")
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+
+    def _maybe_prune(self) -> None:
+        """Xoá kết quả hết hạn và lock không ai dùng, tối đa mỗi `result_ttl` giây một lần."""
+        now = time.time()
+        if now - self._last_prune < self.result_ttl:
+            return
+        self._last_prune = now
+        try:
+            shards = os.listdir(self.directory)
+        except OSError:
+            return
+        for shard in shards:
+            shard_dir = os.path.join(self.directory, shard)
+            try:
+                names = os.listdir(shard_dir)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(shard_dir, name)
+                # Lock được touch khi lấy: quá lock_timeout thì không còn request nào giữ
+                max_age = self.lock_timeout + self.result_ttl if name.endswith(".lock") else self.result_ttl
+                try:
+                    if now - os.path.getmtime(path) > max_age:
+                        os.remove(path)
+                except OSError:
+                    pass
@@ -0,0 +1,386 @@
+import os
+import re
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import asyncio
+import logging
+import contextlib
+from typing import Dict, Iterator, Optional, Tuple
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+STORAGE_BYTES = metrics.registry.gauge(
+    "ocr_storage_bytes", "Dung lượng đĩa của file upload (blobs) và thư mục phiên (sessions)", ("area",))
+STORAGE_OBJECTS = metrics.registry.gauge(
+    "ocr_storage_objects", "Số blob / thư mục phiên trên đĩa", ("area",))
+STORAGE_QUOTA = metrics.registry.gauge(
+    "ocr_storage_quota_bytes", "Quota dung lượng lưu trữ upload (0 = không giới hạn)")
+STORAGE_UPLOADS = metrics.registry.counter(
+    "ocr_storage_uploads_total", "Số file upload theo kết quả lưu (new | dedup: nội dung đã có)", ("outcome",))
+STORAGE_REMOVED = metrics.registry.counter(
+    "ocr_storage_removed_total", "Số blob / thư mục phiên bị janitor xoá theo lý do (ttl | quota)", ("area", "reason"))
+STORAGE_REMOVED_BYTES = metrics.registry.counter(
+    "ocr_storage_removed_bytes_total", "Số byte janitor đã giải phóng theo lý do (ttl | quota)", ("area", "reason"))
+JANITOR_SECONDS = metrics.registry.histogram(
+    "ocr_storage_janitor_seconds", "Thời gian một lượt dọn dẹp của janitor")
+
+# Thư mục phiên kiểu cũ: /data/<uuid> (utils.new_session_dir)
+_LEGACY_NAME = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+
+class QuotaExceeded(Exception):
+    """Dung lượng lưu trữ vượt quota kể cả sau khi dọn: từ chối upload mới."""
+    status_code = 507
+
+    def __init__(self, used: int, quota: int):
+        super().__init__(f"Bộ nhớ lưu trữ đã đầy ({used} / {quota} byte). Vui lòng thử lại sau.")
+        self.used = used
+        self.quota = quota
+
+
+def _tree_size(path: str) -> int:
+    """Tổng dung lượng file trong thư mục (file hard link tới blob không được tính lại)."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            if st.st_nlink == 1:
+                total += st.st_size
+    return total
+
+
+class SessionStorage:
+    """
+    Lưu file upload và thư mục phiên của OCR-service dưới `directory`:
+      blobs/<h[:2]>/<h[2:4]>/<hash>       nội dung upload, địa chỉ theo hash: upload trùng chỉ lưu một lần
+      sessions/<YYYYMMDD>/<HH>/<uuid>/    thư mục làm việc của mỗi request (file upload là hard link tới
+                                          blob, trang render, ảnh trích xuất)
+      tmp/                                file đang ghi, chưa biết hash
+    Janitor xoá phiên quá `session_ttl` giây và blob không phiên nào dùng quá `blob_ttl` giây
+    (tính từ lần upload gần nhất); vượt `max_bytes` thì xoá phiên rồi blob cũ nhất tới 90% quota.
+    Phiên trẻ hơn `min_age` giây (request / task có thể vẫn đang OCR) không bao giờ bị xoá.
+    Nhiều tiến trình dùng chung thư mục: mỗi lượt dọn giữ file lock, kết quả đo ghi vào usage.json.
+    """
+
+    def __init__(self, directory: str = "/data/uploads", session_ttl: float = 24 * 3600,
+                 blob_ttl: float = 24 * 3600, max_bytes: int = 0, legacy_dir: Optional[str] = None,
+                 min_age: float = 900):
+        self.directory = directory
+        self.min_age = min_age
+        self.session_ttl = max(session_ttl, min_age)
+        self.blob_ttl = blob_ttl
+        self.max_bytes = max_bytes
+        self.legacy_dir = legacy_dir
+        self.blob_dir = os.path.join(directory, "blobs")
+        self.session_dir = os.path.join(directory, "sessions")
+        self.tmp_dir = os.path.join(directory, "tmp")
+        for path in (self.blob_dir, self.session_dir, self.tmp_dir):
+            os.makedirs(path, exist_ok=True)
+        self._usage_path = os.path.join(directory, "usage.json")
+        self._usage = {"blobs": 0, "sessions": 0, "blob_count": 0, "session_count": 0, "swept_at": 0.0}
+        self._added = 0  # byte blob mới ghi từ lần đo gần nhất
+        self._dedup = 0
+        STORAGE_QUOTA.set(max_bytes)
+
+    # -- Ghi upload --
+
+    def new_session(self) -> str:
+        """Tạo thư mục phiên mới, chia theo ngày / giờ để mỗi thư mục không có quá nhiều mục."""
+        now = time.gmtime()
+        path = os.path.join(self.session_dir, time.strftime("%Y%m%d", now), time.strftime("%H", now),
+                            uuid.uuid4().hex)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def temp_path(self) -> str:
+        """Đường dẫn tạm để ghi upload trước khi biết hash (cùng filesystem với blobs)."""
+        return os.path.join(self.tmp_dir, f"{uuid.uuid4().hex}.part")
+
+    def blob_path(self, file_hash: str) -> str:
+        return os.path.join(self.blob_dir, file_hash[:2], file_hash[2:4], file_hash)
+
+    def ingest(self, tmp_path: str, file_hash: str, session_dir: str, filename: str) -> str:
+        """
+        Chuyển file tạm vào blob theo hash (bỏ file tạm nếu nội dung đã có) rồi tạo hard link
+        `filename` trong thư mục phiên. Trả về đường dẫn file trong phiên.
+        Blob được tạo bằng os.link (nguyên tử, lỗi nếu đã có) nên hai upload đồng thời cùng nội dung
+        vẫn trỏ tới cùng một inode.
+        """
+        blob = self.blob_path(file_hash)
+        path = os.path.join(session_dir, os.path.basename(filename) or "unnamed_file")
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        for _ in range(3):
+            try:
+                os.link(tmp_path, blob)
+            except FileExistsError:
+                try:
+                    self._link(blob, path)
+                except FileNotFoundError:
+                    continue  # janitor vừa xoá blob: tạo lại từ file tạm
+                os.remove(tmp_path)
+                os.utime(blob)  # TTL của blob tính từ lần upload gần nhất
+                self._dedup += 1
+                STORAGE_UPLOADS.inc(outcome="dedup")
+                return path
+            except OSError:
+                break  # filesystem không hỗ trợ hard link
+            else:
+                # Gắn vào phiên trước khi bỏ tên tạm: blob không lúc nào có link count 1 (janitor bỏ qua)
+                self._link(blob, path)
+                os.remove(tmp_path)
+                self._added += os.path.getsize(blob)
+                STORAGE_UPLOADS.inc(outcome="new")
+                return path
+        # Không dùng được hard link: chuyển file tạm vào phiên, không dedup
+        os.replace(tmp_path, path)
+        STORAGE_UPLOADS.inc(outcome="new")
+        return path
+
+    @staticmethod
+    def _link(blob: str, path: str) -> None:
+        try:
+            os.link(blob, path)
+        except FileExistsError:
+            pass
+        except FileNotFoundError:
+            raise
+        except OSError:
+            # Filesystem không hỗ trợ hard link: chép (phiên này không được dedup nhưng vẫn chạy)
+            shutil.copyfile(blob, path)
+
+    def discard(self, path: str) -> None:
+        with contextlib.suppress(OSError):
+            os.remove(path)
+
+    # -- Quota --
+
+    def usage(self) -> int:
+        """Dung lượng ước tính: lần đo gần nhất (của bất kỳ tiến trình nào) + blob mới ghi từ đó."""
+        try:
+            with open(self._usage_path, "r", encoding="utf-8") as f:
+                shared = json.load(f)
+            if shared.get("swept_at", 0) > self._usage["swept_at"]:
+                self._usage = shared
+                self._added = 0
+        except (OSError, ValueError):
+            pass
+        return self._usage["blobs"] + self._usage["sessions"] + self._added
+
+    def check_quota(self) -> None:
+        """Ném QuotaExceeded nếu vượt quota; trước đó thử dọn ngay một lượt."""
+        if not self.max_bytes or self.usage() < self.max_bytes:
+            return
+        self.sweep()
+        used = self.usage()
+        if used >= self.max_bytes:
+            raise QuotaExceeded(used, self.max_bytes)
+
+    # -- Janitor --
+
+    def _sessions(self) -> Iterator[Tuple[str, int, float]]:
+        """(đường dẫn, byte, mtime) của mọi thư mục phiên, kể cả thư mục kiểu cũ dưới `legacy_dir`."""
+        for day in sorted(os.listdir(self.session_dir)):
+            day_dir = os.path.join(self.session_dir, day)
+            for hour in sorted(os.listdir(day_dir)) if os.path.isdir(day_dir) else ():
+                hour_dir = os.path.join(day_dir, hour)
+                for name in os.listdir(hour_dir) if os.path.isdir(hour_dir) else ():
+                    yield self._entry(os.path.join(hour_dir, name))
+        if self.legacy_dir and os.path.isdir(self.legacy_dir):
+            for name in os.listdir(self.legacy_dir):
+                path = os.path.join(self.legacy_dir, name)
+                if _LEGACY_NAME.match(name) and os.path.isdir(path):
+                    yield self._entry(path)
+
+    @staticmethod
+    def _entry(path: str) -> Tuple[str, int, float]:
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            mtime = 0.0
+        return path, _tree_size(path), mtime
+
+    def _prune_empty_dirs(self) -> None:
+        """Xoá thư mục ngày / giờ đã trống (trừ ngày hiện tại, nơi phiên mới đang được tạo)."""
+        today = time.strftime("%Y%m%d", time.gmtime())
+        for day in os.listdir(self.session_dir):
+            if day == today:
+                continue
+            day_dir = os.path.join(self.session_dir, day)
+            for hour in os.listdir(day_dir) if os.path.isdir(day_dir) else ():
+                with contextlib.suppress(OSError):
+                    os.rmdir(os.path.join(day_dir, hour))
+            with contextlib.suppress(OSError):
+                os.rmdir(day_dir)
+
+    def _blobs(self) -> Iterator[Tuple[str, int, float, int]]:
+        """(đường dẫn, byte, mtime, số hard link) của mọi blob."""
+        for root, _, files in os.walk(self.blob_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, st.st_size, st.st_mtime, st.st_nlink
+
+    def _remove(self, area: str, path: str, size: int, reason: str) -> bool:
+        try:
+            if area == "sessions":
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            logger.warning(f"Cannot remove {path}: {e}")
+            return False
+        STORAGE_REMOVED.inc(area=area, reason=reason)
+        STORAGE_REMOVED_BYTES.inc(size, area=area, reason=reason)
+        return True
+
+    def sweep(self) -> Optional[Dict[str, int]]:
+        """
+        Một lượt dọn: TTL rồi quota. Trả về số mục / byte đã xoá, hoặc None nếu tiến trình
+        khác đang dọn.
+        """
+        fd = os.open(os.path.join(self.directory, "janitor.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            return self._sweep()
+        finally:
+            os.close(fd)
+
+    def _sweep(self) -> Dict[str, int]:
+        start = time.perf_counter()
+        now = time.time()
+        removed = {"sessions": 0, "blobs": 0, "bytes": 0}
+
+        def drop(area, path, size, reason):
+            if self._remove(area, path, size, reason):
+                removed[area] += 1
+                removed["bytes"] += size
+                return True
+            return False
+
+        # 1) TTL: phiên cũ, file tạm bỏ dở, rồi blob không còn phiên nào trỏ tới
+        sessions = []
+        for path, size, mtime in self._sessions():
+            if now - mtime > self.session_ttl:
+                drop("sessions", path, size, "ttl")
+            else:
+                sessions.append((path, size, mtime))
+        self._prune_empty_dirs()
+        for name in os.listdir(self.tmp_dir):
+            path = os.path.join(self.tmp_dir, name)
+            with contextlib.suppress(OSError):
+                if now - os.path.getmtime(path) > self.session_ttl:
+                    os.remove(path)
+        blobs = []
+        for path, size, mtime, links in self._blobs():
+            if links == 1 and now - mtime > self.blob_ttl:
+                drop("blobs", path, size, "ttl")
+            else:
+                blobs.append((path, size, mtime, links))
+
+        # 2) Quota: xoá phiên cũ nhất, rồi blob cũ nhất đã không còn phiên trỏ tới, tới 90% quota
+        total = sum(e[1] for e in sessions) + sum(e[1] for e in blobs)
+        if self.max_bytes and total > self.max_bytes:
+            target = int(self.max_bytes * 0.9)
+            sessions.sort(key=lambda e: e[2])
+            kept = []
+            for entry in sessions:
+                path, size, mtime = entry
+                if total > target and now - mtime > self.min_age and drop("sessions", path, size, "quota"):
+                    total -= size
+                else:
+                    kept.append(entry)
+            sessions = kept
+            if total > target:
+                blobs = [(path, size, mtime, os.stat(path).st_nlink) for path, size, mtime, _ in blobs
+                         if os.path.exists(path)]
+                blobs.sort(key=lambda e: e[2])
+                kept = []
+                for entry in blobs:
+                    path, size, _, links = entry
+                    if total > target and links == 1 and drop("blobs", path, size, "quota"):
+                        total -= size
+                    else:
+                        kept.append(entry)
+                blobs = kept
+
+        self._record_usage(sessions, blobs)
+        JANITOR_SECONDS.observe(time.perf_counter() - start)
+        if removed["sessions"] or removed["blobs"]:
+            logger.info(f"Storage janitor removed {removed['sessions']} session(s), {removed['blobs']} blob(s), "
+                        f"{removed['bytes']} bytes in {time.perf_counter() - start:.2f}s")
+        return removed
+
+    def _record_usage(self, sessions, blobs) -> None:
+        self._usage = {
+            "blobs": sum(e[1] for e in blobs), "sessions": sum(e[1] for e in sessions),
+            "blob_count": len(blobs), "session_count": len(sessions), "swept_at": time.time(),
+        }
+        self._added = 0
+        STORAGE_BYTES.set(self._usage["blobs"], area="blobs")
+        STORAGE_BYTES.set(self._usage["sessions"], area="sessions")
+        STORAGE_OBJECTS.set(len(blobs), area="blobs")
+        STORAGE_OBJECTS.set(len(sessions), area="sessions")
+        tmp = f"{self._usage_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._usage, f)
+            os.replace(tmp, self._usage_path)
+        except OSError as e:
+            logger.warning(f"Cannot write storage usage ({self._usage_path}): {e}")
+
+    async def run_janitor(self, interval: float = 300.0) -> None:
+        """Dọn định kỳ ngoài event loop; chạy tới khi task bị huỷ."""
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                logger.error(f"Storage janitor failed: {e}")
+            await asyncio.sleep(interval)
+
+    def stats(self) -> Dict:
+        used = self.usage()
+        return {
+            "directory": self.directory,
+            "bytes": used,
+            "quota_bytes": self.max_bytes,
+            "blobs": self._usage["blob_count"],
+            "sessions": self._usage["session_count"],
+            "dedup_uploads": self._dedup,
+            "swept_at": self._usage["swept_at"],
+        }
+
+
+def build_storage(prefix: str = "OCR_STORAGE", min_age: float = 900) -> SessionStorage:
+    """
+    Tạo SessionStorage từ biến môi trường (vd. prefix OCR_STORAGE):
+      OCR_STORAGE_DIR           thư mục lưu (mặc định /data/uploads)
+      OCR_STORAGE_SESSION_TTL   số giây giữ thư mục phiên (mặc định 86400)
+      OCR_STORAGE_BLOB_TTL      số giây giữ blob không phiên nào dùng, tính từ lần upload gần nhất (mặc định 86400)
+      OCR_STORAGE_MAX_BYTES     quota dung lượng (mặc định 10 GiB, 0 = không giới hạn)
+      OCR_STORAGE_LEGACY_DIR    nơi có thư mục phiên kiểu cũ /data/<uuid> cần dọn (mặc định /data, none = bỏ qua)
+    `min_age`: thời gian tối đa một request / task dùng thư mục phiên (vd. OCR_WORKER_TIMEOUT).
+    """
+    legacy = os.getenv(f"{prefix}_LEGACY_DIR", "/data")
+    return SessionStorage(
+        directory=os.getenv(f"{prefix}_DIR", "/data/uploads"),
+        session_ttl=float(os.getenv(f"{prefix}_SESSION_TTL", str(24 * 3600))),
+        blob_ttl=float(os.getenv(f"{prefix}_BLOB_TTL", str(24 * 3600))),
+        max_bytes=int(os.getenv(f"{prefix}_MAX_BYTES", str(10 * 1024 ** 3))),
+        legacy_dir=None if legacy.lower() == "none" else legacy,
+        min_age=min_age,
+    )
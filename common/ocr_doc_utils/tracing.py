@@ -0,0 +1,323 @@
+import os
+import json
+import time
+import queue
+import random
+import logging
+import threading
+import contextlib
+import contextvars
+import urllib.request
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Header chuẩn W3C Trace Context: "00-<trace_id 32 hex>-<span_id 16 hex>-<flags 2 hex>"
+TRACEPARENT = "traceparent"
+
+
+class Span:
+    """Một đoạn công việc có thời gian bắt đầu / kết thúc trong một trace."""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "service", "kind", "sampled",
+                 "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name: str, service: str, trace_id: str, parent_id: Optional[str],
+                 sampled: bool, kind: str = "internal"):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.service = service
+        self.kind = kind
+        self.sampled = sampled
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes: Dict[str, Any] = {}
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "service": self.service,
+            "kind": self.kind,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3) if self.end_ns else None,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+def parse_traceparent(header: Optional[str]):
+    """(trace_id, parent span_id, sampled) từ header traceparent, hoặc None nếu không hợp lệ."""
+    if not header:
+        return None
+    parts = header.strip().lower().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or len(parts[3]) != 2:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+# ---------- exporters ----------
+
+class SpanExporter:
+    """Xuất span ở thread nền theo lô, không chặn request; lỗi xuất chỉ được log."""
+
+    def __init__(self, batch_size: int = 128, interval: float = 2.0, max_queue: int = 10000):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue: "queue.Queue[Span]" = queue.Queue(max_queue)
+        self._dropped = 0
+        self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+        self._thread.start()
+
+    def submit(self, span: Span) -> None:
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self._dropped += 1
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self.export(batch)
+            except Exception as e:
+                logger.warning(f"Trace export failed ({len(batch)} spans): {e}")
+
+    def export(self, spans: List[Span]) -> None:
+        raise NotImplementedError
+
+
+class JsonFileExporter(SpanExporter):
+    """Ghi mỗi span một dòng JSON (JSON Lines) vào `path`, vd. /data/traces/api.jsonl."""
+
+    def __init__(self, path: str, **kwargs):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        super().__init__(**kwargs)
+
+    def export(self, spans: List[Span]) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), ensure_ascii=False) + "\n")
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+_OTLP_KINDS = {"internal": 1, "server": 2, "client": 3}
+
+
+class OTLPExporter(SpanExporter):
+    """Gửi span tới OpenTelemetry collector qua OTLP/HTTP (JSON) tại `<endpoint>/v1/traces`."""
+
+    def __init__(self, endpoint: str, timeout: float = 5.0, **kwargs):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def export(self, spans: List[Span]) -> None:
+        by_service: Dict[str, list] = {}
+        for span in spans:
+            by_service.setdefault(span.service, []).append({
+                "traceId": span.trace_id,
+                "spanId": span.span_id,
+                "parentSpanId": span.parent_id or "",
+                "name": span.name,
+                "kind": _OTLP_KINDS.get(span.kind, 1),
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.end_ns or span.start_ns),
+                "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span.attributes.items()],
+                "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+            })
+        body = {"resourceSpans": [
+            {
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service}}]},
+                "scopeSpans": [{"scope": {"name": "ocr_doc_utils.tracing"}, "spans": otlp_spans}],
+            }
+            for service, otlp_spans in by_service.items()
+        ]}
+        request = urllib.request.Request(
+            self.url, data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json"}, method="POST"
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+# ---------- tracer ----------
+
+class Tracer:
+    """
+    Tạo span cho một service, nối vào trace của request đến (header traceparent) và
+    truyền tiếp qua `inject()`. Span chỉ được xuất khi trace được lấy mẫu và có exporter.
+    """
+
+    def __init__(self, service: str, exporter: Optional[SpanExporter] = None, sample_ratio: float = 1.0):
+        self.service = service
+        self.exporter = exporter
+        self.sample_ratio = sample_ratio
+
+    @contextlib.contextmanager
+    def start_span(self, name: str, traceparent: Optional[str] = None, kind: str = "internal",
+                   attributes: Optional[Dict[str, Any]] = None):
+        """
+        Span con của span hiện tại; nếu chưa có span nào thì nối vào `traceparent`
+        (request từ hop trước) hoặc mở trace mới.
+        """
+        parent = _current_span.get()
+        if parent is not None:
+            trace_id, parent_id, sampled = parent.trace_id, parent.span_id, parent.sampled
+        else:
+            remote = parse_traceparent(traceparent)
+            if remote is not None:
+                trace_id, parent_id, sampled = remote
+            else:
+                trace_id, parent_id = os.urandom(16).hex(), None
+                sampled = random.random() < self.sample_ratio
+        span = Span(name, self.service, trace_id, parent_id, sampled, kind)
+        if attributes:
+            span.attributes.update(attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            if span.end_ns is None:
+                span.end_ns = time.time_ns()
+            if span.sampled and self.exporter is not None:
+                self.exporter.submit(span)
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("ocr_trace_span", default=None)
+_tracer: Optional[Tracer] = None
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def inject(headers: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """Thêm header traceparent của span hiện tại (nếu có) cho request tới hop sau."""
+    headers = dict(headers or {})
+    span = _current_span.get()
+    if span is not None:
+        headers[TRACEPARENT] = span.traceparent()
+    return headers
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """Span con trong service hiện tại; không làm gì khi tracing chưa được cấu hình."""
+    if _tracer is None:
+        yield None
+        return
+    with _tracer.start_span(name, attributes=attributes or None) as current:
+        yield current
+
+
+def configure(service: str, prefix: str = "OCR_TRACE") -> Tracer:
+    """
+    Cấu hình tracer của tiến trình từ biến môi trường:
+      OCR_TRACE_EXPORTER      none | json | otlp (mặc định none: vẫn truyền traceparent, không xuất)
+      OCR_TRACE_FILE          file JSON Lines cho exporter json (mặc định /data/traces/<service>.jsonl)
+      OTEL_EXPORTER_OTLP_ENDPOINT  collector cho exporter otlp (mặc định http://localhost:4318)
+      OCR_TRACE_SAMPLE_RATIO  tỉ lệ lấy mẫu trace mới (0..1, mặc định 1)
+    """
+    global _tracer
+    kind = os.getenv(f"{prefix}_EXPORTER", "none").lower()
+    exporter: Optional[SpanExporter] = None
+    if kind == "json":
+        exporter = JsonFileExporter(os.getenv(f"{prefix}_FILE", f"/data/traces/{service}.jsonl"))
+    elif kind == "otlp":
+        exporter = OTLPExporter(os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318"))
+    elif kind not in ("none", ""):
+        raise ValueError(f"Unsupported trace exporter: {kind}")
+    _tracer = Tracer(service, exporter, sample_ratio=float(os.getenv(f"{prefix}_SAMPLE_RATIO", "1")))
+    return _tracer
+
+
+class TracingMiddleware:
+    """
+    Middleware ASGI mở span server cho mỗi request, nối vào traceparent của hop trước
+    và trả trace id qua header X-Trace-Id để tra cứu. Span kết thúc khi message body cuối
+    (`more_body` false) được gửi, nên response stream được tính trọn thời gian truyền.
+    """
+
+    def __init__(self, app, tracer: Tracer, skip_paths: Iterable[str] = ("/metrics", "/health")):
+        self.app = app
+        self.tracer = tracer
+        self.skip_paths = set(skip_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip_paths:
+            return await self.app(scope, receive, send)
+        method, path = scope["method"], scope["path"]
+        headers = dict(scope["headers"])
+        traceparent = headers.get(TRACEPARENT.encode(), b"").decode("latin-1") or None
+        with self.tracer.start_span(
+            f"{method} {path}", traceparent=traceparent, kind="server",
+            attributes={"http.method": method, "http.target": path},
+        ) as server_span:
+
+            async def send_traced(message):
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+                    server_span.set_attribute("http.status_code", status)
+                    if status >= 500:
+                        server_span.error = f"HTTP {status}"
+                    message = {**message, "headers": [*message.get("headers", []),
+                                                      (b"x-trace-id", server_span.trace_id.encode())]}
+                elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                    server_span.end_ns = time.time_ns()
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_traced)
+            finally:
+                # Router gắn route vào scope: dùng template (vd. /jobs/{job_id}) làm tên span
+                route = getattr(scope.get("route"), "path", None)
+                if route:
+                    server_span.name = f"{method} {route}"
+
+
+def instrument_app(app, tracer: Tracer) -> None:
+    """Gắn TracingMiddleware vào ứng dụng FastAPI."""
+    app.add_middleware(TracingMiddleware, tracer=tracer)
@@ -3,6 +3,10 @@ import uuid
 import logging
 import datetime
 import hashlib
+import base64
+
+# Kích thước khối khi đọc/ghi file theo luồng
+CHUNK_SIZE = 1024 * 1024
 
 def new_session_dir(base: str = "/data"):
     """
@@ -36,12 +40,64 @@ def get_timestamp():
     """
     return datetime.datetime.now().isoformat()
 
+def format_timestamp(ts: float) -> str:
+    """
+    Đổi epoch seconds sang chuỗi ISO 8601 (cùng định dạng với get_timestamp).
+    """
+    return datetime.datetime.fromtimestamp(ts).isoformat()
+
 def compute_file_hash(file_bytes: bytes) -> str:
     """
     Tính hash MD5 cho nội dung file.
     """
     return hashlib.md5(file_bytes).hexdigest()
 
+def file_hasher():
+    """
+    Trả về đối tượng hash cùng thuật toán với compute_file_hash, để hash tăng dần theo từng khối.
+    """
+    return hashlib.md5()
+
+def hash_stream(fileobj, chunk_size: int = CHUNK_SIZE):
+    """
+    Hash nội dung file-like theo từng khối (từ vị trí hiện tại tới hết), rồi tua lại về đầu.
+    Trả về (hash, số byte).
+    """
+    hasher = file_hasher()
+    size = 0
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        hasher.update(chunk)
+        size += len(chunk)
+    fileobj.seek(0)
+    return hasher.hexdigest(), size
+
+def stream_size(fileobj) -> int:
+    """
+    Kích thước của file-like có thể seek, giữ nguyên vị trí đọc hiện tại.
+    """
+    pos = fileobj.tell()
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell()
+    fileobj.seek(pos)
+    return size
+
+def file_to_data_uri(path: str, mime: str, chunk_size: int = 3 * 256 * 1024) -> str:
+    """
+    Tạo data URI base64 từ file trên đĩa, mã hoá từng khối (bội số của 3 byte)
+    thay vì đọc toàn bộ file vào bộ nhớ trước.
+    """
+    parts = [f"data:{mime};base64,"]
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            parts.append(base64.b64encode(chunk).decode())
+    return "".join(parts)
+
 def extract_file_info(filename: str) -> dict:
     """
     Trích xuất thông tin từ tên file.
@@ -0,0 +1,372 @@
+import os
+import json
+import time
+import uuid
+import base64
+import hashlib
+import sqlite3
+import asyncio
+import threading
+from typing import Any, Dict, List, Optional
+from . import metrics
+
+# Trạng thái của một task trong hàng đợi
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+QUEUE_SUBMITTED = metrics.registry.counter(
+    "ocr_queue_submitted_total", "Số task OCR được đưa vào hàng đợi worker")
+QUEUE_REQUEUED = metrics.registry.counter(
+    "ocr_queue_requeued_total", "Số task được trả lại hàng đợi do worker mất heartbeat")
+
+
+class WorkQueue:
+    """
+    Hàng đợi task giữa HTTP front và các tiến trình worker. `payload` và kết quả là dict JSON được.
+    Worker lấy task bằng `claim`, gửi `heartbeat` trong lúc xử lý và kết thúc bằng `complete` / `fail`;
+    task của worker chết (quá `lease` giây không heartbeat) được `requeue_stale` trả lại hàng đợi.
+    """
+
+    def submit(self, payload: Dict[str, Any]) -> str:
+        raise NotImplementedError
+
+    def claim(self, worker: str) -> Optional[Dict[str, Any]]:
+        """Task kế tiếp {"id", "payload", "attempts"} hoặc None nếu hàng đợi trống (không chặn)."""
+        raise NotImplementedError
+
+    def heartbeat(self, task_id: str) -> None:
+        raise NotImplementedError
+
+    def complete(self, task_id: str, result: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def fail(self, task_id: str, error: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def outcome(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """{"status": done, "result": ...} | {"status": failed, "error": ...} hoặc None nếu chưa xong."""
+        raise NotImplementedError
+
+    def cancel(self, task_id: str) -> bool:
+        """Bỏ task chưa được worker nhận; True nếu đã bỏ."""
+        raise NotImplementedError
+
+    def requeue_stale(self, lease: float, max_attempts: int = 3) -> int:
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, int]:
+        raise NotImplementedError
+
+
+class SQLiteQueue(WorkQueue):
+    """
+    Hàng đợi trong SQLite (WAL) dưới thư mục dùng chung /data: đủ cho nhiều tiến trình trên một máy.
+    Task đã xong được xoá sau `retention` giây. Nhiều máy dùng chung thì dùng RedisQueue.
+    """
+
+    def __init__(self, path: str = "/data/queue/ocr.db", retention: float = 3600):
+        self.path = path
+        self.retention = retention
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tasks (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                result TEXT,
+                worker TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                heartbeat_at REAL,
+                finished_at REAL
+            )
+            """
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, created_at)")
+        self._last_purge = 0.0
+
+    def submit(self, payload):
+        task_id = uuid.uuid4().hex
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO tasks (id, status, payload, created_at) VALUES (?, ?, ?, ?)",
+                (task_id, QUEUED, json.dumps(payload, ensure_ascii=False), time.time()),
+            )
+        QUEUE_SUBMITTED.inc()
+        return task_id
+
+    def claim(self, worker):
+        now = time.time()
+        with self._lock:
+            # BEGIN IMMEDIATE giữ khoá ghi: hai worker không thể nhận cùng một task
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT id, payload, attempts FROM tasks WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)
+                ).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        "UPDATE tasks SET status = ?, worker = ?, attempts = attempts + 1, heartbeat_at = ? WHERE id = ?",
+                        (RUNNING, worker, now, row["id"]),
+                    )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return {"id": row["id"], "payload": json.loads(row["payload"]), "attempts": row["attempts"] + 1}
+
+    def heartbeat(self, task_id):
+        with self._lock:
+            self._db.execute("UPDATE tasks SET heartbeat_at = ? WHERE id = ? AND status = ?",
+                             (time.time(), task_id, RUNNING))
+
+    def _finish(self, task_id: str, status: str, data: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            # Kết quả đã có thì payload (có thể chứa API key) không cần giữ nữa
+            self._db.execute(
+                "UPDATE tasks SET status = ?, result = ?, payload = '{}', finished_at = ? WHERE id = ?",
+                (status, json.dumps(data, ensure_ascii=False), now, task_id),
+            )
+            if now - self._last_purge > 60:
+                self._last_purge = now
+                self._db.execute("DELETE FROM tasks WHERE finished_at IS NOT NULL AND finished_at < ?",
+                                 (now - self.retention,))
+
+    def complete(self, task_id, result):
+        self._finish(task_id, DONE, result)
+
+    def fail(self, task_id, error):
+        self._finish(task_id, FAILED, error)
+
+    def outcome(self, task_id):
+        with self._lock:
+            row = self._db.execute("SELECT status, result FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        if row is None or row["status"] not in (DONE, FAILED):
+            return None
+        key = "result" if row["status"] == DONE else "error"
+        return {"status": row["status"], key: json.loads(row["result"])}
+
+    def cancel(self, task_id):
+        with self._lock:
+            cursor = self._db.execute("DELETE FROM tasks WHERE id = ? AND status = ?", (task_id, QUEUED))
+        return cursor.rowcount > 0
+
+    def requeue_stale(self, lease, max_attempts=3):
+        cutoff = time.time() - lease
+        with self._lock:
+            # Task đã thử quá số lần (vd. file làm worker crash) bị đánh dấu lỗi thay vì lặp vô hạn
+            self._db.execute(
+                "UPDATE tasks SET status = ?, result = ?, payload = '{}', finished_at = ? "
+                "WHERE status = ? AND heartbeat_at < ? AND attempts >= ?",
+                (FAILED, json.dumps({"status_code": 502, "detail": "OCR worker lost the task repeatedly"}),
+                 time.time(), RUNNING, cutoff, max_attempts),
+            )
+            cursor = self._db.execute(
+                "UPDATE tasks SET status = ?, worker = NULL WHERE status = ? AND heartbeat_at < ?",
+                (QUEUED, RUNNING, cutoff),
+            )
+        if cursor.rowcount:
+            QUEUE_REQUEUED.inc(cursor.rowcount)
+        return cursor.rowcount
+
+    def stats(self):
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) AS n FROM tasks GROUP BY status").fetchall()
+        counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        counts.update({row["status"]: row["n"] for row in rows})
+        return counts
+
+
+class RedisQueue(WorkQueue):
+    """
+    Hàng đợi trên Redis (hoặc server tương thích): dùng được cho worker ở nhiều máy.
+    Task id nằm trong list `<prefix>queued`, dữ liệu trong hash `<prefix>task:<id>`,
+    kết quả giữ `retention` giây.
+    """
+
+    def __init__(self, url: str = "redis://localhost:6379/0", prefix: str = "ocr:queue:", retention: float = 3600):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("OCR_QUEUE_BACKEND=redis cần cài thư viện `redis`") from e
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.retention = int(retention)
+
+    def _task(self, task_id: str) -> str:
+        return f"{self.prefix}task:{task_id}"
+
+    def submit(self, payload):
+        task_id = uuid.uuid4().hex
+        pipe = self.client.pipeline()
+        pipe.hset(self._task(task_id), mapping={
+            "status": QUEUED, "payload": json.dumps(payload, ensure_ascii=False),
+            "attempts": 0, "created_at": time.time(),
+        })
+        pipe.lpush(f"{self.prefix}queued", task_id)
+        pipe.execute()
+        QUEUE_SUBMITTED.inc()
+        return task_id
+
+    def claim(self, worker):
+        while True:
+            # Chuyển nguyên tử sang list running: task không bị mất nếu worker chết giữa chừng
+            raw = self.client.rpoplpush(f"{self.prefix}queued", f"{self.prefix}running")
+            if raw is None:
+                return None
+            task_id = raw.decode()
+            key = self._task(task_id)
+            if not self.client.exists(key):  # đã bị huỷ
+                self.client.lrem(f"{self.prefix}running", 1, task_id)
+                continue
+            pipe = self.client.pipeline()
+            pipe.hset(key, mapping={"status": RUNNING, "worker": worker, "heartbeat_at": time.time()})
+            pipe.hincrby(key, "attempts", 1)
+            pipe.hget(key, "payload")
+            _, attempts, payload = pipe.execute()
+            return {"id": task_id, "payload": json.loads(payload), "attempts": attempts}
+
+    def heartbeat(self, task_id):
+        self.client.hset(self._task(task_id), "heartbeat_at", time.time())
+
+    def _finish(self, task_id: str, status: str, data: Dict[str, Any]) -> None:
+        key = self._task(task_id)
+        pipe = self.client.pipeline()
+        pipe.hset(key, mapping={"status": status, "result": json.dumps(data, ensure_ascii=False), "payload": "{}"})
+        pipe.expire(key, self.retention)
+        pipe.lrem(f"{self.prefix}running", 1, task_id)
+        pipe.execute()
+
+    def complete(self, task_id, result):
+        self._finish(task_id, DONE, result)
+
+    def fail(self, task_id, error):
+        self._finish(task_id, FAILED, error)
+
+    def outcome(self, task_id):
+        status, result = self.client.hmget(self._task(task_id), "status", "result")
+        if status is None or status.decode() not in (DONE, FAILED):
+            return None
+        status = status.decode()
+        return {"status": status, "result" if status == DONE else "error": json.loads(result)}
+
+    def cancel(self, task_id):
+        if self.client.lrem(f"{self.prefix}queued", 1, task_id):
+            self.client.delete(self._task(task_id))
+            return True
+        return False
+
+    def requeue_stale(self, lease, max_attempts=3):
+        cutoff = time.time() - lease
+        requeued = 0
+        for raw in self.client.lrange(f"{self.prefix}running", 0, -1):
+            task_id = raw.decode()
+            heartbeat_at, attempts = self.client.hmget(self._task(task_id), "heartbeat_at", "attempts")
+            if heartbeat_at is not None and float(heartbeat_at) >= cutoff:
+                continue
+            if heartbeat_at is None and self.client.exists(self._task(task_id)):
+                continue  # vừa được nhận, chưa kịp ghi heartbeat
+            if not self.client.lrem(f"{self.prefix}running", 1, task_id):
+                continue  # worker khác đã xử lý
+            if attempts is not None and int(attempts) >= max_attempts:
+                self._finish(task_id, FAILED, {"status_code": 502, "detail": "OCR worker lost the task repeatedly"})
+                continue
+            self.client.hset(self._task(task_id), "status", QUEUED)
+            self.client.rpush(f"{self.prefix}queued", task_id)
+            requeued += 1
+        if requeued:
+            QUEUE_REQUEUED.inc(requeued)
+        return requeued
+
+    def stats(self):
+        return {
+            QUEUED: self.client.llen(f"{self.prefix}queued"),
+            RUNNING: self.client.llen(f"{self.prefix}running"),
+        }
+
+
+async def wait_outcome(queue: WorkQueue, task_id: str, timeout: float,
+                       interval: float = 0.05, max_interval: float = 0.5) -> Optional[Dict[str, Any]]:
+    """
+    Chờ kết quả task bằng cách hỏi định kỳ (khoảng cách tăng dần tới `max_interval`),
+    không giữ thread nào trong lúc chờ (mỗi lần hỏi chạy ngoài event loop). Trả về None khi quá `timeout` giây.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        result = await asyncio.to_thread(queue.outcome, task_id)
+        if result is not None:
+            return result
+        if time.monotonic() >= deadline:
+            return None
+        await asyncio.sleep(interval)
+        interval = min(interval * 1.5, max_interval)
+
+
+def queue_metrics(queue: WorkQueue) -> List[str]:
+    """Độ sâu hàng đợi theo trạng thái, đọc lúc scrape /metrics."""
+    lines = ["# TYPE ocr_queue_tasks gauge"]
+    try:
+        stats = queue.stats()
+    except Exception:
+        return []
+    for status, count in stats.items():
+        lines.append(f'ocr_queue_tasks{{status="{status}"}} {count}')
+    return lines
+
+
+class KeySealer:
+    """
+    Mã hoá API key riêng trước khi đưa vào payload task (Fernet, khoá dẫn xuất từ secret dùng chung
+    giữa front và worker): hàng đợi nằm trên volume /data dùng chung nên không được giữ key dạng rõ.
+    """
+
+    def __init__(self, secret: str):
+        try:
+            from cryptography.fernet import Fernet
+        except ImportError as e:
+            raise RuntimeError("OCR_QUEUE_SECRET cần cài thư viện `cryptography`") from e
+        self._fernet = Fernet(base64.urlsafe_b64encode(hashlib.sha256(secret.encode("utf-8")).digest()))
+
+    def seal(self, value: str) -> str:
+        return self._fernet.encrypt(value.encode("utf-8")).decode("ascii")
+
+    def unseal(self, token: str) -> str:
+        """Ném ValueError nếu token sai hoặc được mã hoá bằng secret khác."""
+        from cryptography.fernet import InvalidToken
+        try:
+            return self._fernet.decrypt(token.encode("ascii")).decode("utf-8")
+        except InvalidToken as e:
+            raise ValueError("Cannot decrypt API key (OCR_QUEUE_SECRET mismatch?)") from e
+
+
+def build_sealer(prefix: str = "OCR_QUEUE") -> Optional[KeySealer]:
+    """KeySealer từ OCR_QUEUE_SECRET (cùng giá trị ở ocr-service và worker), None nếu chưa đặt."""
+    secret = os.getenv(f"{prefix}_SECRET")
+    return KeySealer(secret) if secret else None
+
+
+def build_queue(prefix: str = "OCR_QUEUE") -> WorkQueue:
+    """
+    Tạo hàng đợi worker từ biến môi trường:
+      OCR_QUEUE_BACKEND     sqlite | redis (mặc định sqlite)
+      OCR_QUEUE_PATH        file SQLite (mặc định /data/queue/ocr.db)
+      OCR_QUEUE_REDIS_URL   URL cho backend redis
+      OCR_QUEUE_RETENTION   số giây giữ kết quả task đã xong (mặc định 3600)
+    """
+    kind = os.getenv(f"{prefix}_BACKEND", "sqlite").lower()
+    retention = float(os.getenv(f"{prefix}_RETENTION", "3600"))
+    if kind == "sqlite":
+        return SQLiteQueue(os.getenv(f"{prefix}_PATH", "/data/queue/ocr.db"), retention=retention)
+    if kind == "redis":
+        return RedisQueue(os.getenv(f"{prefix}_REDIS_URL", "redis://localhost:6379/0"), retention=retention)
+    raise ValueError(f"Unsupported queue backend: {kind}")
@@ -0,0 +1,50 @@
+# common/tests/test_cache.py
+"""
+Kiểm thử đếm dung lượng của `ocr_doc_utils.cache.DiskBackend`.
+
+    python -m pytest common/tests
+"""
+
+import shutil
+import tempfile
+import unittest
+
+from ocr_doc_utils import cache
+
+
+class DiskBackendBytesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def disk_bytes(self) -> int:
+        return sum(size for _, size, _ in cache.DiskBackend(self.directory)._scan())
+
+    def test_overwrite_keeps_bytes_exact(self):
+        backend = cache.DiskBackend(self.directory, max_bytes=1024 * 1024)
+        backend.set("doc", {"text": "a" * 500})
+        backend.set("doc", {"text": "a" * 100})
+        backend.set("doc", {"text": "a" * 300})
+        self.assertEqual(backend.stats()["bytes"], self.disk_bytes())
+        self.assertEqual(backend.get("doc"), {"text": "a" * 300})
+
+    def test_delete_and_eviction_stay_within_max_bytes(self):
+        backend = cache.DiskBackend(self.directory, max_bytes=2000)
+        for i in range(20):
+            backend.set(f"doc{i}", {"text": str(i) * 200})
+            self.assertLessEqual(backend.stats()["bytes"], backend.max_bytes)
+            self.assertEqual(backend.stats()["bytes"], self.disk_bytes())
+        self.assertGreater(backend.stats()["evictions"], 0)
+
+        backend.delete("doc19")
+        backend.delete("doc19")  # xoá lần hai không được trừ thêm
+        self.assertIsNone(backend.get("doc19"))
+        self.assertEqual(backend.stats()["bytes"], self.disk_bytes())
+
+        backend.clear()
+        self.assertEqual(backend.stats()["bytes"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+# common/tests/test_resilience.py
+"""
+Kiểm thử circuit breaker của `ocr_doc_utils.resilience`.
+
+    python -m pytest common/tests
+"""
+
+import asyncio
+import unittest
+
+from ocr_doc_utils import resilience
+
+
+class EngineDown(Exception):
+    status_code = 503
+
+
+class CircuitBreakerCancelTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_cancelled_half_open_trial_is_released(self):
+        breaker = resilience.CircuitBreaker("test", failure_threshold=1, reset_timeout=0.05)
+        caller = resilience.ResilientCaller("test", attempts=1, breaker=breaker)
+
+        async def fail():
+            raise EngineDown()
+
+        with self.assertRaises(EngineDown):
+            await caller.call(fail)
+        self.assertEqual(breaker.state, resilience.OPEN)
+        await asyncio.sleep(0.06)
+
+        # Lời gọi thử khi half-open bị huỷ giữa chừng (client ngắt kết nối)
+        started = asyncio.Event()
+
+        async def hang():
+            started.set()
+            await asyncio.sleep(10)
+
+        trial = asyncio.ensure_future(caller.call(hang))
+        await started.wait()
+        self.assertEqual(breaker.state, resilience.HALF_OPEN)
+        trial.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await trial
+
+        async def ok():
+            return "ok"
+
+        self.assertEqual(await caller.call(ok), "ok")
+        self.assertEqual(breaker.state, resilience.CLOSED)
+
+    async def test_stuck_half_open_trial_expires(self):
+        breaker = resilience.CircuitBreaker("test", failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure()
+        await asyncio.sleep(0.06)
+        breaker.before_call()  # lượt thử không bao giờ ghi nhận kết quả
+        with self.assertRaises(resilience.CircuitOpen):
+            breaker.before_call()
+        await asyncio.sleep(0.06)
+        breaker.before_call()
+        self.assertEqual(breaker.state, resilience.HALF_OPEN)
+
+
+class BadRequest(Exception):
+    status_code = 400
+
+
+class CircuitBreakerOutcomeTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_non_transient_crash_opens_breaker(self):
+        breaker = resilience.CircuitBreaker("test", failure_threshold=3, reset_timeout=30)
+        caller = resilience.ResilientCaller("test", attempts=1, breaker=breaker)
+
+        async def crash():
+            raise RuntimeError("engine crashed")
+
+        for _ in range(3):
+            with self.assertRaises(RuntimeError):
+                await caller.call(crash)
+        self.assertEqual(breaker.state, resilience.OPEN)
+
+    async def test_client_error_does_not_open_breaker(self):
+        breaker = resilience.CircuitBreaker("test", failure_threshold=2, reset_timeout=30)
+        caller = resilience.ResilientCaller("test", attempts=1, breaker=breaker)
+
+        async def bad_input():
+            raise BadRequest()
+
+        for _ in range(3):
+            with self.assertRaises(BadRequest):
+                await caller.call(bad_input)
+        self.assertEqual(breaker.state, resilience.CLOSED)
+
+
+class CallTimeoutTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_stalled_call_times_out_and_counts_as_failure(self):
+        breaker = resilience.CircuitBreaker("test", failure_threshold=2, reset_timeout=30)
+        caller = resilience.ResilientCaller("test", attempts=2, base_delay=0, breaker=breaker, timeout=0.05)
+
+        async def stall():
+            await asyncio.sleep(10)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await caller.call(stall)
+        self.assertEqual(breaker.state, resilience.OPEN)
+
+
+if __name__ == "__main__":
+    unittest.main()
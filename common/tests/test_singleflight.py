@@ -0,0 +1,71 @@
+# common/tests/test_singleflight.py
+"""
+Kiểm thử gộp request trong tiến trình của `ocr_doc_utils.singleflight`.
+
+    python -m pytest common/tests
+"""
+
+import asyncio
+import unittest
+
+from ocr_doc_utils import singleflight
+
+
+class EngineDown(Exception):
+    status_code = 503
+
+
+class SingleFlightTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_waiter_takes_over_after_leader_fails(self):
+        flights = singleflight.SingleFlight(directory=None)
+        calls = []
+        release = asyncio.Event()
+
+        async def engine(caller):
+            calls.append(caller)
+            if len(calls) == 1:
+                await release.wait()
+                raise EngineDown()
+            await asyncio.sleep(0.01)  # leader mới còn đang OCR khi request chờ còn lại quay lại
+            return {"text": caller}
+
+        leader = asyncio.ensure_future(flights.do("doc", lambda: engine("leader")))
+        await asyncio.sleep(0)
+        waiters = [asyncio.ensure_future(flights.do("doc", lambda name=name: engine(name)))
+                   for name in ("first", "second")]
+        await asyncio.sleep(0)
+        release.set()
+
+        with self.assertRaises(EngineDown):
+            await leader
+        results = await asyncio.gather(*waiters)
+
+        # Một request chờ trở thành leader mới, request còn lại dùng chung kết quả của nó
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0], "leader")
+        self.assertIn(calls[1], ("first", "second"))
+        self.assertEqual([result for result, _ in results], [{"text": calls[1]}] * 2)
+        self.assertEqual(sorted(shared for _, shared in results), [False, True])
+
+    async def test_distinct_keys_are_not_coalesced(self):
+        # pipeline gộp theo f"{cache_key}:{process_mode}": khác process_mode là khác khoá
+        flights = singleflight.SingleFlight(directory=None)
+        calls = []
+
+        async def engine(mode):
+            calls.append(mode)
+            await asyncio.sleep(0.01)
+            return {"mode": mode}
+
+        results = await asyncio.gather(
+            flights.do("doc:fast", lambda: engine("fast")),
+            flights.do("doc:accurate", lambda: engine("accurate")),
+        )
+
+        self.assertEqual(sorted(calls), ["accurate", "fast"])
+        self.assertEqual(results, [({"mode": "fast"}, False), ({"mode": "accurate"}, False)])
+
+
+if __name__ == "__main__":
+    unittest.main()
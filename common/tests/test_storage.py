@@ -0,0 +1,100 @@
+# common/tests/test_storage.py
+"""
+Kiểm thử kho upload `ocr_doc_utils.storage.SessionStorage`: dedup bằng hard link, janitor.
+
+    python -m pytest common/tests
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from ocr_doc_utils import storage, utils
+
+
+class SessionStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def write_temp(self, store: storage.SessionStorage, data: bytes) -> str:
+        path = store.temp_path()
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_concurrent_ingest_shares_one_inode(self):
+        store = storage.SessionStorage(self.directory)
+        data = b"%PDF-1.4 same content" * 100
+        file_hash = utils.compute_file_hash(data)
+        workers = 8
+        barrier = threading.Barrier(workers)
+        paths, errors = [], []
+
+        def upload():
+            tmp = self.write_temp(store, data)
+            session = store.new_session()
+            barrier.wait()
+            try:
+                paths.append(store.ingest(tmp, file_hash, session, "doc.pdf"))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=upload) for _ in range(workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        blob = os.stat(store.blob_path(file_hash))
+        self.assertGreaterEqual(blob.st_nlink, 2)
+        self.assertEqual(blob.st_nlink, workers + 1)
+        self.assertEqual({os.stat(p).st_ino for p in paths}, {blob.st_ino})
+        self.assertEqual(os.listdir(store.tmp_dir), [])
+
+    def test_quota_sweep_keeps_sessions_younger_than_min_age(self):
+        store = storage.SessionStorage(self.directory, max_bytes=1000, min_age=600)
+        now = time.time()
+        sessions = {}
+        for name, age in (("old", 3600), ("young", 60)):
+            path = store.new_session()
+            with open(os.path.join(path, "page.png"), "wb") as f:
+                f.write(b"x" * 800)
+            os.utime(path, (now - age, now - age))
+            sessions[name] = path
+
+        removed = store.sweep()
+
+        self.assertEqual(removed["sessions"], 1)
+        self.assertFalse(os.path.exists(sessions["old"]))
+        self.assertTrue(os.path.exists(sessions["young"]))
+
+        # Chỉ còn phiên trẻ nhưng vẫn vượt quota: không được xoá
+        store.max_bytes = 100
+        self.assertEqual(store.sweep()["sessions"], 0)
+        self.assertTrue(os.path.exists(sessions["young"]))
+
+    def test_ingest_without_hard_links_falls_back_to_move(self):
+        store = storage.SessionStorage(self.directory)
+        data = b"no hard links here"
+        file_hash = utils.compute_file_hash(data)
+        tmp = self.write_temp(store, data)
+        session = store.new_session()
+
+        with mock.patch.object(storage.os, "link", side_effect=PermissionError("link not permitted")):
+            path = store.ingest(tmp, file_hash, session, "doc.png")
+
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertFalse(os.path.exists(tmp))
+        self.assertFalse(os.path.exists(store.blob_path(file_hash)))
+
+
+if __name__ == "__main__":
+    unittest.main()
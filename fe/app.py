@@ -2,19 +2,24 @@
 import streamlit as st
 import requests
 import json
-import io
 import base64
-import zipfile
 import uuid
-import datetime
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+from ocr_doc_utils import sessions, tracing
 
 # Nạp biến môi trường từ file .env
 load_dotenv()
 
-API_URL = "http://api:8000/ocr"
+API_BASE_URL = "http://api:8000"
+API_URL = f"{API_BASE_URL}/ocr"
+# Địa chỉ API mà trình duyệt truy cập được (link tải ZIP đi thẳng tới API, không qua Streamlit)
+API_PUBLIC_URL = os.getenv("API_PUBLIC_URL", "http://localhost:8000").rstrip("/")
+# Số file gửi OCR song song mặc định (có thể chỉnh trong sidebar)
+OCR_PARALLELISM = int(os.getenv("FE_OCR_PARALLELISM", "4"))
 
 # ============================================================
 # Cấu hình trang + CSS nhỏ
@@ -51,9 +56,6 @@ st.markdown(
 def show_toast(msg: str, dur: int = 3000):
     st.toast(msg, icon="ℹ️")
 
-def build_data_uri(raw: bytes, mime: str) -> str:
-    return f"data:{mime};base64,{base64.b64encode(raw).decode()}"
-
 # Auto‑download helper (inject HTML + JS click)
 def auto_download(bytes_data: bytes, mime: str, filename: str):
     b64 = base64.b64encode(bytes_data).decode()
@@ -62,6 +64,81 @@ def auto_download(bytes_data: bytes, mime: str, filename: str):
     js = f"<script>document.getElementById('{element_id}').click();</script>"
     st.markdown(href + js, unsafe_allow_html=True)
 
+# Kho phiên trên đĩa dùng chung với API (/data/sessions), mở một lần cho mỗi tiến trình
+@st.cache_resource
+def get_session_store():
+    return sessions.build_session_store()
+
+# Tracer của FE: mỗi lần gửi OCR là gốc của một trace, truyền qua header traceparent tới API
+@st.cache_resource
+def get_tracer():
+    return tracing.configure("fe")
+
+# Số trang và ảnh render từng trang lấy từ API (/files/{hash}/...), file gốc nằm trong kho phiên.
+# Cache phía FE để rerun của Streamlit không gọi lại API.
+@st.cache_data(max_entries=256, show_spinner=False)
+def fetch_page_count(file_hash: str) -> int:
+    res = requests.get(f"{API_BASE_URL}/files/{file_hash}/pages", timeout=60)
+    res.raise_for_status()
+    return res.json()["page_count"]
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def fetch_page_image(file_hash: str, page: int) -> bytes:
+    res = requests.get(f"{API_BASE_URL}/files/{file_hash}/pages/{page}", timeout=120)
+    res.raise_for_status()
+    return res.content
+
+# Hiển thị nguồn: file đã lưu → chỉ ảnh trang đang xem (vài trăm KB) thay vì nhúng cả file base64;
+# URL không lưu file → để trình duyệt tự tải URL
+def show_source(key: str, file_hash: str = None, url: str = "", height: str = "90vh"):
+    if file_hash:
+        try:
+            page_count = fetch_page_count(file_hash)
+            page = 1
+            if page_count > 1:
+                page = st.number_input(f"Trang (1-{page_count}):", min_value=1, max_value=page_count, value=1, key=f"page_{key}")
+            st.image(fetch_page_image(file_hash, int(page)), use_container_width=True)
+        except Exception as e:
+            st.warning(f"Không hiển thị được file: {e}")
+    elif url.lower().endswith(".pdf"):
+        st.markdown(
+            f"""
+            <div style="width:100%; height:{height}; overflow:hidden; border:1px solid #ccc; border-radius:5px; margin-bottom:20px;">
+                <iframe src="{url}" width="100%" height="100%" 
+                    style="transform:scale(1); transform-origin:top left; border:none;"
+                    allowfullscreen></iframe>
+            </div>
+            """, 
+            unsafe_allow_html=True
+        )
+    elif url:
+        st.image(url, use_container_width=True)
+
+def show_zoom_hint():
+    st.markdown(
+        """
+        <div style="text-align:center; margin-top:-15px; margin-bottom:15px;">
+            <small>💡 Nhấn vào ảnh để xem phóng to</small>
+        </div>
+        """,
+        unsafe_allow_html=True
+    )
+
+# Gửi một nguồn tới API OCR (chạy trong thread của pool, không gọi st.* ở đây).
+# FE chỉ dùng văn bản đã làm sạch nên chỉ yêu cầu profile "text" để response gọn;
+# API lưu file gốc + kết quả vào phiên `session_id`.
+def ocr_source(http, tracer, payload, name, api_key, session_id):
+    form = {"api_key": api_key, "fields": "text", "session_id": session_id}
+    with tracer.start_span("fe.ocr", kind="client", attributes={"file.name": name, "source.type": payload[0]}):
+        headers = tracing.inject()
+        if payload[0] == "url":
+            res = http.post(API_URL, data={**form, "url": payload[1]}, headers=headers)
+        else:
+            _, raw, mime = payload
+            res = http.post(API_URL, files={"file": (name, raw, mime)}, data=form, headers=headers)
+        res.raise_for_status()
+        return res.json().get("text", "")
+
 # Kiểm tra tính hợp lệ của API key
 def validate_api_key(api_key):
     try:
@@ -84,14 +161,19 @@ def validate_api_key(api_key):
 # Khởi tạo session_state mặc định
 # ============================================================
 
-st.session_state.setdefault("history", {})         # id → {names, previews, results}
-st.session_state.setdefault("history_list", [])
+# Lịch sử phiên nằm trong SessionStore trên đĩa, session_state chỉ giữ id phiên đang xem
 st.session_state.setdefault("current_session", None)
 st.session_state.setdefault("ocr_running", False)
-st.session_state.setdefault("zip_buffer", None)
-st.session_state.setdefault("zip_name", None)
 st.session_state.setdefault("custom_api_key", "")
 st.session_state.setdefault("use_custom_api_key", False)
+# Hash blob của file upload đã lưu cho phần xem trước (theo file_id), để mỗi lần rerun không hash / ghi lại
+st.session_state.setdefault("preview_blobs", {})
+
+# Định danh trình duyệt (giữ trong URL) để lịch sử phiên còn sau khi tải lại trang / restart
+if "client" not in st.query_params:
+    st.query_params["client"] = uuid.uuid4().hex
+client_id = st.query_params["client"]
+session_store = get_session_store()
 
 # ============================================================
 # Tiêu đề & mô tả
@@ -241,6 +323,12 @@ with st.sidebar:
         re.findall(r"https?://\S+?\.(?:pdf|png|jpe?g)", raw_urls, flags=re.I) if raw_urls else []
     )
     
+    # ---- Số file xử lý song song ----
+    st.number_input(
+        "Số file OCR song song:", min_value=1, max_value=16,
+        value=OCR_PARALLELISM, key="ocr_parallelism"
+    )
+
     # ---- Nút thực thi OCR ----
     run_disabled = (
         not sources or 
@@ -248,8 +336,6 @@ with st.sidebar:
         (ocr_method == "Mistral OCR (API)" and not (st.session_state.get("custom_api_key", "") if st.session_state.get("use_custom_api_key", False) else default_api_key))
     )
     if st.button("Thực hiện OCR", disabled=run_disabled):
-        st.session_state["zip_buffer"] = None
-        st.session_state["zip_name"] = None
         st.session_state["ocr_running"] = True
         
         # Lưu API key hiện tại vào session state để sử dụng khi gọi OCR
@@ -259,8 +345,9 @@ with st.sidebar:
         st.rerun()
 
     # ---- Chọn phiên lịch sử ----
-    if st.session_state["history_list"]:
-        sess_opts = st.session_state["history_list"][::-1]  # mới nhất trước
+    history = [sess["id"] for sess in session_store.list_sessions(owner=client_id) if sess["item_count"]]
+    if history:
+        sess_opts = history  # mới nhất trước
         sel_sess = st.selectbox(
             "Chọn phiên kết quả:", sess_opts,
             index=sess_opts.index(st.session_state["current_session"]) if st.session_state["current_session"] in sess_opts else 0,
@@ -270,12 +357,14 @@ with st.sidebar:
             st.session_state["current_session"] = sel_sess
             st.rerun()
 
-    # ---- Tải ZIP toàn phiên ----
-    if st.session_state.get("zip_buffer"):
-        st.download_button(
-            "Tải ZIP kết quả phiên", st.session_state["zip_buffer"].getvalue(),
-            file_name=f"{st.session_state['zip_name']}.zip", mime="application/zip", key="download_zip_full"
-        )
+    # ---- Tải ZIP toàn phiên (API nén theo luồng từ kết quả đã lưu) ----
+    if st.session_state.get("current_session") in history:
+        zip_formats = st.multiselect("Định dạng trong ZIP:", ["txt", "md", "json"], default=["txt", "md", "json"], key="zip_formats")
+        if zip_formats:
+            st.link_button(
+                "Tải ZIP kết quả phiên",
+                f"{API_PUBLIC_URL}/sessions/{st.session_state['current_session']}/export?formats={','.join(zip_formats)}"
+            )
 
 # ============================================================
 # Preview của sources (nếu chưa chạy và không có kết quả hiển thị)
@@ -314,11 +403,17 @@ if show_preview:
         # Hiển thị nguồn được chọn
         for i, src in enumerate(selected_sources):
             if isinstance(src, str):
-                prev = src
+                file_hash, url = None, src
                 name = os.path.basename(src)
             else:
-                raw = src.read(); src.seek(0)
-                prev = build_data_uri(raw, src.type)
+                # File upload được lưu vào kho phiên (theo hash, trùng với lần OCR sau) để API render từng trang;
+                # chỉ ghi một lần cho mỗi file upload (hoặc lại khi blob đã bị GC của kho phiên xoá)
+                blob_key = getattr(src, "file_id", None) or f"{getattr(src, 'name', i)}:{getattr(src, 'size', 0)}"
+                preview_blobs = st.session_state["preview_blobs"]
+                file_hash = preview_blobs.get(blob_key)
+                if file_hash is None or not os.path.exists(session_store.blob_path(file_hash)):
+                    file_hash = preview_blobs[blob_key] = session_store.put_blob(src.getvalue())
+                url = ""
                 name = src.name if hasattr(src, "name") else f"File {i+1}"
             
             # Tạo card với container để hiển thị file
@@ -327,29 +422,9 @@ if show_preview:
             
             preview_col = st.container()
             with preview_col:
-                if prev.lower().endswith(".pdf") or prev.startswith("data:application/pdf"):
-                    # Sử dụng layout toàn màn hình cho PDF với chiều cao lớn hơn
-                    st.markdown(
-                        f"""
-                        <div style="width:100%; height:90vh; overflow:hidden; border:1px solid #ccc; border-radius:5px; margin-bottom:20px;">
-                            <iframe src="{prev}" width="100%" height="100%" 
-                                style="transform:scale(1); transform-origin:top left; border:none;"
-                                allowfullscreen></iframe>
-                        </div>
-                        """, 
-                        unsafe_allow_html=True
-                    )
-                else:
-                    # Hiển thị ảnh với kích thước tối đa
-                    st.image(prev, use_container_width=True)
-                    st.markdown(
-                        """
-                        <div style="text-align:center; margin-top:-15px; margin-bottom:15px;">
-                            <small>💡 Nhấn vào ảnh để xem phóng to</small>
-                        </div>
-                        """,
-                        unsafe_allow_html=True
-                    )
+                show_source(f"preview_{file_hash or url}", file_hash=file_hash, url=url)
+                if file_hash or not url.lower().endswith(".pdf"):
+                    show_zoom_hint()
 else:
     preview_container.empty()
 
@@ -359,76 +434,49 @@ else:
 
 if st.session_state["ocr_running"] and sources:
     preview_container.empty()
-    sess_id = f"sess_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
-    names, previews, results = [], [], {}
+    # Tạo phiên ngay từ đầu, API lưu từng kết quả vào phiên khi vừa hoàn thành
+    sess_id = session_store.create_session(owner=client_id)
+    st.session_state["current_session"] = sess_id
 
-    progress = st.progress(0)
     total = len(sources)
+    progress = st.progress(0, text=f"OCR 0/{total} file...")
+    done_container = st.container()
+    current_api_key = st.session_state.get("current_api_key", "")
+    parallelism = int(st.session_state.get("ocr_parallelism", OCR_PARALLELISM))
 
+    # Chuẩn bị dữ liệu ở thread chính (UploadedFile/st.* không dùng trong thread)
+    tasks = []
     for i, src in enumerate(sources, 1):
         name = src.name if hasattr(src, "name") else (os.path.basename(src) if isinstance(src, str) else f"file_{i}")
-        try:
-            if isinstance(src, str):  # URL
-                with st.spinner(f"Tải {name} từ URL..."):
-                    # Gửi URL trực tiếp đến API thay vì tải trước
-                    res = requests.post(
-                        API_URL,
-                        data={
-                            "url": src,
-                            "api_key": st.session_state.get("current_api_key", "")
-                        }
-                    )
-                    res.raise_for_status()
-                    data = res.json()
-                    text = data.get("text", "")
-                    prev = src
-            else:  # File upload
-                raw = src.read(); src.seek(0)
-                prev = build_data_uri(raw, src.type)
-                
-                # OCR qua API
-                with st.spinner(f"OCR {name} ..."):
-                    files = {"file": (name, raw, src.type)}
-                    data = {"api_key": st.session_state.get("current_api_key", "")}
-                    res = requests.post(
-                        API_URL,
-                        files=files,
-                        data=data
-                    )
-                    res.raise_for_status()
-                    data = res.json()
-                    text = data.get("text", "")
-
-            names.append(name); previews.append(prev); results[name] = text
-        except Exception as e:
-            show_toast(f"Lỗi {name}: {e}")
-        finally:
-            progress.progress(i / total)
-
+        if isinstance(src, str):  # URL: gửi URL trực tiếp đến API thay vì tải trước
+            tasks.append((name, ("url", src)))
+        else:  # File upload
+            tasks.append((name, ("file", src.getvalue(), src.type)))
+
+    # Session HTTP dùng chung, đủ kết nối cho số luồng song song
+    http = requests.Session()
+    http.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=parallelism))
+
+    with ThreadPoolExecutor(max_workers=parallelism) as pool:
+        futures = {
+            pool.submit(ocr_source, http, get_tracer(), payload, name, current_api_key, sess_id): name
+            for name, payload in tasks
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            name = futures[future]
+            try:
+                text = future.result()
+                with done_container:
+                    with st.expander(f"✅ {name}", expanded=False):
+                        st.code(text, language="markdown")
+            except Exception as e:
+                show_toast(f"Lỗi {name}: {e}")
+            finally:
+                progress.progress(done / total, text=f"OCR {done}/{total} file...")
+
+    http.close()
     progress.empty()
-
-    # Lưu lịch sử
-    st.session_state["history"][sess_id] = {
-        "names": names, "previews": previews, "results": results
-    }
-    st.session_state["history_list"].append(sess_id)
-    st.session_state["current_session"] = sess_id
-
-    # Đóng gói ZIP toàn phiên
-    try:
-        zip_buf = io.BytesIO()
-        with zipfile.ZipFile(zip_buf, "w", zipfile.ZIP_DEFLATED) as zf:
-            for n, txt in results.items():
-                base = os.path.splitext(n)[0]
-                zf.writestr(f"{base}.txt", txt)
-                zf.writestr(f"{base}.md", txt)
-                zf.writestr(f"{base}.json", json.dumps({"result": txt}, ensure_ascii=False, indent=2))
-        zip_buf.seek(0)
-        st.session_state["zip_buffer"] = zip_buf
-        st.session_state["zip_name"] = sess_id
-        show_toast("OCR hoàn thành!")
-    except Exception as e:
-        show_toast(f"Lỗi đóng ZIP: {e}")
+    show_toast("OCR hoàn thành!")
 
     st.session_state["ocr_running"] = False
     st.rerun()
@@ -438,80 +486,53 @@ if st.session_state["ocr_running"] and sources:
 # ============================================================
 
 if st.session_state.get("current_session"):
-    data = st.session_state["history"][st.session_state["current_session"]]
+    # Chỉ metadata của phiên được đọc; kết quả và file gốc được nạp cho mục đang xem
+    items = session_store.items(st.session_state["current_session"])
+    names = [item["name"] for item in items]
 
     st.markdown("---"); st.header(f"Kết quả phiên: {st.session_state['current_session']}")
     
     # Thêm selectbox để dễ dàng chọn nguồn khi có nhiều kết quả
-    if len(data["names"]) > 1:
-        st.write(f"**Số kết quả: {len(data['names'])}**")
+    if len(names) > 1:
+        st.write(f"**Số kết quả: {len(names)}**")
         selected_idx = st.selectbox(
             "Chọn nguồn để xem kết quả:",
-            range(len(data["names"])),
-            format_func=lambda i: data["names"][i],
+            range(len(names)),
+            format_func=lambda i: names[i],
             key="results_selectbox"
         )
         # Hiển thị chỉ nguồn được chọn
         selected_indices = [selected_idx]
-        st.write(f"**Đang xem: {data['names'][selected_idx]}**")
+        st.write(f"**Đang xem: {names[selected_idx]}**")
     else:
         # Hiển thị tất cả nếu chỉ có 1 nguồn
-        selected_indices = range(len(data["names"]))
+        selected_indices = range(len(names))
     
     # Hiển thị cho mỗi nguồn được chọn
     for selected_idx in selected_indices:
-        fname = data["names"][selected_idx]
-        prev = data["previews"][selected_idx]
-        text = data["results"][fname]
+        item = items[selected_idx]
+        fname = item["name"]
+        text = session_store.read_result(item)
+        item_key = f"{st.session_state['current_session']}_{selected_idx}"
 
         # Chỉ hiển thị số nguồn nếu không có selectbox
-        if len(data["names"]) == 1:
+        if len(names) == 1:
             st.markdown(f"### Nguồn: {fname}")
         
         tab1, tab2, tab3 = st.tabs(["Gốc", "So sánh", "Tải xuống / Chỉnh sửa"])
 
         # ---------- Tab Gốc ----------
         with tab1:
-            if prev.lower().endswith(".pdf") or "application/pdf" in prev:
-                st.markdown(
-                    f"""
-                    <div style="width:100%; height:90vh; overflow:hidden; border:1px solid #ccc; border-radius:5px; margin-bottom:20px;">
-                        <iframe src="{prev}" width="100%" height="100%" 
-                            style="transform:scale(1); transform-origin:top left; border:none;"
-                            allowfullscreen></iframe>
-                    </div>
-                    """, 
-                    unsafe_allow_html=True
-                )
-            else:
-                st.image(prev, use_container_width=True)
-                st.markdown(
-                    """
-                    <div style="text-align:center; margin-top:-15px; margin-bottom:15px;">
-                        <small>💡 Nhấn vào ảnh để xem phóng to</small>
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
+            show_source(f"orig_{item_key}", file_hash=item["file_hash"], url=item["url"] or "")
+            if item["file_hash"] or not (item["url"] or "").lower().endswith(".pdf"):
+                show_zoom_hint()
 
         # ---------- Tab So sánh ----------
         with tab2:
             c1, c2 = st.columns(2)
             with c1:
                 st.markdown("**File gốc**")
-                if prev.lower().endswith(".pdf") or "application/pdf" in prev:
-                    st.markdown(
-                        f"""
-                        <div style="width:100%; height:70vh; overflow:hidden; border:1px solid #ccc; border-radius:5px;">
-                            <iframe src="{prev}" width="100%" height="100%" 
-                                style="transform:scale(1); transform-origin:top left; border:none;"
-                                allowfullscreen></iframe>
-                        </div>
-                        """, 
-                        unsafe_allow_html=True
-                    )
-                else:
-                    st.image(prev, use_container_width=True)
+                show_source(f"cmp_{item_key}", file_hash=item["file_hash"], url=item["url"] or "", height="70vh")
             with c2:
                 st.markdown("**Text OCR**")
                 # Sử dụng container có thể cuộn với chiều cao phù hợp với khung PDF
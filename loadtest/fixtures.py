@@ -0,0 +1,89 @@
+# loadtest/fixtures.py
+"""
+Sinh file đầu vào tổng hợp cho load test, không cần thư viện ngoài:
+PDF nhiều trang có chữ (hợp lệ với poppler / Mistral) và PNG có nhiễu (khó nén,
+kích thước gần với ảnh chụp thật).
+"""
+
+import os
+import zlib
+import struct
+import random
+
+LINE = "Dieu {n}. Nghi dinh nay quy dinh chi tiet mot so dieu, khoan cua Luat Dat dai."
+
+
+def make_pdf(pages: int, lines_per_page: int = 40) -> bytes:
+    """PDF `pages` trang, mỗi trang vài chục dòng chữ Helvetica."""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # Pages, điền sau khi biết id các trang
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_ids = []
+    for page in range(pages):
+        text = ["BT /F1 10 Tf 50 800 Td 12 TL"]
+        for line in range(lines_per_page):
+            text.append(f"({LINE.format(n=page * lines_per_page + line + 1)}) '")
+        text.append("ET")
+        stream = "\n".join(text).encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id
+        )
+        page_ids.append(len(objects))
+    kids = b" ".join(b"%d 0 R" % pid for pid in page_ids)
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, pages)
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+def make_png(width: int, height: int, noise: float = 0.3, seed: int = 0) -> bytes:
+    """PNG xám `width`x`height`; `noise` là tỉ lệ điểm ngẫu nhiên (càng cao file càng lớn)."""
+    rnd = random.Random(seed)
+    rows = []
+    for _ in range(height):
+        row = bytearray(b"\xff" * width)
+        for _ in range(int(width * noise)):
+            row[rnd.randrange(width)] = rnd.randrange(256)
+        rows.append(b"\x00" + bytes(row))
+    header = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + _png_chunk(b"IHDR", header)
+            + _png_chunk(b"IDAT", zlib.compress(b"".join(rows), 6)) + _png_chunk(b"IEND", b""))
+
+
+def make_unique(data: bytes, content_type: str) -> bytes:
+    """
+    Thêm vài byte ngẫu nhiên mà trình đọc bỏ qua (comment cuối PDF, dữ liệu sau IEND của PNG)
+    để mỗi request có hash khác nhau và không trúng cache kết quả.
+    """
+    marker = os.urandom(8).hex().encode()
+    if content_type == "application/pdf":
+        return data + b"% " + marker + b"\n"
+    return data + marker
+
+
+# Các loại tài liệu mặc định: tên → (content_type, hàm sinh, số trang)
+PROFILES = {
+    "pdf-1p": ("application/pdf", lambda: make_pdf(1), 1),
+    "pdf-10p": ("application/pdf", lambda: make_pdf(10), 10),
+    "pdf-50p": ("application/pdf", lambda: make_pdf(50), 50),
+    "png-small": ("image/png", lambda: make_png(800, 1100, noise=0.05), 1),
+    "png-large": ("image/png", lambda: make_png(2000, 2800, noise=0.3), 1),
+}
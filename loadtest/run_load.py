@@ -0,0 +1,224 @@
+# loadtest/run_load.py
+"""
+Load test cho stack OCR (api → ocr-service) với engine giả lập, cho số đo thông lượng lặp lại được.
+
+Chạy stack với MockEngine (không gọi Mistral):
+
+    docker compose -f docker-compose.yaml -f loadtest/docker-compose.mock.yaml up --build
+
+rồi bắn tải đồng thời với hỗn hợp PDF / ảnh nhiều kích thước:
+
+    python loadtest/run_load.py --concurrency 16 --requests 500
+    python loadtest/run_load.py --target http://localhost:9000/ocr --duration 60 \\
+        --mix pdf-1p=4,pdf-10p=3,pdf-50p=1,png-small=2,png-large=1 --json result.json
+
+Báo cáo: số request thành công / lỗi, thông lượng (tài liệu/s, trang/s), độ trễ p50/p95/p99
+tổng và theo loại tài liệu, RSS (đỉnh) của từng service đọc từ GET /metrics.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+from collections import Counter, defaultdict
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fixtures  # noqa: E402
+
+
+def percentile(values, q: float) -> float:
+    """Phân vị theo nearest-rank của danh sách (giây)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def parse_mix(spec: str) -> dict:
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in fixtures.PROFILES:
+            sys.exit(f"unknown profile {name!r}; available: {', '.join(fixtures.PROFILES)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+async def read_rss(client: httpx.AsyncClient, url: str):
+    """process_resident_memory_bytes từ /metrics (None nếu không đọc được)."""
+    try:
+        response = await client.get(url, timeout=5)
+        for line in response.text.splitlines():
+            if line.startswith("process_resident_memory_bytes "):
+                return float(line.split()[1])
+    except httpx.HTTPError:
+        pass
+    return None
+
+
+async def sample_rss(client: httpx.AsyncClient, urls, peaks: dict, stop: asyncio.Event, interval: float):
+    while not stop.is_set():
+        for url in urls:
+            rss = await read_rss(client, url)
+            if rss is not None:
+                peaks[url] = max(peaks.get(url, 0.0), rss)
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run(args) -> dict:
+    mix = parse_mix(args.mix)
+    print(f"Generating fixtures: {', '.join(mix)}", file=sys.stderr)
+    documents = {name: (fixtures.PROFILES[name][0], fixtures.PROFILES[name][1](), fixtures.PROFILES[name][2])
+                 for name in mix}
+    names, weights = list(mix), list(mix.values())
+    rnd = random.Random(args.seed)
+
+    headers = {"X-API-Key": args.api_key} if args.api_key else {}
+    form = {}
+    if args.fields:
+        form["fields"] = args.fields
+    if args.mode:
+        form["mode"] = args.mode
+
+    latencies = defaultdict(list)
+    statuses = Counter()
+    pages_done = 0
+    bytes_sent = 0
+    issued = 0
+    deadline = time.monotonic() + args.duration if args.duration else None
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client:
+        baseline = {url: await read_rss(client, url) for url in args.metrics}
+        peaks = {}
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(sample_rss(client, args.metrics, peaks, stop, args.sample_interval))
+
+        async def worker():
+            nonlocal issued, pages_done, bytes_sent
+            while True:
+                if deadline is not None:
+                    if time.monotonic() >= deadline:
+                        return
+                elif issued >= args.requests:
+                    return
+                issued += 1
+                name = rnd.choices(names, weights)[0]
+                content_type, data, page_count = documents[name]
+                if not args.allow_cache:
+                    data = fixtures.make_unique(data, content_type)
+                ext = "pdf" if content_type == "application/pdf" else "png"
+                start = time.perf_counter()
+                try:
+                    response = await client.post(
+                        args.target, files={"file": (f"{name}.{ext}", data, content_type)},
+                        data=form, headers=headers
+                    )
+                    status = response.status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                elapsed = time.perf_counter() - start
+                statuses[status] += 1
+                bytes_sent += len(data)
+                if status == 200:
+                    latencies[name].append(elapsed)
+                    pages_done += page_count
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        wall = time.perf_counter() - started
+        stop.set()
+        await sampler
+        final = {url: await read_rss(client, url) for url in args.metrics}
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    ok = len(all_latencies)
+
+    def summary(values):
+        return {
+            "count": len(values),
+            "p50": round(percentile(values, 50), 4),
+            "p95": round(percentile(values, 95), 4),
+            "p99": round(percentile(values, 99), 4),
+            "max": round(max(values), 4) if values else 0.0,
+        }
+
+    return {
+        "target": args.target,
+        "concurrency": args.concurrency,
+        "wall_seconds": round(wall, 2),
+        "requests": sum(statuses.values()),
+        "ok": ok,
+        "statuses": {str(key): value for key, value in statuses.items()},
+        "throughput_docs_per_s": round(ok / wall, 2) if wall else 0.0,
+        "throughput_pages_per_s": round(pages_done / wall, 2) if wall else 0.0,
+        "upload_mb_per_s": round(bytes_sent / wall / (1024 * 1024), 2) if wall else 0.0,
+        "latency": summary(all_latencies),
+        "latency_by_profile": {name: summary(values) for name, values in sorted(latencies.items())},
+        "rss_mb": {
+            url: {
+                "start": round(baseline[url] / 2**20, 1) if baseline.get(url) else None,
+                "peak": round(peaks[url] / 2**20, 1) if peaks.get(url) else None,
+                "end": round(final[url] / 2**20, 1) if final.get(url) else None,
+            }
+            for url in args.metrics
+        },
+    }
+
+
+def print_report(result: dict) -> None:
+    print(f"\ntarget        {result['target']}  (concurrency {result['concurrency']}, {result['wall_seconds']} s)")
+    print(f"requests      {result['requests']}  ok {result['ok']}  statuses {result['statuses']}")
+    print(f"throughput    {result['throughput_docs_per_s']} docs/s  {result['throughput_pages_per_s']} pages/s  "
+          f"{result['upload_mb_per_s']} MB/s upload")
+    print(f"\n{'profile':<12} {'count':>6} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} {'max s':>8}")
+    rows = list(result["latency_by_profile"].items()) + [("all", result["latency"])]
+    for name, stats in rows:
+        print(f"{name:<12} {stats['count']:>6} {stats['p50']:>8.3f} {stats['p95']:>8.3f} {stats['p99']:>8.3f} {stats['max']:>8.3f}")
+    if result["rss_mb"]:
+        print(f"\n{'RSS MB':<40} {'start':>8} {'peak':>8} {'end':>8}")
+        for url, rss in result["rss_mb"].items():
+            print(f"{url:<40} {rss['start'] or '-':>8} {rss['peak'] or '-':>8} {rss['end'] or '-':>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test OCR stack (api / ocr-service)")
+    parser.add_argument("--target", default="http://localhost:8000/ocr", help="endpoint /ocr của api hoặc ocr-service")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200, help="tổng số request (bỏ qua khi có --duration)")
+    parser.add_argument("--duration", type=float, default=None, help="chạy trong N giây")
+    parser.add_argument("--mix", default="pdf-1p=4,pdf-10p=3,pdf-50p=1,png-small=2,png-large=1",
+                        help="tỉ trọng các loại tài liệu, xem fixtures.PROFILES")
+    parser.add_argument("--metrics", nargs="*", default=["http://localhost:8000/metrics", "http://localhost:9000/metrics"],
+                        help="endpoint /metrics để đọc RSS")
+    parser.add_argument("--sample-interval", type=float, default=0.5)
+    parser.add_argument("--fields", default="text", help="profile response gửi kèm (mặc định text)")
+    parser.add_argument("--mode", default=None, help="document | pages | parallel")
+    parser.add_argument("--api-key", default=None, help="gửi header X-API-Key")
+    parser.add_argument("--allow-cache", action="store_true", help="gửi lại đúng file (cho phép trúng cache kết quả)")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", default=None, help="ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,447 @@
+# ocr-service/engines.py
+
+import os
+import re
+import time
+import base64
+import random
+import hashlib
+import asyncio
+import threading
+import contextlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+from ocr_doc_utils import utils
+import pdf_pages
+
+logger = utils.setup_logging()
+
+
+@dataclass
+class Document:
+    """
+    File đã được chuẩn bị cho một engine. `payload` là dữ liệu riêng của engine
+    (vd. tham số `document` của Mistral), `uploaded_id` là file tạm cần xoá khi xong.
+    `images` nhận ảnh trích xuất khi gọi `process(..., include_images=True)`:
+    {"page": chỉ số trang (từ 0), "id": tên ảnh trong markdown, "data": bytes}.
+    """
+    path: str
+    filename: str
+    content_type: str
+    size: int
+    payload: Any = None
+    uploaded_id: Optional[str] = None
+    images: List[Dict[str, Any]] = field(default_factory=list)
+
+
+class OCREngine:
+    """
+    Giao diện chung cho các engine OCR. Một engine nhận file trên đĩa và trả về
+    markdown của từng trang theo thứ tự.
+    """
+
+    name = "base"
+    model = ""
+
+    async def warmup(self) -> None:
+        """Nạp trước tài nguyên nặng (model, kết nối) để request đầu tiên không phải chờ."""
+
+    async def prepare(self, path: str, filename: str, content_type: str, size: int, shared: bool = False) -> Document:
+        """
+        Chuẩn bị file cho các lần gọi `process`. `shared=True` khi cùng một document
+        được dùng cho nhiều lần gọi (vd. OCR song song theo khoảng trang).
+        """
+        return Document(path=path, filename=filename, content_type=content_type, size=size)
+
+    async def release(self, doc: Document) -> None:
+        """Giải phóng tài nguyên tạo ra trong `prepare`."""
+
+    async def process(self, doc: Document, pages: Optional[List[int]] = None, include_images: bool = False) -> List[str]:
+        """
+        OCR `doc` (hoặc chỉ các trang `pages`, đánh số từ 0), trả về markdown từng trang.
+        Ảnh trong trang chỉ được yêu cầu khi `include_images=True` và được thêm vào `doc.images`.
+        """
+        raise NotImplementedError
+
+    async def aclose(self) -> None:
+        """Đóng kết nối / giải phóng model khi engine bị loại khỏi pool."""
+
+
+class MistralEngine(OCREngine):
+    """
+    Engine gọi Mistral OCR trên cloud. File nhỏ được nhúng base64, file lớn
+    (hoặc document dùng chung) được upload theo luồng và tham chiếu bằng signed URL.
+    """
+
+    name = "mistral"
+
+    def __init__(self, api_key: str, model: str = "mistral-ocr-latest", inline_max_bytes: int = 4 * 1024 * 1024,
+                 max_connections: int = 20, keepalive_expiry: float = 60, timeout: Optional[float] = 300):
+        import httpx
+        from mistralai import Mistral
+        # HTTP client riêng để giữ kết nối TLS sống giữa các request và đóng được khi bị loại khỏi pool.
+        # `timeout` (giây, None = không giới hạn): provider treo thì lời gọi lỗi thay vì giữ slot mãi
+        self._http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, keepalive_expiry=keepalive_expiry),
+            timeout=httpx.Timeout(timeout, connect=min(timeout, 10.0) if timeout else None),
+        )
+        self.client = Mistral(api_key=api_key, async_client=self._http)
+        self.model = model
+        self.inline_max_bytes = inline_max_bytes
+
+    async def validate(self) -> None:
+        """Gọi nhẹ (liệt kê model) để kiểm tra API key; ném lỗi của SDK nếu key không hợp lệ."""
+        await self.client.models.list_async()
+
+    async def aclose(self):
+        await self._http.aclose()
+
+    async def prepare(self, path, filename, content_type, size, shared=False):
+        doc = await super().prepare(path, filename, content_type, size, shared)
+        doc_type = "document_url" if content_type == "application/pdf" else "image_url"
+        # Document dùng chung: nhúng base64 sẽ gửi lại cả file cho mỗi lần gọi nên luôn upload
+        if size <= self.inline_max_bytes and not shared:
+            data_uri = await asyncio.to_thread(utils.file_to_data_uri, path, content_type)
+            doc.payload = {"type": doc_type, doc_type: data_uri}
+            return doc
+
+        with open(path, "rb") as fh:
+            uploaded = await self.client.files.upload_async(
+                file={"file_name": filename, "content": fh},
+                purpose="ocr"
+            )
+        doc.uploaded_id = uploaded.id
+        signed = await self.client.files.get_signed_url_async(file_id=uploaded.id)
+        doc.payload = {"type": doc_type, doc_type: signed.url}
+        return doc
+
+    async def release(self, doc):
+        if not doc.uploaded_id:
+            return
+        try:
+            await self.client.files.delete_async(file_id=doc.uploaded_id)
+        except Exception as e:
+            logger.warning(f"Failed to delete uploaded file {doc.uploaded_id}: {e}")
+
+    async def process(self, doc, pages=None, include_images=False):
+        options = {"pages": list(pages)} if pages is not None else {}
+        ocr_result = await self.client.ocr.process_async(
+            model=self.model,
+            document=doc.payload,
+            include_image_base64=include_images,
+            **options
+        )
+        result_pages = sorted(ocr_result.pages, key=lambda p: p.index)
+        if include_images:
+            for page in result_pages:
+                for image in page.images or []:
+                    if image.image_base64:
+                        doc.images.append({"page": page.index, "id": image.id, "data": decode_image(image.image_base64)})
+        return [page.markdown for page in result_pages]
+
+
+def decode_image(image_base64: str) -> bytes:
+    """Giải mã ảnh base64 Mistral trả về (có thể ở dạng data URI)."""
+    if image_base64.startswith("data:"):
+        image_base64 = image_base64.split(",", 1)[1]
+    return base64.b64decode(image_base64)
+
+
+class LocalEngine(OCREngine):
+    """
+    Engine chạy offline trên CPU với model vision .gguf qua llama-cpp-python.
+    Model được nạp một lần cho mỗi tiến trình worker và giữ trong bộ nhớ giữa các request;
+    mỗi lần chỉ chạy một suy luận vì context của llama.cpp không an toàn đa luồng.
+    """
+
+    name = "local"
+    prompt = (
+        "Transcribe all text in this document page exactly as written, in reading order. "
+        "Keep the original language (Vietnamese) and diacritics. Return Markdown only, "
+        "using headings, lists and tables where the page has them."
+    )
+
+    def __init__(self, model_path: str, mmproj_path: Optional[str] = None, n_threads: Optional[int] = None,
+                 n_ctx: int = 8192, max_tokens: int = 4096, dpi: int = 150):
+        self.model_path = model_path
+        self.mmproj_path = mmproj_path
+        self.model = os.path.basename(model_path)
+        self.n_threads = n_threads or os.cpu_count()
+        self.n_ctx = n_ctx
+        self.max_tokens = max_tokens
+        self.dpi = dpi
+        self._llm = None
+        self._load_lock = threading.Lock()
+        self._infer_lock = threading.Lock()
+
+    def _load(self):
+        with self._load_lock:
+            if self._llm is not None:
+                return self._llm
+            try:
+                from llama_cpp import Llama
+                from llama_cpp.llama_chat_format import Llava15ChatHandler
+            except ImportError as e:
+                raise RuntimeError("OCR_MODE=local cần cài `llama-cpp-python`") from e
+            if not os.path.exists(self.model_path):
+                raise RuntimeError(f"Local OCR model not found: {self.model_path}")
+            # Không có projector vision thì model không thấy ảnh và trả về văn bản bịa thay vì lỗi
+            if not self.mmproj_path:
+                raise RuntimeError("OCR_MODE=local cần OCR_LOCAL_MMPROJ (projector vision đi kèm model)")
+            if not os.path.exists(self.mmproj_path):
+                raise RuntimeError(f"Local OCR mmproj not found: {self.mmproj_path}")
+
+            logger.info(f"Loading local OCR model {self.model_path} ({self.n_threads} threads)")
+            chat_handler = Llava15ChatHandler(clip_model_path=self.mmproj_path, verbose=False)
+            self._llm = Llama(
+                model_path=self.model_path,
+                chat_handler=chat_handler,
+                n_ctx=self.n_ctx,
+                n_threads=self.n_threads,
+                n_gpu_layers=0,
+                verbose=False,
+            )
+            return self._llm
+
+    def _infer(self, image_bytes: bytes, mime: str) -> str:
+        llm = self._load()
+        data_uri = f"data:{mime};base64,{base64.b64encode(image_bytes).decode()}"
+        with self._infer_lock:
+            completion = llm.create_chat_completion(
+                messages=[{
+                    "role": "user",
+                    "content": [
+                        {"type": "image_url", "image_url": {"url": data_uri}},
+                        {"type": "text", "text": self.prompt},
+                    ],
+                }],
+                temperature=0,
+                max_tokens=self.max_tokens,
+            )
+        return completion["choices"][0]["message"]["content"].strip()
+
+    async def warmup(self):
+        await asyncio.to_thread(self._load)
+
+        def tiny_completion():
+            with self._infer_lock:
+                self._llm.create_completion("OK", max_tokens=1)
+
+        # Một lượt sinh ngắn để nạp trọng số vào RAM trước request đầu tiên
+        await asyncio.to_thread(tiny_completion)
+        logger.info(f"Local OCR model {self.model} warmed up")
+
+    async def process(self, doc, pages=None, include_images=False):
+        # Model vision chỉ trả văn bản, không trích xuất ảnh trong trang
+        if doc.content_type != "application/pdf":
+            with open(doc.path, "rb") as f:
+                image_bytes = f.read()
+            return [await asyncio.to_thread(self._infer, image_bytes, doc.content_type)]
+
+        if pages is None:
+            pages = range(await asyncio.to_thread(pdf_pages.page_count, doc.path))
+        results = []
+        for index in pages:
+            png = await asyncio.to_thread(pdf_pages.render_page, doc.path, index + 1, self.dpi)
+            results.append(await asyncio.to_thread(self._infer, png, "image/png"))
+        return results
+
+
+class MockEngineError(RuntimeError):
+    """Lỗi giả lập của MockEngine (mô phỏng lỗi / 5xx từ provider)."""
+    status_code = 503
+
+
+class MockEngine(OCREngine):
+    """
+    Engine giả lập cho load test và phát triển không cần Mistral: không gọi mạng, chỉ chờ
+    `page_latency` giây cho mỗi trang (± `jitter` tỉ lệ), lỗi ngẫu nhiên với xác suất
+    `failure_rate` và trả về `page_chars` ký tự markdown văn bản pháp luật cho mỗi trang.
+    Số trang PDF được đếm trực tiếp trên file để không tốn thời gian render.
+    """
+
+    name = "mock"
+    model = "mock-ocr"
+    _page_pattern = re.compile(rb"/Type\s*/Page\b")
+    _sentences = (
+        "Nghị định này quy định chi tiết một số điều, khoản của Luật Đất đai về quản lý nhà nước.",
+        "Cơ quan nhà nước có thẩm quyền thực hiện việc thu hồi đất theo quy định tại Điều 79.",
+        "Mức thu bằng 0.5% giá trị quyền sử dụng đất tính theo bảng giá đất của Ủy ban nhân dân cấp tỉnh.",
+        "Người sử dụng đất có trách nhiệm kê khai, đăng ký đất đai theo mẫu do Bộ ban hành.",
+    )
+
+    def __init__(self, page_latency: float = 0.2, jitter: float = 0.2, failure_rate: float = 0.0,
+                 page_chars: int = 2000, api_key: Optional[str] = None):
+        self.page_latency = page_latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.page_chars = page_chars
+        self.api_key = api_key
+
+    async def validate(self) -> None:
+        # Key "invalid" được coi là sai để thử luồng kiểm tra key
+        if self.api_key == "invalid":
+            error = MockEngineError("Invalid API key (mock)")
+            error.status_code = 401
+            raise error
+
+    def _page_count(self, doc: Document) -> int:
+        if doc.content_type != "application/pdf":
+            return 1
+        with open(doc.path, "rb") as f:
+            return max(1, len(self._page_pattern.findall(f.read())))
+
+    def _page_markdown(self, index: int) -> str:
+        lines = [f"# Trang {index + 1}", ""]
+        size = 0
+        article = index * 3 + 1
+        while size < self.page_chars:
+            line = f"Điều {article}. {self._sentences[article % len(self._sentences)]}"
+            lines.append(line)
+            lines.append("")
+            size += len(line) + 2
+            article += 1
+        return "\n".join(lines)
+
+    async def process(self, doc, pages=None, include_images=False):
+        if pages is None:
+            pages = range(await asyncio.to_thread(self._page_count, doc))
+        pages = list(pages)
+        latency = self.page_latency * len(pages) * random.uniform(1 - self.jitter, 1 + self.jitter)
+        await asyncio.sleep(max(latency, 0.0))
+        if random.random() < self.failure_rate:
+            raise MockEngineError(f"Mock engine failure for {doc.filename}")
+        if include_images:
+            for index in pages:
+                doc.images.append({"page": index, "id": f"img-{index}.png", "data": _MOCK_PNG})
+        return [self._page_markdown(index) for index in pages]
+
+
+# PNG 1x1 dùng làm ảnh trích xuất giả
+_MOCK_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+)
+
+
+def build_mock_engine(api_key: Optional[str] = None) -> MockEngine:
+    return MockEngine(
+        page_latency=float(os.getenv("OCR_MOCK_PAGE_LATENCY", "0.2")),
+        jitter=float(os.getenv("OCR_MOCK_JITTER", "0.2")),
+        failure_rate=float(os.getenv("OCR_MOCK_FAILURE_RATE", "0")),
+        page_chars=int(os.getenv("OCR_MOCK_PAGE_CHARS", "2000")),
+        api_key=api_key,
+    )
+
+
+class EnginePool:
+    """
+    Pool engine theo API key (khoá là hash của key, không lưu key thô làm khoá), giới hạn
+    kích thước theo LRU và loại các engine không dùng quá `idle_ttl` giây. Engine bị loại
+    chỉ được đóng khi không còn request nào đang mượn nó.
+    """
+
+    def __init__(self, factory: Callable[[str], OCREngine], max_size: int = 32, idle_ttl: float = 600):
+        self.factory = factory
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()  # digest → {engine, last_used, leases}
+        self._retired: List[Dict[str, Any]] = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _digest(api_key: str) -> str:
+        return hashlib.sha256(api_key.encode()).hexdigest()
+
+    @contextlib.asynccontextmanager
+    async def lease(self, api_key: str):
+        """Mượn engine cho `api_key` trong phạm vi `async with`."""
+        entry = self._acquire(api_key)
+        entry["leases"] += 1
+        try:
+            yield entry["engine"]
+        finally:
+            entry["leases"] -= 1
+            entry["last_used"] = time.monotonic()
+            await self._close_retired()
+
+    def _acquire(self, api_key: str) -> Dict[str, Any]:
+        digest = self._digest(api_key)
+        self._evict_idle()
+        entry = self._entries.get(digest)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(digest)
+            return entry
+        self.misses += 1
+        entry = {"engine": self.factory(api_key), "last_used": time.monotonic(), "leases": 0}
+        self._entries[digest] = entry
+        while len(self._entries) > self.max_size:
+            _, oldest = self._entries.popitem(last=False)
+            self._retire(oldest)
+        return entry
+
+    def _evict_idle(self) -> None:
+        deadline = time.monotonic() - self.idle_ttl
+        for digest in [d for d, e in self._entries.items() if e["leases"] == 0 and e["last_used"] < deadline]:
+            self._retire(self._entries.pop(digest))
+
+    def _retire(self, entry: Dict[str, Any]) -> None:
+        self.evictions += 1
+        self._retired.append(entry)
+
+    async def _close_retired(self) -> None:
+        idle = [e for e in self._retired if e["leases"] == 0]
+        self._retired = [e for e in self._retired if e["leases"] > 0]
+        for entry in idle:
+            try:
+                await entry["engine"].aclose()
+            except Exception as e:
+                logger.warning(f"Failed to close pooled engine: {e}")
+
+    async def aclose(self) -> None:
+        for entry in self._entries.values():
+            self._retired.append(entry)
+        self._entries.clear()
+        await self._close_retired()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+def local_model_path() -> Optional[str]:
+    """
+    Đường dẫn model local: OCR_LOCAL_MODEL=7b|14b chọn OCR_MODEL_7B / OCR_MODEL_14B,
+    nếu không có thì dùng LOCAL_MODEL_PATH.
+    """
+    size = os.getenv("OCR_LOCAL_MODEL", "7b").lower()
+    by_size = {"7b": os.getenv("OCR_MODEL_7B"), "14b": os.getenv("OCR_MODEL_14B")}
+    return by_size.get(size) or os.getenv("LOCAL_MODEL_PATH")
+
+
+def build_local_engine() -> LocalEngine:
+    model_path = local_model_path()
+    if not model_path:
+        raise RuntimeError("MISSING local model path! Set OCR_MODEL_7B / OCR_MODEL_14B or LOCAL_MODEL_PATH when OCR_MODE=local")
+    mmproj_path = os.getenv("OCR_LOCAL_MMPROJ")
+    if not mmproj_path:
+        raise RuntimeError("MISSING OCR_LOCAL_MMPROJ! The vision projector (.gguf) is required when OCR_MODE=local")
+    threads = os.getenv("OCR_LOCAL_THREADS")
+    return LocalEngine(
+        model_path=model_path,
+        mmproj_path=mmproj_path,
+        n_threads=int(threads) if threads else None,
+        n_ctx=int(os.getenv("OCR_LOCAL_CTX", "8192")),
+        max_tokens=int(os.getenv("OCR_LOCAL_MAX_TOKENS", "4096")),
+        dpi=int(os.getenv("OCR_LOCAL_DPI", "150")),
+    )
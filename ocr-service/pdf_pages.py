@@ -0,0 +1,17 @@
+# ocr-service/pdf_pages.py
+
+import io
+from pdf2image import convert_from_path, pdfinfo_from_path
+
+
+def page_count(path: str) -> int:
+    """Số trang của file PDF."""
+    return pdfinfo_from_path(path)["Pages"]
+
+
+def render_page(path: str, page_no: int, dpi: int = 200) -> bytes:
+    """Render một trang PDF (1-based) thành PNG, chỉ trang đó được nạp vào bộ nhớ."""
+    image = convert_from_path(path, dpi=dpi, first_page=page_no, last_page=page_no)[0]
+    buf = io.BytesIO()
+    image.save(buf, format="PNG")
+    return buf.getvalue()
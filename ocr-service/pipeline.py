@@ -0,0 +1,370 @@
+# ocr-service/pipeline.py
+"""
+Pipeline OCR dùng chung cho HTTP front (server.py, OCR_WORKER_MODE=inline) và tiến trình worker
+(worker.py, OCR_WORKER_MODE=queue): engine, cache kết quả, gộp request, các chế độ xử lý PDF và
+hậu xử lý. Engine được tạo khi module được import, nên mỗi tiến trình worker có client / model riêng.
+"""
+
+import os
+import time
+import asyncio
+import contextlib
+from typing import List, Dict, Any, Optional
+from ocr_doc_utils import utils, postprocess, schemas, cache, metrics, resilience, singleflight
+import engines
+import pdf_pages
+
+logger = utils.setup_logging()
+
+# 1) Đọc API key từ biến môi trường
+MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
+OCR_MODE = os.getenv("OCR_MODE", "api")  # api | local | mock
+OCR_MODEL = os.getenv("OCR_MODEL", "mistral-ocr-latest")
+OCR_PROCESS_MODE = os.getenv("OCR_PROCESS_MODE", "document")  # document | pages | parallel
+OCR_PAGE_DPI = int(os.getenv("OCR_PAGE_DPI", "200"))
+# File lớn hơn ngưỡng này được upload lên Mistral (signed URL) thay vì nhúng base64 vào request
+OCR_INLINE_MAX_BYTES = int(os.getenv("OCR_INLINE_MAX_BYTES", str(4 * 1024 * 1024)))
+# Chế độ parallel: số trang mỗi chunk, số chunk chạy đồng thời, số lần thử lại mỗi chunk (thay OCR_ENGINE_RETRY_ATTEMPTS)
+OCR_PARALLEL_CHUNK_PAGES = int(os.getenv("OCR_PARALLEL_CHUNK_PAGES", "8"))
+OCR_PARALLEL_CONCURRENCY = int(os.getenv("OCR_PARALLEL_CONCURRENCY", "4"))
+OCR_PARALLEL_RETRIES = int(os.getenv("OCR_PARALLEL_RETRIES", "2"))
+# Nạp model / kết nối trước khi nhận request (mặc định bật cho local)
+OCR_WARMUP = os.getenv("OCR_WARMUP", "1" if OCR_MODE == "local" else "0") == "1"
+# Pool engine theo API key riêng: số client tối đa và thời gian rảnh trước khi bị loại
+OCR_ENGINE_POOL_SIZE = int(os.getenv("OCR_ENGINE_POOL_SIZE", "32"))
+OCR_ENGINE_IDLE_TTL = float(os.getenv("OCR_ENGINE_IDLE_TTL", "600"))
+# Thời gian tối đa của một lời gọi engine (giây, 0 = không giới hạn; mặc định tắt với engine local)
+OCR_ENGINE_TIMEOUT = float(os.getenv("OCR_ENGINE_TIMEOUT", "0" if OCR_MODE == "local" else "300"))
+
+if not MISTRAL_API_KEY and OCR_MODE == "api":
+    raise RuntimeError("MISSING MISTRAL_API_KEY! Required when OCR_MODE=api")
+
+# 2) Khởi tạo engine mặc định (local: model được nạp một lần cho mỗi worker)
+if OCR_MODE == "api":
+    default_engine = engines.MistralEngine(MISTRAL_API_KEY, model=OCR_MODEL, inline_max_bytes=OCR_INLINE_MAX_BYTES,
+                                           timeout=OCR_ENGINE_TIMEOUT or None)
+elif OCR_MODE == "local":
+    default_engine = engines.build_local_engine()
+elif OCR_MODE == "mock":
+    # Engine giả lập cho load test (OCR_MOCK_PAGE_LATENCY, OCR_MOCK_FAILURE_RATE, OCR_MOCK_PAGE_CHARS)
+    default_engine = engines.build_mock_engine()
+else:
+    raise RuntimeError(f"Unsupported OCR_MODE: {OCR_MODE}")
+
+# 3) Cache kết quả theo hash nội dung + model (memory | disk | redis, xem cache.build_cache)
+result_cache = cache.build_cache()
+# Upload đồng thời cùng nội dung chỉ gọi engine một lần: gộp trong tiến trình và giữa các worker
+# qua file lock dưới OCR_SINGLEFLIGHT_DIR ("none" = chỉ gộp trong tiến trình)
+OCR_SINGLEFLIGHT_DIR = os.getenv("OCR_SINGLEFLIGHT_DIR", "/data/inflight")
+single_flight = singleflight.SingleFlight(
+    None if OCR_SINGLEFLIGHT_DIR.lower() == "none" else OCR_SINGLEFLIGHT_DIR,
+    result_ttl=float(os.getenv("OCR_SINGLEFLIGHT_TTL", "60"))
+)
+
+# 4) Engine cho API key riêng (header X-API-Key) được tái sử dụng qua pool
+engine_pool = engines.EnginePool(
+    engines.build_mock_engine if OCR_MODE == "mock" else
+    lambda api_key: engines.MistralEngine(api_key, model=OCR_MODEL, inline_max_bytes=OCR_INLINE_MAX_BYTES,
+                                          timeout=OCR_ENGINE_TIMEOUT or None),
+    max_size=OCR_ENGINE_POOL_SIZE,
+    idle_ttl=OCR_ENGINE_IDLE_TTL
+)
+
+# Lời gọi engine.process: thử lại lỗi tạm thời (backoff có jitter), hedge theo phân vị độ trễ
+# và circuit breaker để trả 503 ngay khi provider đang hỏng (cấu hình OCR_ENGINE_*, xem resilience.build_caller)
+engine_caller = resilience.build_caller("engine", "OCR_ENGINE", timeout=OCR_ENGINE_TIMEOUT)
+
+# 5) Số liệu xử lý (GET /metrics của front; worker không phục vụ HTTP)
+OCR_FILES = metrics.registry.counter("ocr_files_total", "Số file được OCR", ("content_type", "mode", "cache"))
+OCR_FILE_BYTES = metrics.registry.counter("ocr_file_bytes_total", "Tổng byte file được OCR", ("content_type",))
+OCR_PAGES = metrics.registry.counter("ocr_pages_total", "Số trang trả về", ("content_type",))
+OCR_ERRORS = metrics.registry.counter("ocr_engine_errors_total", "Số lỗi khi xử lý OCR", ("engine", "mode"))
+
+@contextlib.asynccontextmanager
+async def engine_lease(api_key: Optional[str]):
+    """
+    Engine cho một request: API key riêng (header X-API-Key) mượn client từ pool,
+    còn lại dùng engine mặc định của tiến trình.
+    """
+    if OCR_MODE in ("api", "mock") and api_key and api_key != MISTRAL_API_KEY:
+        async with engine_pool.lease(api_key) as engine:
+            yield engine
+    else:
+        yield default_engine
+
+def latency_key(engine: engines.OCREngine, content_type: str, size: int) -> str:
+    """Nhóm thống kê độ trễ cho hedge: engine, loại file và cỡ file (theo luỹ thừa của 2)."""
+    return f"{engine.name}:{content_type}:{size.bit_length()}"
+
+async def ocr_file(engine: engines.OCREngine, path: str, filename: str, content_type: str, size: int,
+                   include_images: bool = False):
+    """
+    OCR cả file trong một lần gọi engine.
+    Trả về (markdown từng trang, ảnh trích xuất — rỗng nếu không yêu cầu).
+    """
+    # prepare: base64 hoặc upload file lên Mistral; engine_call: chờ kết quả OCR
+    with metrics.stage("prepare"):
+        doc = await engine.prepare(path, filename, content_type, size)
+    try:
+        # Hedge chỉ khi không lấy ảnh: hai lời gọi cùng về sẽ ghi ảnh hai lần vào doc.images
+        with metrics.stage("engine_call"):
+            pages = await engine_caller.call(
+                lambda: engine.process(doc, include_images=include_images),
+                hedge=not include_images, latency_key=latency_key(engine, content_type, size)
+            )
+        return pages, doc.images
+    finally:
+        await engine.release(doc)
+
+def write_images(images: List[Dict[str, Any]], images_dir: str) -> List[Dict[str, Any]]:
+    """
+    Ghi ảnh trích xuất ra thư mục phiên (ngoài response), trả về danh sách tham chiếu
+    {"page": số trang (từ 1), "id": tên ảnh trong markdown, "path": ..., "size_bytes": ...}.
+    """
+    refs = []
+    for image in images:
+        page_dir = os.path.join(images_dir, f"page_{image['page'] + 1:04d}")
+        os.makedirs(page_dir, exist_ok=True)
+        path = os.path.join(page_dir, os.path.basename(image["id"]))
+        with open(path, "wb") as f:
+            f.write(image["data"])
+        refs.append({"page": image["page"] + 1, "id": image["id"], "path": path, "size_bytes": len(image["data"])})
+    return refs
+
+async def ocr_pdf_by_page(engine: engines.OCREngine, path: str, filename: str, session_dir: str,
+                          include_images: bool = False):
+    """
+    Chế độ theo trang: tách PDF thành ảnh từng trang (pdf2image), hash ảnh render
+    và chỉ gửi các trang chưa có trong cache tới engine.
+    Cache trang chỉ lưu markdown nên khi cần ảnh, mọi trang đều được OCR lại.
+    Trả về (danh sách markdown theo thứ tự trang, số trang lấy từ cache, ảnh trích xuất).
+    """
+    page_total = await asyncio.to_thread(pdf_pages.page_count, path)
+    pages, reused, images = [], 0, []
+    for page_no in range(1, page_total + 1):
+        # Render từng trang một (ngoài event loop) để không giữ toàn bộ ảnh của PDF trong bộ nhớ
+        with metrics.stage("render"):
+            png = await asyncio.to_thread(pdf_pages.render_page, path, page_no, OCR_PAGE_DPI)
+        
+        page_key = cache.make_key(utils.compute_file_hash(png), engine.model, namespace="page")
+        cached_page = None if include_images else await asyncio.to_thread(result_cache.get, page_key)
+        if cached_page is not None:
+            pages.append(cached_page["markdown"])
+            reused += 1
+            continue
+        
+        logger.info(f"Processing page {page_no}/{page_total} of {filename} with {engine.name} engine")
+        page_path = os.path.join(session_dir, f"page_{page_no:04d}.png")
+        with open(page_path, "wb") as f:
+            f.write(png)
+        page_markdowns, page_images = await ocr_file(
+            engine, page_path, os.path.basename(page_path), "image/png", len(png), include_images
+        )
+        markdown = "\n\n".join(page_markdowns)
+        await asyncio.to_thread(result_cache.set, page_key, {"markdown": markdown})
+        pages.append(markdown)
+        images.extend({**image, "page": page_no - 1} for image in page_images)
+    return pages, reused, images
+
+async def ocr_pdf_parallel(engine: engines.OCREngine, path: str, filename: str, content_type: str, file_size: int,
+                           include_images: bool = False):
+    """
+    Chế độ parallel: chia PDF thành các khoảng trang, OCR đồng thời (giới hạn bởi
+    OCR_PARALLEL_CONCURRENCY) với thử lại theo từng chunk, rồi ghép lại đúng thứ tự trang.
+    Trả về (danh sách markdown theo thứ tự trang, thời gian từng chunk, ảnh trích xuất).
+    """
+    page_total = await asyncio.to_thread(pdf_pages.page_count, path)
+    ranges = [
+        (start, min(start + OCR_PARALLEL_CHUNK_PAGES, page_total))
+        for start in range(0, page_total, OCR_PARALLEL_CHUNK_PAGES)
+    ]
+    # Mọi chunk dùng chung một document đã chuẩn bị
+    with metrics.stage("prepare"):
+        doc = await engine.prepare(path, filename, content_type, file_size, shared=True)
+    semaphore = asyncio.Semaphore(OCR_PARALLEL_CONCURRENCY)
+    
+    async def run_chunk(start: int, end: int):
+        async with semaphore:
+            chunk_start = time.time()
+            attempt = 0
+
+            async def process_chunk():
+                nonlocal attempt
+                attempt += 1
+                return await engine.process(doc, pages=list(range(start, end)), include_images=include_images)
+
+            # Các chunk chạy đồng thời: engine_call là tổng thời gian của mọi chunk
+            with metrics.stage("engine_call"):
+                chunk_pages = await engine_caller.call(
+                    process_chunk, hedge=not include_images, attempts=OCR_PARALLEL_RETRIES + 1,
+                    latency_key=f"{engine.name}:chunk:{end - start}"
+                )
+            timing = {
+                "pages": [start + 1, end],
+                "attempts": attempt,
+                "seconds": round(time.time() - chunk_start, 2)
+            }
+            return chunk_pages, timing
+    
+    logger.info(f"Processing {filename} ({page_total} pages) in {len(ranges)} parallel chunks")
+    try:
+        results = await asyncio.gather(*(run_chunk(start, end) for start, end in ranges))
+    finally:
+        await engine.release(doc)
+    
+    pages = [markdown for chunk_pages, _ in results for markdown in chunk_pages]
+    # Các chunk hoàn thành không theo thứ tự: sắp ảnh lại theo trang
+    images = sorted(doc.images, key=lambda image: image["page"])
+    return pages, [timing for _, timing in results], images
+
+async def run_engine(engine: engines.OCREngine, process_mode: str, in_path: str, session_dir: str,
+                     filename: str, content_type: str, file_size: int, include_images: bool = False):
+    """
+    Chạy engine theo chế độ xử lý. Trả về (markdown từng trang, số trang dùng lại từ cache,
+    thời gian từng chunk hoặc None, ảnh trích xuất).
+    """
+    if process_mode == "pages" and content_type == "application/pdf":
+        pages, pages_reused, images = await ocr_pdf_by_page(engine, in_path, filename, session_dir, include_images)
+        return pages, pages_reused, None, images
+    if process_mode == "parallel" and content_type == "application/pdf":
+        pages, chunk_timings, images = await ocr_pdf_parallel(engine, in_path, filename, content_type, file_size, include_images)
+        return pages, 0, chunk_timings, images
+    # Gọi engine OCR với cả file (Mistral cloud hoặc model local)
+    logger.info(f"Processing {filename} with {engine.name} engine")
+    pages, images = await ocr_file(engine, in_path, filename, content_type, file_size, include_images)
+    return pages, 0, None, images
+
+class OCRFailed(Exception):
+    """Lỗi xử lý trả về client, tương ứng HTTPException(status_code, detail, headers)."""
+
+    def __init__(self, status_code: int, detail: str, headers: Optional[Dict[str, str]] = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.headers = headers
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"status_code": self.status_code, "detail": self.detail, "headers": self.headers}
+
+async def process_file(timer: metrics.StageTimer, in_path: str, session_dir: str, filename: str, content_type: str,
+                       file_hash: str, file_size: int, requested: set, mode: Optional[str], api_key: Optional[str],
+                       include_images: bool, debug: bool, start_time: float) -> schemas.OCRResponse:
+    """
+    OCR file đã được ghi vào `session_dir` (bước 4-9 của POST /ocr): tra cache, gọi engine,
+    hậu xử lý và tạo OCRResponse. Ném OCRFailed khi lỗi.
+    """
+    # 4) Tra cache theo hash nội dung + model
+    cache_key = cache.make_key(file_hash, default_engine.model)
+    with timer.stage("cache_lookup"):
+        # Backend disk / redis là I/O chặn: chạy ngoài event loop
+        cached = None if include_images else await asyncio.to_thread(result_cache.get, cache_key)
+    process_mode = (mode or OCR_PROCESS_MODE).lower()
+    if process_mode not in ("document", "pages", "parallel"):
+        raise OCRFailed(400, f"Unsupported mode: {process_mode}")
+    pages_reused = 0
+    chunk_timings = None
+    image_refs = None
+    coalesced = False
+    
+    async def run_ocr():
+        # 5-6) Gọi engine (API key riêng dùng engine từ pool, còn lại engine mặc định)
+        lease_start = time.perf_counter()
+        async with engine_lease(api_key) as engine:
+            timer.record("engine_wait", time.perf_counter() - lease_start)
+            pages, pages_reused, chunk_timings, images = await run_engine(
+                engine, process_mode, in_path, session_dir, filename, content_type, file_size, include_images
+            )
+        await asyncio.to_thread(result_cache.set, cache_key, {"pages": pages})
+        return {"pages": pages, "pages_reused": pages_reused, "chunks": chunk_timings, "images": images}
+    
+    try:
+        if cached is not None:
+            logger.info(f"Cache hit for {filename} (hash: {file_hash})")
+            pages = cached["pages"]
+        elif include_images:
+            # Ảnh được ghi vào thư mục phiên của từng request nên không gộp
+            outcome = await run_ocr()
+            pages, pages_reused, chunk_timings = outcome["pages"], outcome["pages_reused"], outcome["chunks"]
+            with timer.stage("write_images"):
+                image_refs = await asyncio.to_thread(write_images, outcome["images"], os.path.join(session_dir, "images"))
+        else:
+            # Request đồng thời cho cùng nội dung và chế độ (kể cả ở worker khác) chờ chung một lời gọi engine
+            wait_start = time.perf_counter()
+            outcome, coalesced = await single_flight.do(f"{cache_key}:{process_mode}", run_ocr)
+            if coalesced:
+                logger.info(f"Coalesced {filename} (hash: {file_hash}) with an in-flight request")
+                timer.record("coalesce_wait", time.perf_counter() - wait_start)
+            pages, pages_reused, chunk_timings = outcome["pages"], outcome["pages_reused"], outcome["chunks"]
+        
+        # 7) Lấy text từ kết quả - GIỮ ĐỊNH DẠNG
+        texts = []
+        for i, page_markdown in enumerate(pages):
+            # Nếu có nhiều trang, đánh dấu rõ ràng ranh giới giữa các trang
+            if len(pages) > 1:
+                page_header = f"--- Trang {i+1}/{len(pages)} ---\n\n"
+                texts.append(page_header + page_markdown)
+            else:
+                texts.append(page_markdown)
+        
+        # Kết hợp văn bản với ngắt trang rõ ràng
+        combined_text = "\n\n" + "\n\n" + "\n\n".join(texts)
+        
+        # Áp dụng hậu xử lý nhưng giữ định dạng (từng trang, kết quả như correct(combined_text)),
+        # bỏ qua khi profile không cần văn bản đã làm sạch
+        full_profile = requested >= set(schemas.RESPONSE_FIELDS)
+        clean_text = None
+        if full_profile or requested & {"text", "markdown"}:
+            with timer.stage("postprocess"):
+                clean_text = "".join(postprocess.correct_stream(texts))
+        
+        # 8) Tạo markdown có định dạng tốt hơn
+        markdown = None
+        if "markdown" in requested:
+            markdown = f"""```markdown
+{clean_text}
+```"""
+        
+        # 9) Chuẩn bị kết quả
+        json_result = {
+            "text": combined_text,
+            "clean": clean_text,
+            "page_count": len(pages),
+            "results": texts,
+            "processing_time_seconds": round(time.time() - start_time, 2),
+            "filename": filename,
+            "file_size_bytes": file_size,
+            "timestamp": utils.get_timestamp(),
+            "content_type": content_type,
+            "file_hash": file_hash,
+            "cache_hit": cached is not None,
+            "coalesced": coalesced,
+            "mode": process_mode,
+            "pages_reused": pages_reused
+        }
+        if chunk_timings is not None:
+            json_result["chunks"] = chunk_timings
+        if image_refs is not None:
+            json_result["image_count"] = len(image_refs)
+        if debug:
+            json_result["stages"] = timer.summary()
+        
+        type_label = metrics.content_type_label(content_type)
+        OCR_FILES.inc(content_type=type_label, mode=process_mode, cache="hit" if cached is not None else "coalesced" if coalesced else "miss")
+        OCR_FILE_BYTES.inc(file_size, content_type=type_label)
+        OCR_PAGES.inc(len(pages), content_type=type_label)
+        with timer.stage("serialize"):
+            return schemas.build_response(
+                requested,
+                text=clean_text,
+                markdown=markdown,
+                raw_json=json_result,
+                images=image_refs
+            )
+        
+    except resilience.CircuitOpen as e:
+        OCR_ERRORS.inc(engine=default_engine.name, mode=process_mode)
+        raise OCRFailed(503, str(e), headers={"Retry-After": str(max(1, round(e.retry_after)))})
+    except Exception as e:
+        OCR_ERRORS.inc(engine=default_engine.name, mode=process_mode)
+        logger.error(f"OCR processing error: {str(e)}")
+        raise OCRFailed(502, f"OCR processing error: {str(e)}")
@@ -1,125 +1,208 @@
 # ocr-service/server.py
 
 import os
-import io
-import base64
 import time
-from typing import List, Dict, Any, Optional
-from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, Body, Header
-from ocr_doc_utils import utils, postprocess, schemas
-from pdf2image import convert_from_bytes
-from mistralai import Mistral
-import requests
-from PIL import Image
+import asyncio
+import hashlib
+from typing import Dict, Optional
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks, Body, Header
+from ocr_doc_utils import utils, schemas, cache, metrics, tracing, admission, workqueue, storage
+import pipeline
 
 logger = utils.setup_logging()
 app = FastAPI()
 
-# 1) Đọc API key từ biến môi trường
-MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
-OCR_MODE = os.getenv("OCR_MODE", "api")  # api | local
+# 1) Cấu hình HTTP front (engine, cache và chế độ xử lý: xem pipeline.py)
+# Thời gian nhớ kết quả kiểm tra API key
+OCR_VALIDATE_CACHE_TTL = float(os.getenv("OCR_VALIDATE_CACHE_TTL", "300"))
+# Gắn thời gian từng giai đoạn vào raw_json["stages"] cho mọi request (hoặc từng request qua form `debug`)
+OCR_DEBUG_TIMINGS = os.getenv("OCR_DEBUG_TIMINGS", "0") == "1"
+# inline: OCR ngay trong tiến trình HTTP; queue: đưa vào hàng đợi cho các tiến trình worker.py
+OCR_WORKER_MODE = os.getenv("OCR_WORKER_MODE", "inline").lower()
+# Thời gian tối đa chờ worker trả kết quả (chế độ queue)
+OCR_WORKER_TIMEOUT = float(os.getenv("OCR_WORKER_TIMEOUT", "900"))
+if OCR_WORKER_MODE not in ("inline", "queue"):
+    raise RuntimeError(f"Unsupported OCR_WORKER_MODE: {OCR_WORKER_MODE}")
 
-if not MISTRAL_API_KEY and OCR_MODE == "api":
-    raise RuntimeError("MISSING MISTRAL_API_KEY! Required when OCR_MODE=api")
+# 2) Kết quả kiểm tra API key được nhớ trong thời gian ngắn
+validation_cache = cache.ResultCache(cache.MemoryBackend(max_entries=1024, ttl=OCR_VALIDATE_CACHE_TTL))
 
-# 2) Khởi tạo client
-ocr_client = Mistral(api_key=MISTRAL_API_KEY) if OCR_MODE == "api" else None
+# 3) Lưu trữ upload dưới /data/uploads: nội dung theo hash (upload trùng lưu một lần), thư mục phiên
+#    chia theo ngày / giờ, janitor dọn theo TTL và quota (xem storage.build_storage). Phiên chưa quá
+#    OCR_WORKER_TIMEOUT giây có thể còn đang được OCR (hoặc chờ worker) nên không bị xoá.
+upload_storage = storage.build_storage(min_age=OCR_WORKER_TIMEOUT)
+OCR_STORAGE_JANITOR_INTERVAL = float(os.getenv("OCR_STORAGE_JANITOR_INTERVAL", "300"))
+janitor_task: Optional[asyncio.Task] = None
 
-@app.post("/ocr", response_model=schemas.OCRResponse)
+# 4) Chế độ queue: hàng đợi dùng chung với worker (sqlite dưới /data | redis, xem workqueue.build_queue)
+work_queue = workqueue.build_queue() if OCR_WORKER_MODE == "queue" else None
+#    API key riêng chỉ vào hàng đợi dưới dạng mã hoá (OCR_QUEUE_SECRET); chưa đặt secret thì request
+#    có key riêng được OCR ngay trong front để key không bị ghi ra đĩa
+key_sealer = workqueue.build_sealer() if work_queue is not None else None
+
+# 5) Admission control trước engine: giới hạn request OCR đồng thời, hàng đợi có giới hạn
+#    (đầy hoặc chờ quá lâu → 429 + Retry-After) và token bucket theo header X-API-Key.
+#    Request bị từ chối trước khi upload được đọc; thêm trước metrics/tracing để 429 vẫn được đếm.
+admission_limiter, rate_limiter = admission.build_admission("ocr-service")
+app.add_middleware(admission.AdmissionMiddleware, limiter=admission_limiter, paths=("/ocr",),
+                   rate_limiter=rate_limiter)
+
+# 6) Metrics (GET /metrics): request/độ trễ theo route, giai đoạn xử lý, cache, lỗi engine và hàng đợi worker
+metrics.instrument_app(app, "ocr-service")
+
+# Số liệu chỉ tăng (xuất dạng counter `_total` để dùng được rate()); còn lại là gauge
+CACHE_COUNTER_STATS = {"hits", "misses", "errors", "evictions"}
+
+def cache_metrics():
+    """Số liệu cache kết quả và pool engine đọc lúc scrape."""
+    lines = []
+    for name, stats in (("ocr_result_cache", pipeline.result_cache.stats()), ("ocr_engine_pool", pipeline.engine_pool.stats())):
+        for key, value in stats.items():
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                continue
+            if key in CACHE_COUNTER_STATS:
+                lines += [f"# TYPE {name}_{key}_total counter", f"{name}_{key}_total {value}"]
+            else:
+                lines += [f"# TYPE {name}_{key} gauge", f"{name}_{key} {value}"]
+    return lines
+
+metrics.registry.add_collector(cache_metrics)
+if work_queue is not None:
+    metrics.registry.add_collector(lambda: workqueue.queue_metrics(work_queue))
+
+# 7) Tracing: span của request nối vào traceparent từ API, các giai đoạn là span con
+tracer = tracing.configure("ocr-service")
+tracing.instrument_app(app, tracer)
+
+@app.on_event("startup")
+async def warmup_engine():
+    global janitor_task
+    janitor_task = asyncio.create_task(upload_storage.run_janitor(OCR_STORAGE_JANITOR_INTERVAL))
+    # Chế độ queue: engine chỉ chạy trong worker, front không nạp model
+    if pipeline.OCR_WARMUP and OCR_WORKER_MODE == "inline":
+        await pipeline.default_engine.warmup()
+
+@app.on_event("shutdown")
+async def close_engines():
+    if janitor_task is not None:
+        janitor_task.cancel()
+    await pipeline.engine_pool.aclose()
+    await pipeline.default_engine.aclose()
+
+async def spool_upload(file: UploadFile, path: str):
+    """
+    Ghi file upload xuống đĩa theo từng khối, đồng thời tính hash.
+    Trả về (hash, số byte) mà không giữ toàn bộ file trong bộ nhớ.
+    """
+    hasher = utils.file_hasher()
+    size = 0
+    with open(path, "wb") as out:
+        while True:
+            chunk = await file.read(utils.CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            out.write(chunk)
+            size += len(chunk)
+    return hasher.hexdigest(), size
+
+
+@app.post("/ocr", response_model=schemas.OCRResponse, response_model_exclude_unset=True)
 async def do_ocr(
     file: UploadFile = File(...), 
     background_tasks: BackgroundTasks = None, 
-    x_api_key: Optional[str] = Header(None)
+    x_api_key: Optional[str] = Header(None),
+    mode: Optional[str] = Form(None),
+    fields: Optional[str] = Form(None),
+    include_images: bool = Form(False),
+    debug: bool = Form(False)
 ):
     """
     Process a file (PDF or image) and extract text using OCR.
     Returns a structured OCRResponse with comprehensive metadata similar to stand.py.
+    
+    mode: "document" gửi cả file trong một lần gọi; "pages" OCR từng trang PDF
+    và dùng lại kết quả các trang không đổi; "parallel" OCR đồng thời các khoảng trang
+    của PDF lớn (mặc định theo OCR_PROCESS_MODE).
+    fields: profile response, vd. "text" hoặc "text,pages,meta" (xem schemas.RESPONSE_FIELDS);
+    mặc định trả đầy đủ.
+    include_images: trích xuất ảnh trong trang, ghi vào thư mục phiên dưới /data và trả về
+    đường dẫn trong `images` (không nhúng base64). Khi bật, cache kết quả không được dùng
+    vì cache chỉ lưu văn bản.
+    debug: gắn thời gian từng giai đoạn (giây) vào raw_json["stages"] (luôn bật khi OCR_DEBUG_TIMINGS=1).
     """
     start_time = time.time()  # Track processing time
+    try:
+        requested = schemas.parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    # Use custom API key if provided in header, otherwise use the default
-    api_key_to_use = x_api_key or MISTRAL_API_KEY
-    
-    # Initialize client with the appropriate API key
-    if OCR_MODE == "api":
-        # Create client with potentially custom API key
-        current_client = Mistral(api_key=api_key_to_use)
-    else:
-        current_client = ocr_client
-    
-    # 1) Đọc raw bytes
-    data = await file.read()
+    with metrics.start_timer("ocr-service", file.content_type or "application/octet-stream") as timer:
+        return await process_upload(
+            file, timer, requested, mode, x_api_key, include_images, debug or OCR_DEBUG_TIMINGS, start_time
+        )
+
+async def process_upload(file: UploadFile, timer: metrics.StageTimer, requested: set, mode: Optional[str],
+                         x_api_key: Optional[str], include_images: bool, debug: bool, start_time: float):
+    """Phần xử lý của do_ocr, chạy trong StageTimer của request."""
+    # 1) Hết quota (kể cả sau khi dọn) thì từ chối trước khi đọc upload
+    try:
+        await asyncio.to_thread(upload_storage.check_quota)
+    except storage.QuotaExceeded as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
     
-    # 2) Tạo thư mục phiên mới
-    session_dir = utils.new_session_dir("/data")
-    in_path = os.path.join(session_dir, file.filename or "unnamed_file")
-    with open(in_path, "wb") as f:
-        f.write(data)
+    # 2) Ghi file theo luồng vào file tạm, tính hash tăng dần, rồi lưu theo hash và
+    #    gắn vào thư mục phiên mới
+    filename = file.filename or "unnamed_file"
+    with timer.stage("upload"):
+        tmp_path = upload_storage.temp_path()
+        try:
+            file_hash, file_size = await spool_upload(file, tmp_path)
+        except BaseException:
+            upload_storage.discard(tmp_path)
+            raise
+        session_dir = upload_storage.new_session()
+        in_path = await asyncio.to_thread(upload_storage.ingest, tmp_path, file_hash, session_dir, filename)
     
     # 3) Lấy thông tin file
-    filename = file.filename or "unnamed_file"
-    file_size = len(data)
     content_type = file.content_type or "application/octet-stream"
     
-    # 4) Tạo data URI
-    data_uri = f"data:{content_type};base64,{base64.b64encode(data).decode()}"
-    
-    try:
-        # 5) Xác định loại document
-        doc_type = "document_url" if content_type == "application/pdf" else "image_url"
-        doc = {"type": doc_type, doc_type: data_uri}
-        
-        # 6) Gọi Mistral OCR API (giống stand.py)
-        logger.info(f"Processing {filename} with Mistral OCR API")
-        ocr_result = current_client.ocr.process(
-            model="mistral-ocr-latest", 
-            document=doc,
-            include_image_base64=True
+    # 4-9) OCR trong tiến trình này hoặc qua worker
+    if work_queue is not None and (not x_api_key or key_sealer is not None):
+        return await process_via_queue(
+            timer, in_path=in_path, session_dir=session_dir, filename=filename, content_type=content_type,
+            file_hash=file_hash, file_size=file_size, fields=sorted(requested), mode=mode,
+            sealed_api_key=key_sealer.seal(x_api_key) if x_api_key else None,
+            include_images=include_images, debug=debug, start_time=start_time,
         )
-        
-        # 7) Lấy text từ kết quả - GIỮ ĐỊNH DẠNG
-        texts = []
-        for i, page in enumerate(ocr_result.pages):
-            # Nếu có nhiều trang, đánh dấu rõ ràng ranh giới giữa các trang
-            if len(ocr_result.pages) > 1:
-                page_header = f"--- Trang {i+1}/{len(ocr_result.pages)} ---\n\n"
-                texts.append(page_header + page.markdown)
-            else:
-                texts.append(page.markdown)
-        
-        # Kết hợp văn bản với ngắt trang rõ ràng
-        combined_text = "\n\n" + "\n\n" + "\n\n".join(texts)
-        
-        # Áp dụng hậu xử lý nhưng giữ định dạng
-        clean_text = postprocess.correct(combined_text)
-        
-        # 8) Tạo markdown có định dạng tốt hơn
-        markdown = f"""```markdown
-{clean_text}
-```"""
-        
-        # 9) Chuẩn bị kết quả
-        json_result = {
-            "text": combined_text,
-            "clean": clean_text,
-            "page_count": len(ocr_result.pages),
-            "results": texts,
-            "processing_time_seconds": round(time.time() - start_time, 2),
-            "filename": filename,
-            "file_size_bytes": file_size,
-            "timestamp": utils.get_timestamp(),
-            "content_type": content_type
-        }
-        
-        return schemas.OCRResponse(
-            text=clean_text,
-            markdown=markdown,
-            raw_json=json_result
+    try:
+        return await pipeline.process_file(
+            timer, in_path, session_dir, filename, content_type, file_hash, file_size,
+            requested, mode, x_api_key, include_images, debug, start_time
         )
-        
-    except Exception as e:
-        logger.error(f"OCR processing error: {str(e)}")
-        raise HTTPException(status_code=502, detail=f"OCR processing error: {str(e)}")
+    except pipeline.OCRFailed as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
+
+async def process_via_queue(timer: metrics.StageTimer, **task) -> Dict:
+    """
+    Đưa task vào hàng đợi và chờ worker trả kết quả. File nằm trong thư mục phiên dưới /data
+    (volume dùng chung với worker), task chỉ chứa đường dẫn và tham số.
+    """
+    task["traceparent"] = tracing.inject().get(tracing.TRACEPARENT)
+    with timer.stage("queue"):
+        task_id = await asyncio.to_thread(work_queue.submit, task)
+        outcome = await workqueue.wait_outcome(work_queue, task_id, OCR_WORKER_TIMEOUT)
+    if outcome is None:
+        await asyncio.to_thread(work_queue.cancel, task_id)
+        raise HTTPException(status_code=504, detail="OCR worker xử lý quá lâu. Vui lòng thử lại sau.")
+    if outcome["status"] == workqueue.FAILED:
+        error = outcome["error"]
+        raise HTTPException(status_code=error["status_code"], detail=error["detail"], headers=error.get("headers"))
+    result = outcome["result"]
+    if task["debug"] and "stages" in result.get("raw_json", {}):
+        # Thời gian của front (upload, chờ hàng đợi) + của worker
+        result["raw_json"]["stages"] = {**timer.summary(), **result["raw_json"]["stages"]}
+    return result
 
 @app.post("/validate_api_key")
 async def validate_api_key(data: Dict[str, str] = Body(...)):
@@ -131,20 +214,41 @@ async def validate_api_key(data: Dict[str, str] = Body(...)):
     if not api_key:
         raise HTTPException(status_code=400, detail="API key is required")
     
+    # Kết quả đã biết trong OCR_VALIDATE_CACHE_TTL giây gần nhất thì không gọi mạng
+    key_digest = hashlib.sha256(api_key.encode()).hexdigest()
+    known = validation_cache.get(key_digest)
+    if known is not None:
+        if known["valid"]:
+            return {"status": "valid", "message": "API key is valid"}
+        raise HTTPException(status_code=401, detail=known["detail"])
+    
     try:
-        # Create temporary client with the provided API key
-        test_client = Mistral(api_key=api_key)
-        
-        # Try a lightweight request to verify the key
+        # Try a lightweight request to verify the key, reusing the pooled client
         # We'll just get models list as a simple verification
-        response = test_client.models.list()
+        async with pipeline.engine_pool.lease(api_key) as engine:
+            await engine.validate()
         
         # If we get here, the API key is valid
+        validation_cache.set(key_digest, {"valid": True})
         return {"status": "valid", "message": "API key is valid"}
     except Exception as e:
-        # Any exception means the key is invalid
+        # Any exception means the key is invalid; only cache definite auth failures
         logger.error(f"Invalid API key: {str(e)}")
-        raise HTTPException(status_code=401, detail=f"Invalid API key: {str(e)}")
+        detail = f"Invalid API key: {str(e)}"
+        if getattr(e, "status_code", None) in (401, 403):
+            validation_cache.set(key_digest, {"valid": False, "detail": detail})
+        raise HTTPException(status_code=401, detail=detail)
+
+@app.get("/stats")
+def stats():
+    """Cache hit/miss counters, engine pool, API key validation cache and upload storage usage"""
+    return {
+        "cache": pipeline.result_cache.stats(),
+        "engine_pool": pipeline.engine_pool.stats(),
+        "validation_cache": validation_cache.stats(),
+        "storage": upload_storage.stats(),
+        "timestamp": utils.get_timestamp()
+    }
 
 @app.get("/health")
 def health_check():
@@ -152,5 +256,8 @@ def health_check():
     return {
         "status": "ok",
         "timestamp": utils.get_timestamp(),
-        "mode": OCR_MODE
+        "mode": pipeline.OCR_MODE,
+        "worker_mode": OCR_WORKER_MODE,
+        "engine": pipeline.default_engine.name,
+        "model": pipeline.default_engine.model
     }
@@ -0,0 +1,196 @@
+# ocr-service/worker.py
+"""
+Tiến trình worker OCR cho OCR_WORKER_MODE=queue: HTTP front (server.py) ghi file vào thư mục phiên
+dưới /data và đưa task vào hàng đợi (workqueue.build_queue); worker lấy task, chạy pipeline
+(engine + hậu xử lý) rồi ghi kết quả lại cho front.
+
+    python worker.py --processes 4 --concurrency 2
+
+Mỗi tiến trình con tự import pipeline nên có engine / model / client riêng. Worker ở nhiều máy dùng
+chung hàng đợi redis và volume /data. SIGTERM / SIGINT: ngừng nhận task mới, xử lý nốt task đang
+chạy (tối đa OCR_WORKER_DRAIN_TIMEOUT giây) rồi thoát.
+"""
+
+import os
+import sys
+import time
+import signal
+import socket
+import asyncio
+import argparse
+import multiprocessing
+
+from ocr_doc_utils import utils
+
+logger = utils.setup_logging()
+
+# Chu kỳ gửi heartbeat của task đang chạy và thời gian mất heartbeat trước khi task bị trả lại hàng đợi
+OCR_WORKER_HEARTBEAT = float(os.getenv("OCR_WORKER_HEARTBEAT", "10"))
+OCR_WORKER_LEASE = float(os.getenv("OCR_WORKER_LEASE", "60"))
+OCR_WORKER_POLL_INTERVAL = float(os.getenv("OCR_WORKER_POLL_INTERVAL", "0.2"))
+OCR_WORKER_DRAIN_TIMEOUT = float(os.getenv("OCR_WORKER_DRAIN_TIMEOUT", "900"))
+
+
+async def heartbeat(queue, task_id: str) -> None:
+    while True:
+        await asyncio.sleep(OCR_WORKER_HEARTBEAT)
+        try:
+            await asyncio.to_thread(queue.heartbeat, task_id)
+        except Exception as e:
+            logger.warning(f"Heartbeat failed for task {task_id}: {e}")
+
+
+async def handle_task(queue, tracer, sealer, task: dict) -> None:
+    """Chạy một task và ghi kết quả (hoặc lỗi dạng HTTPException) vào hàng đợi."""
+    import pipeline
+    from fastapi.encoders import jsonable_encoder
+    from ocr_doc_utils import metrics
+
+    payload = task["payload"]
+    beat = asyncio.create_task(heartbeat(queue, task["id"]))
+    try:
+        api_key = None
+        if payload.get("sealed_api_key"):
+            if sealer is None:
+                raise RuntimeError("OCR_QUEUE_SECRET is not set on the worker")
+            api_key = sealer.unseal(payload["sealed_api_key"])
+        with tracer.start_span("ocr.worker", traceparent=payload.get("traceparent"),
+                               attributes={"task.id": task["id"], "task.attempts": task["attempts"]}):
+            with metrics.start_timer("ocr-worker", payload["content_type"]) as timer:
+                response = await pipeline.process_file(
+                    timer, payload["in_path"], payload["session_dir"], payload["filename"], payload["content_type"],
+                    payload["file_hash"], payload["file_size"], set(payload["fields"]), payload["mode"],
+                    api_key, payload["include_images"], payload["debug"], payload["start_time"]
+                )
+        outcome = ("complete", jsonable_encoder(response, exclude_unset=True))
+    except pipeline.OCRFailed as e:
+        outcome = ("fail", e.to_dict())
+    except Exception as e:
+        logger.error(f"Task {task['id']} failed: {e}")
+        outcome = ("fail", {"status_code": 500, "detail": f"OCR worker error: {e}"})
+    finally:
+        beat.cancel()
+    method, data = outcome
+    await asyncio.to_thread(getattr(queue, method), task["id"], data)
+
+
+async def run_worker(index: int, concurrency: int) -> None:
+    """Vòng lặp của một tiến trình worker: tối đa `concurrency` task chạy đồng thời."""
+    import pipeline
+    from ocr_doc_utils import tracing, workqueue
+
+    queue = workqueue.build_queue()
+    sealer = workqueue.build_sealer()
+    tracer = tracing.configure("ocr-worker")
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    if pipeline.OCR_WARMUP:
+        await pipeline.default_engine.warmup()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    slots = asyncio.Semaphore(concurrency)
+    running = set()
+    last_reap = 0.0
+    logger.info(f"OCR worker {index} ({name}) started, concurrency {concurrency}")
+    while not stop.is_set():
+        await slots.acquire()
+        if stop.is_set():
+            slots.release()
+            break
+        # Worker nào cũng có thể trả lại task của worker đã chết (mất heartbeat)
+        if time.monotonic() - last_reap > OCR_WORKER_LEASE / 2:
+            last_reap = time.monotonic()
+            requeued = await asyncio.to_thread(queue.requeue_stale, OCR_WORKER_LEASE)
+            if requeued:
+                logger.warning(f"Requeued {requeued} task(s) from lost workers")
+        task = await asyncio.to_thread(queue.claim, name)
+        if task is None:
+            slots.release()
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=OCR_WORKER_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        job = asyncio.create_task(handle_task(queue, tracer, sealer, task))
+        running.add(job)
+        job.add_done_callback(lambda done: (running.discard(done), slots.release()))
+
+    # Graceful drain: không nhận task mới, chờ task đang chạy xong
+    if running:
+        logger.info(f"OCR worker {index} draining {len(running)} task(s)")
+        await asyncio.gather(*running, return_exceptions=True)
+    await pipeline.engine_pool.aclose()
+    await pipeline.default_engine.aclose()
+    logger.info(f"OCR worker {index} stopped")
+
+
+def worker_main(index: int, concurrency: int, metrics_port: int) -> None:
+    if metrics_port:
+        from ocr_doc_utils import metrics
+        metrics.start_http_server(metrics_port + index)
+    asyncio.run(run_worker(index, concurrency))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OCR worker processes (OCR_WORKER_MODE=queue)")
+    parser.add_argument("--processes", type=int, default=int(os.getenv("OCR_WORKER_PROCESSES", str(os.cpu_count() or 1))),
+                        help="số tiến trình worker (mặc định số CPU)")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("OCR_WORKER_CONCURRENCY", "1")),
+                        help="số task chạy đồng thời trong mỗi tiến trình (engine cloud có thể đặt cao hơn)")
+    parser.add_argument("--metrics-port", type=int, default=int(os.getenv("OCR_WORKER_METRICS_PORT", "0")),
+                        help="GET /metrics của tiến trình thứ i ở cổng metrics-port + i (0 = tắt)")
+    args = parser.parse_args()
+
+    # spawn: tiến trình con không kế thừa client / thread của tiến trình cha
+    context = multiprocessing.get_context("spawn")
+    stopping = False
+    started = {}
+
+    def start(index: int):
+        process = context.Process(target=worker_main, args=(index, args.concurrency, args.metrics_port),
+                                  name=f"ocr-worker-{index}")
+        process.start()
+        started[index] = time.monotonic()
+        return process
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        if not stopping:
+            logger.info("Stopping OCR workers (draining in-flight tasks)")
+        stopping = True
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()  # SIGTERM → worker ngừng nhận task và chờ task đang chạy
+
+    processes = {index: start(index) for index in range(args.processes)}
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    deadline = None
+    while processes:
+        for index, process in list(processes.items()):
+            process.join(timeout=0.5)
+            if process.exitcode is None:
+                continue
+            del processes[index]
+            if not stopping:
+                # Worker chết ngoài ý muốn: task của nó được trả lại hàng đợi sau OCR_WORKER_LEASE giây
+                logger.error(f"OCR worker {index} exited with code {process.exitcode}, restarting")
+                if time.monotonic() - started[index] < 10:
+                    time.sleep(5)  # lỗi khi khởi động (cấu hình sai): không khởi động lại liên tục
+                processes[index] = start(index)
+        if stopping:
+            deadline = deadline or time.monotonic() + OCR_WORKER_DRAIN_TIMEOUT
+            if time.monotonic() > deadline:
+                for process in processes.values():
+                    process.kill()
+                logger.error("Drain timeout, killed remaining OCR workers")
+                break
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()